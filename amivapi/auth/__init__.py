@@ -12,7 +12,9 @@ from amivapi.auth.auth import (
     authenticate,
     check_if_admin,
     check_item_write_permission,
-    check_resource_write_permission
+    check_resource_write_permission,
+    flush_touches,
+    TouchBuffer
 )
 from amivapi.auth.link_methods import (
     add_permitted_methods_after_fetch_item,
@@ -21,8 +23,14 @@ from amivapi.auth.link_methods import (
     add_permitted_methods_after_update,
     add_permitted_methods_for_home
 )
-from amivapi.auth.sessions import process_login, sessiondomain
-from amivapi.utils import register_domain
+from amivapi.auth.sessions import (
+    add_login_timings,
+    clear_session_cache,
+    invalidate_session_cache,
+    process_login,
+    sessiondomain
+)
+from amivapi.utils import register_domain, TTLCache
 
 
 def init_app(app):
@@ -34,6 +42,25 @@ def init_app(app):
     register_domain(app, sessiondomain)
     app.on_insert_sessions += process_login
 
+    # Per-process session cache, see `authenticate_token`
+    app.session_cache = TTLCache(app.config['SESSION_CACHE_SIZE'],
+                                 app.config['SESSION_CACHE_TTL'])
+    app.on_deleted_item_sessions += invalidate_session_cache
+    app.on_deleted_resource_sessions += clear_session_cache
+
+    # Per-process LDAP login caches, see `process_login`
+    app.ldap_sync_cache = TTLCache(app.config['LDAP_LOGIN_CACHE_SIZE'],
+                                   app.config['LDAP_SYNC_CACHE_TTL'])
+    app.ldap_failed_binds = TTLCache(
+        app.config['LDAP_LOGIN_CACHE_SIZE'],
+        app.config['LDAP_MAX_FAILED_BINDS'] and
+        app.config['LDAP_FAILED_BIND_TIMEOUT'])
+    app.after_request(add_login_timings)
+
+    # Buffer for session and API key timestamps, see `touch`
+    app.touch_buffer = TouchBuffer(app)
+    app.after_request(flush_touches)
+
     # on_pre_METHOD, triggered right after auth by Eve
     for method in ['GET', 'POST', 'PATCH', 'DELETE']:
         event = getattr(app, 'on_pre_' + method)
@@ -9,12 +9,10 @@ Provides the apikey resource and hooks to handle authorization with a key.
 
 API keys should only be created or modified by admins.
 """
-from datetime import datetime as dt
-
 from flask import abort, current_app, g
 
-from amivapi.auth.auth import AdminOnlyAuth
-from amivapi.utils import register_domain
+from amivapi.auth.auth import AdminOnlyAuth, touch
+from amivapi.utils import register_domain, TTLCache
 
 try:
     from secrets import token_urlsafe
@@ -23,23 +21,57 @@ except ImportError:
     from amivapi.utils import token_urlsafe
 
 
+def get_apikey(token):
+    """Find the API key for a token.
+
+    All keys are loaded at once and kept in the API key cache, so requests
+    with user tokens do not need any database access. Without cache, the key
+    is looked up in the database.
+
+    Returns:
+        dict: The key with `_id`, `permissions` and `_updated` or None
+    """
+    projection = {'token': 1, 'permissions': 1, '_updated': 1}
+    collection = current_app.data.driver.db['apikeys']
+    cache = current_app.apikey_cache
+
+    if not cache.enabled:
+        return collection.find_one({'token': token}, projection)
+
+    index = cache.get('index')
+    if index is None:
+        index = {key['token']: key
+                 for key in collection.find({}, projection)}
+        cache.set('index', index)
+    return index.get(token)
+
+
+def clear_apikey_cache(*args):
+    """Hook to reload all API keys after any change."""
+    current_app.apikey_cache.clear()
+
+
 def authorize_apikeys(resource):
     """Check if user is an apikey, and if it is, do authorization.
 
-    Also update 'updated' timestamp everytime a key is accessed
+    Also update 'updated' timestamp everytime a key is accessed (once per
+    request, even if called for several resources)
     """
-    apikeys = current_app.data.driver.db['apikeys']
-    apikey = apikeys.find_one({'token': g.get('current_token')},
-                              {'permissions': 1})
+    token = g.get('current_token')
+    apikey = get_apikey(token) if token else None
 
     if apikey:
         # Get permission for resource if they exist
         permission = apikey['permissions'].get(resource)
 
-        # Update timestamp (remove microseconds to match mongo precision)
-        new_time = dt.utcnow().replace(microsecond=0)
-        apikeys.update_one({'_id': apikey['_id']},
-                           {'$set': {'_updated': new_time}})
+        if not g.get('apikey_touched'):
+            touch('apikeys', apikey)
+            g.apikey_touched = True
+
+            # Remember that there is no session for this token, so the next
+            # requests skip the session lookup (see `authenticate_token`)
+            if g.get('current_session') is None:
+                current_app.session_cache.set(token, False)
 
         if permission == 'read':
             g.resource_admin_readonly = True
@@ -144,3 +176,10 @@ def init_apikeys(app):
     register_domain(app, apikeydomain)
     app.after_auth += authorize_apikeys
     app.on_insert_apikeys += generate_tokens
+
+    # Per-process index of all keys, see `get_apikey`
+    app.apikey_cache = TTLCache(1, app.config['APIKEY_CACHE_TTL'])
+    app.on_inserted_apikeys += clear_apikey_cache
+    app.on_updated_apikeys += clear_apikey_cache
+    app.on_deleted_item_apikeys += clear_apikey_cache
+    app.on_deleted_resource_apikeys += clear_apikey_cache
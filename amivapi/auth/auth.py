@@ -33,6 +33,8 @@
 2. implement `create_user_lookup_filter`, `has_item_write_permission` and/or
    'has_resource_write_permission' if you don't want default behaviour.
    (Default: Users can't write, no special lookups)
+   If `has_item_write_permission` needs the database, also implement
+   `has_item_write_permission_many` to check all items of a listing at once.
    Note: You shouldn't care about admin permissions. Those methods will only be
    called for non-admins!
 3. Use your auth class in your resource settings. Done!
@@ -71,11 +73,15 @@ Item endpoints:
   - `AmivTokenAuth.has_item_write_permission`
 """
 
+import atexit
 from datetime import datetime as dt
 from functools import wraps
+from threading import Lock, Timer
+from time import monotonic
 
 from eve.auth import BasicAuth, resource_auth
 from flask import abort, current_app, g, request
+from pymongo import UpdateOne
 
 
 class AmivTokenAuth(BasicAuth):
@@ -129,6 +135,27 @@ class AmivTokenAuth(BasicAuth):
         """
         return False
 
+    def has_item_write_permission_many(self, user_id, items):
+        """Check if the user is allowed to modify each of the items.
+
+        Used for resource listings. Implement this function for your resource
+        if `has_item_write_permission` needs to query the database, so that
+        the data of all items can be fetched at once.
+        Default behaviour: Call `has_item_write_permission` for every item.
+
+        Args:
+            user (str): The id of the user that wants to access the items
+            items (list): The items the user wants to change or delete.
+                The same warning about ObjectIds as for
+                `has_item_write_permission` applies.
+
+        Returns:
+            list: A bool for every item, True if the user has permission to
+                change the item, False if not.
+        """
+        return [self.has_item_write_permission(user_id, item)
+                for item in items]
+
     def create_user_lookup_filter(self, user_id):
         """Create a filter for item lookup in GET, PATCH and DELETE.
 
@@ -199,6 +226,125 @@ def only_amiv_token_auth(func):
     return wrapped
 
 
+# Coalesced timestamp updates
+
+
+class TouchBuffer(object):
+    """Collect `_updated` timestamps to write them in bulk later.
+
+    Only the latest timestamp per document is kept, and `$max` ensures that
+    a timestamp is never moved backwards by another process.
+
+    Requests flush the buffer once `TOUCH_FLUSH_INTERVAL` has passed. A
+    background timer flushes it as well, so timestamps are not lost if a
+    worker receives no further requests, and so does exiting the process.
+
+    Args:
+        app: The app to write the timestamps with
+    """
+
+    def __init__(self, app):
+        self._app = app
+        self._pending = {}
+        self._lock = Lock()
+        self._last_flush = monotonic()
+        self._timer = None
+        self._exit_registered = False
+
+    def add(self, collection, _id, time):
+        """Remember a new timestamp for a document."""
+        with self._lock:
+            self._pending[(collection, _id)] = time
+
+            if self._timer is None:
+                interval = self._app.config['TOUCH_FLUSH_INTERVAL']
+                self._timer = Timer(interval.total_seconds(),
+                                    self.flush_idle)
+                self._timer.daemon = True  # Don't keep the process alive
+                self._timer.start()
+            if not self._exit_registered:
+                atexit.register(self.flush_idle)
+                self._exit_registered = True
+
+    def is_due(self, interval):
+        """Check if there are pending timestamps older than `interval`."""
+        return bool(self._pending) and (
+            monotonic() - self._last_flush >= interval.total_seconds())
+
+    def flush(self, db):
+        """Write all pending timestamps, one `bulk_write` per collection."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = monotonic()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        operations = {}
+        for (collection, _id), time in pending.items():
+            operations.setdefault(collection, []).append(
+                UpdateOne({'_id': _id}, {'$max': {'_updated': time}}))
+
+        for collection, requests in operations.items():
+            db[collection].bulk_write(requests, ordered=False)
+
+    def flush_idle(self):
+        """Write pending timestamps outside of a request.
+
+        Used by the timer and at exit. Errors are logged, as nobody could
+        handle them.
+        """
+        if not self._pending:
+            return
+        with self._app.app_context():
+            try:
+                self.flush(self._app.data.driver.db)
+            except Exception as e:
+                self._app.logger.error("Writing buffered timestamps failed: "
+                                       "%s" % e)
+
+
+def touch(collection, document):
+    """Update the `_updated` timestamp of a document (and the document).
+
+    If `TOUCH_GRANULARITY` is set, the timestamp is only written if it is
+    older than the granularity. The write is buffered and flushed once
+    `TOUCH_FLUSH_INTERVAL` has passed, see `TouchBuffer`.
+    Otherwise the timestamp is updated immediately.
+
+    Args:
+        collection (str): The collection containing the document
+        document (dict): The document, must contain the `_id`
+    """
+    # Remove microseconds to match mongo precision
+    new_time = dt.utcnow().replace(microsecond=0)
+    granularity = current_app.config['TOUCH_GRANULARITY']
+
+    if granularity is None:
+        current_app.data.driver.db[collection].update_one(
+            {'_id': document['_id']}, {'$set': {'_updated': new_time}})
+    else:
+        # Mongo dates may be timezone aware, everything is utc anyways
+        old_time = document.get('_updated')
+        if (old_time is not None and
+                old_time.replace(tzinfo=None) > new_time - granularity):
+            return
+        current_app.touch_buffer.add(collection, document['_id'], new_time)
+
+    document['_updated'] = new_time
+
+
+def flush_touches(response):
+    """Write buffered timestamps if the flush interval has passed.
+
+    Registered with `after_request`, so the response is returned unchanged.
+    """
+    buffer = current_app.touch_buffer
+    if buffer.is_due(current_app.config['TOUCH_FLUSH_INTERVAL']):
+        buffer.flush(current_app.data.driver.db)
+    return response
+
+
 # Function to log in the user with a specific token
 
 
@@ -214,21 +360,23 @@ def authenticate_token(token):
     if token:
         g.current_token = token
 
-        # Get session
+        # Get session, use the cache of this process if possible. API keys
+        # are cached as `False`, i.e. without session
         sessions = current_app.data.driver.db['sessions']
-        session = sessions.find_one({'token': token})
+        session = current_app.session_cache.get(token)
+        if session is None:
+            session = sessions.find_one({'token': token})
+            if session:
+                # Only on a miss, so the entry expires even if the token is
+                # used all the time. Touching updates the cached session.
+                current_app.session_cache.set(token, session)
 
         if session:
-            # Update timestamp (remove microseconds to match mongo precision)
-            new_time = dt.utcnow().replace(microsecond=0)
-            sessions.update_one({'_id': session['_id']},
-                                {'$set': {
-                                    '_updated': new_time
-                                }})
-            session['_updated'] = new_time
+            touch('sessions', session)
 
             # Save user_id and session with updated timestamp in g
-            g.current_session = session
+            # (use a copy, the cached session must not be modified)
+            g.current_session = dict(session)
             g.current_user = str(session['user'])  # ObjectId to str
 
 
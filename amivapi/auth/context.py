@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Authorization context of the current user.
+
+Many auth classes need the same information about a user, e.g. the groups
+the user is a member of or the events the user moderates. The home endpoint
+and link methods ask for it repeatedly within a single request.
+
+`get_auth_context` returns an `AuthContext`, which is stored in
+`g.auth_context` and loads every piece of information with one query on
+first access:
+
+    from amivapi.auth.context import get_auth_context
+    context = get_auth_context(user_id)
+    if group_id in context.moderated_groups:
+        ...
+
+Hooks changing the underlying data should call `clear_auth_context`.
+"""
+
+from datetime import datetime
+from functools import wraps
+
+from bson import ObjectId
+from flask import current_app, g
+
+
+def lazy(func):
+    """Property that is only computed on first access."""
+    attribute = '_' + func.__name__
+
+    @property
+    @wraps(func)
+    def wrapped(self):
+        if not hasattr(self, attribute):
+            setattr(self, attribute, func(self))
+        return getattr(self, attribute)
+    return wrapped
+
+
+class AuthContext(object):
+    """Authorization data of a user, loaded on demand.
+
+    If the user is None (nobody logged in), everything is empty.
+
+    Args:
+        user_id (str): The id of the user
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def _find(self, resource, lookup, projection):
+        if self.user_id is None:
+            return []
+        return current_app.data.driver.db[resource].find(lookup, projection)
+
+    @lazy
+    def membership(self):
+        """str: The membership of the user, e.g. 'regular' or 'none'."""
+        if self.user_id is None:
+            return 'none'
+        user = current_app.data.driver.db['users'].find_one(
+            {'_id': ObjectId(self.user_id)}, {'membership': 1})
+        return user['membership'] if user else 'none'
+
+    @lazy
+    def is_member(self):
+        """bool: True if the user is a member of the organization."""
+        return self.membership != 'none'
+
+    @lazy
+    def _groups(self):
+        """Groups of the user with permissions, cached per user."""
+        if self.user_id is None:
+            return ([], {})
+
+        cache = current_app.group_permissions_cache
+        groups = cache.get(self.user_id)
+        if groups is None:
+            memberships = current_app.data.driver.db['groupmemberships']
+            result = memberships.aggregate([
+                {'$match': {'user': ObjectId(self.user_id)}},
+                {'$lookup': {'from': 'groups',
+                             'localField': 'group',
+                             'foreignField': '_id',
+                             'as': 'group'}},
+                {'$unwind': '$group'},
+                {'$project': {'group': '$group._id',
+                              'permissions': '$group.permissions'}},
+            ])
+
+            group_ids = []
+            permissions = {}
+            for item in result:
+                group_ids.append(item['group'])
+                for resource, permission in (
+                        item.get('permissions') or {}).items():
+                    permissions.setdefault(resource, set()).add(permission)
+
+            groups = (group_ids, permissions)
+            cache.set(self.user_id, groups)
+        return groups
+
+    @property
+    def member_groups(self):
+        """list: ids of the groups the user is a member of."""
+        return self._groups[0]
+
+    @property
+    def group_permissions(self):
+        """dict: set of permissions granted by groups per resource."""
+        return self._groups[1]
+
+    @lazy
+    def moderated_groups(self):
+        """set: ids of the groups the user moderates."""
+        return set(group['_id'] for group in self._find(
+            'groups', {'moderator': ObjectId(self.user_id)}, {'_id': 1}))
+
+    @lazy
+    def moderated_events(self):
+        """set: ids of the events the user moderates."""
+        return set(event['_id'] for event in self._find(
+            'events', {'moderator': ObjectId(self.user_id)}, {'_id': 1}))
+
+    @lazy
+    def is_blacklisted(self):
+        """bool: True if the user has an unresolved blacklist entry."""
+        if self.user_id is None:
+            return False
+        return current_app.data.driver.db['blacklist'].count_documents({
+            'user': ObjectId(self.user_id),
+            '$or': [{'end_time': None},
+                    {'end_time': {'$gte': datetime.utcnow()}}]
+        }, limit=1) > 0
+
+
+def get_auth_context(user_id=None):
+    """Get the authorization context of a user (default: current user)."""
+    if user_id is None:
+        user_id = g.get('current_user')
+
+    context = g.get('auth_context')
+    if context is None or context.user_id != user_id:
+        context = g.auth_context = AuthContext(user_id)
+    return context
+
+
+def clear_auth_context(*args):
+    """Hook to discard the authorization context after data changes."""
+    g.pop('auth_context', None)
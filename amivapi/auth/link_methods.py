@@ -15,17 +15,26 @@ from amivapi.auth import AmivTokenAuth, authenticate, check_if_admin
 from amivapi.utils import on_post_hook
 
 
-def _get_item_methods(resource, item):
-    res = current_app.config['DOMAIN'][resource]
+def _get_write_permissions(resource, items):
+    """Check write permissions for all items at once."""
+    if g.get('resource_admin'):
+        # Admins have access to all methods
+        return [True] * len(items)
+
     user = g.get('current_user')  # TODO: post_internal_problem
-    auth = resource_auth(resource)
-    is_admin = g.get('resource_admin')
+    return resource_auth(resource).has_item_write_permission_many(user, items)
+
+
+def _get_item_methods(resource, item, write_permission=None):
+    res = current_app.config['DOMAIN'][resource]
 
     # If the item is displayed, the read methods are obviously allowed
     methods = ['GET', 'HEAD', 'OPTIONS'] + res['public_item_methods']
 
     # Admins have access to all methods. For non admins check user permission.
-    if is_admin or auth.has_item_write_permission(user, item):
+    if write_permission is None:
+        write_permission = _get_write_permissions(resource, [item])[0]
+    if write_permission:
         methods += res['item_methods']
 
     # Remove duplicates before returning
@@ -60,12 +69,17 @@ def _home_link_methods():
     return ['GET', 'HEAD', 'OPTIONS']
 
 
-def add_methods_to_item_links(resource, item):
+def add_methods_to_item_links(resource, item, write_permission=None,
+                              resource_methods=None):
     """Add methods to all links of the item.
 
     Args:
         resource (str): The name of the resource
         item (dict): The item, must have a 'links' key.
+        write_permission (bool): Whether the user may modify the item, will
+            be checked if not provided.
+        resource_methods (list): Methods of the resource link, will be
+            computed if not provided.
     """
     if '_links' not in item:
         # Embedded objects don't have a _links field
@@ -74,7 +88,8 @@ def add_methods_to_item_links(resource, item):
     links = item['_links']
 
     # self
-    links['self']['methods'] = _get_item_methods(resource, item)
+    links['self']['methods'] = _get_item_methods(resource, item,
+                                                 write_permission)
 
     # parent, i.e. home -> only read methods (optional)
     if 'parent' in links:
@@ -82,7 +97,9 @@ def add_methods_to_item_links(resource, item):
 
     # collection -> resource (optional)
     if 'collection' in links:
-        links['collection']['methods'] = _get_resource_methods(resource)
+        if resource_methods is None:
+            resource_methods = _get_resource_methods(resource)
+        links['collection']['methods'] = resource_methods
 
 
 def add_methods_to_resource_links(resource, response):
@@ -119,11 +136,19 @@ def add_permitted_methods_after_fetch_item(resource, item):
 
 
 def add_permitted_methods_after_fetch_resource(resource, response):
-    """Add link methods with an on_fetched_resource hook."""
+    """Add link methods with an on_fetched_resource hook.
+
+    Write permissions are checked for all items at once, such that auth
+    classes can resolve e.g. parent items with a single query.
+    """
     if isinstance(resource_auth(resource), AmivTokenAuth):
         # Item links
-        for item in response['_items']:
-            add_methods_to_item_links(resource, item)
+        items = [item for item in response['_items'] if '_links' in item]
+        permissions = _get_write_permissions(resource, items)
+        resource_methods = _get_resource_methods(resource)
+        for item, permission in zip(items, permissions):
+            add_methods_to_item_links(resource, item, permission,
+                                      resource_methods)
 
         # Resource links
         add_methods_to_resource_links(resource, response)
@@ -4,18 +4,26 @@
 #          you to buy us beer if we meet and you like the software.
 """Sessions endpoint."""
 
+from contextlib import contextmanager
 import datetime
+from time import monotonic
 
 from bson import ObjectId
 from bson.errors import InvalidId
-from eve.methods.patch import patch_internal
+from eve.methods.common import resolve_document_etag
 from eve.utils import debug_error_message
-from flask import abort, current_app as app
+from flask import (
+    abort,
+    after_this_request,
+    current_app as app,
+    g,
+    has_request_context
+)
 
 from amivapi import ldap
 from amivapi.auth import AmivTokenAuth
 from amivapi.cron import periodic
-from amivapi.utils import admin_permissions, get_id
+from amivapi.utils import get_id
 
 # Change when we drop python3.5 support
 try:
@@ -175,14 +183,13 @@ def process_login(items):
         password = item['password']
 
         # LDAP
-        if (app.config.get('ldap_connector') and
-                ldap.authenticate_user(username, password)):
-            # Success, sync user and get token
-            updated = ldap.sync_one(username)
-            _prepare_token(item, updated['_id'])
-            app.logger.info(
-                "User '%s' was authenticated with LDAP" % username)
-            return
+        if app.config.get('ldap_connector'):
+            user_id = _ldap_login(username, password)
+            if user_id is not None:
+                _prepare_token(item, user_id)
+                app.logger.info(
+                    "User '%s' was authenticated with LDAP" % username)
+                return
 
         # Database, try to find via nethz, mail or objectid
         users = app.data.driver.db['users']
@@ -192,11 +199,14 @@ def process_login(items):
             lookup['$or'].append({'_id': objectid})
         except InvalidId:
             pass  # input can't be used as ObjectId
-        user = users.find_one(lookup)
+        with _timed('db'):
+            user = users.find_one(lookup)
 
         if user:
             app.logger.debug("User found in db.")
-            if verify_password(user, item['password']):
+            with _timed('password'):
+                is_valid = verify_password(user, item['password'])
+            if is_valid:
                 app.logger.debug("Login for user '%s' successful." % username)
                 _prepare_token(item, user['_id'])
                 return
@@ -211,6 +221,73 @@ def process_login(items):
         abort(401, description=debug_error_message(status))
 
 
+def _ldap_login(username, password):
+    """Authenticate a user with LDAP and synchronize the user.
+
+    Usernames with too many failed attempts are not sent to LDAP until the
+    failures expire, see `LDAP_MAX_FAILED_BINDS`. The synchronization is
+    skipped if the user has been synchronized recently, see
+    `LDAP_SYNC_CACHE_TTL`.
+
+    Returns:
+        ObjectId: id of the user, None if authentication failed
+    """
+    failures = app.ldap_failed_binds.get(username, 0)
+    max_failures = app.config.get('LDAP_MAX_FAILED_BINDS')
+    if max_failures and failures >= max_failures:
+        app.logger.info("LDAP login for '%s' skipped after %i failed "
+                        "attempts." % (username, failures))
+        return None
+
+    with _timed('ldap'):
+        authenticated = ldap.authenticate_user(username, password)
+    if not authenticated:
+        app.ldap_failed_binds.set(username, failures + 1)
+        return None
+    app.ldap_failed_binds.pop(username)
+
+    # Recently synchronized, only make sure the user still exists
+    user_id = app.ldap_sync_cache.get(username)
+    if user_id is not None:
+        with _timed('db'):
+            exists = app.data.driver.db['users'].count_documents(
+                {'_id': user_id, 'nethz': username}, limit=1)
+        if exists:
+            return user_id
+
+    with _timed('ldap_sync'):
+        updated = ldap.sync_one(username)
+    app.ldap_sync_cache.set(username, updated['_id'])
+    return updated['_id']
+
+
+@contextmanager
+def _timed(name):
+    """Add the duration of the block to the login timings of the request."""
+    start = monotonic()
+    try:
+        yield
+    finally:
+        timings = g.setdefault('login_timings', {})
+        timings[name] = timings.get(name, 0) + monotonic() - start
+
+
+def add_login_timings(response):
+    """Report the time spent in LDAP and database during login.
+
+    The timings are added as `Server-Timing` header (in milliseconds), which
+    can be inspected by clients and proxies, and logged.
+    """
+    timings = g.pop('login_timings', None)
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(
+            '%s;dur=%.1f' % (name, duration * 1000)
+            for name, duration in timings.items())
+        app.logger.info("Login timings: %s" % ', '.join(
+            '%s %.3fs' % item for item in timings.items()))
+    return response
+
+
 def _prepare_token(item, user_id):
     token = token_urlsafe()
 
@@ -229,6 +306,9 @@ def verify_password(user, plaintext):
     It is possible that the password is None, e.g. if the user is authenticated
     via LDAP. In this case default to "not verified".
 
+    Within a request, the rehash is deferred until the response has been sent,
+    so a higher hashing cost does not slow down the login.
+
     Args:
         user (dict): the user in question.
         plaintext (string): password to check
@@ -245,13 +325,62 @@ def verify_password(user, plaintext):
     is_valid = password_context.verify(plaintext, user['password'])
 
     if is_valid and password_context.needs_update(user['password']):
-        # update password - hook will handle hashing
-        update = {'password': plaintext}
-        with admin_permissions():
-            patch_internal("users", payload=update, _id=user['_id'])
+        args = (user['_id'], user['password'], plaintext)
+        if has_request_context():
+            _rehash_after_response(*args)
+        else:
+            rehash_password(*args)
     return is_valid
 
 
+def rehash_password(user_id, old_hash, plaintext):
+    """Replace the password hash of a user with a hash of the current cost.
+
+    The hash is only replaced if the user is unchanged since the hash was
+    computed, so a password changed in the meantime is not overwritten.
+    Like a PATCH, the rehash updates `_updated` and `_etag`.
+    """
+    new_hash = app.config['PASSWORD_CONTEXT'].encrypt(plaintext)
+    users = app.data.driver.db['users']
+    user = users.find_one({'_id': user_id, 'password': old_hash})
+    if user is None:
+        return
+
+    # Timestamps in the database have no microseconds, see Eve
+    changes = {'password': new_hash,
+               '_updated': datetime.datetime.utcnow().replace(microsecond=0)}
+    updated = dict(user, **changes)
+    resolve_document_etag(updated, 'users')
+    if updated.get('_etag'):
+        changes['_etag'] = updated['_etag']
+
+    users.update_one({'_id': user_id, 'password': old_hash,
+                      '_etag': user.get('_etag')},
+                     {'$set': changes})
+
+
+def _rehash_after_response(*args):
+    """Rehash the password once the response has been sent to the client.
+
+    The plaintext password must not be stored, so the rehash can't be
+    scheduled with `amivapi.cron`. Instead, it runs in the worker after the
+    response is closed, outside of the request.
+    """
+    flask_app = app._get_current_object()
+
+    def rehash():
+        with flask_app.app_context():
+            try:
+                rehash_password(*args)
+            except Exception as e:
+                flask_app.logger.error("Rehashing password failed: %s" % e)
+
+    @after_this_request
+    def register(response):
+        response.call_on_close(rehash)
+        return response
+
+
 # Regular task to clean up expired sessions
 @periodic(datetime.timedelta(days=1))
 def delete_expired_sessions():
@@ -265,4 +394,23 @@ def delete_expired_sessions():
     >>>     delete_expired_sessions()
     """
     deadline = datetime.datetime.utcnow() - app.config['SESSION_TIMEOUT']
-    app.data.driver.db['sessions'].remove({'_updated': {'$lt': deadline}})
+    lookup = {'_updated': {'$lt': deadline}}
+    collection = app.data.driver.db['sessions']
+
+    if app.session_cache.enabled:
+        for session in collection.find(lookup, {'token': 1}):
+            app.session_cache.pop(session['token'])
+
+    collection.remove(lookup)
+
+
+# Cache invalidation
+
+def invalidate_session_cache(session):
+    """Remove a deleted session from the session cache."""
+    app.session_cache.pop(session['token'])
+
+
+def clear_session_cache():
+    """Clear the session cache after all sessions have been deleted."""
+    app.session_cache.clear()
@@ -7,6 +7,7 @@
 Contains settings for eve resource, special validation.
 """
 
+from amivapi.auth.context import clear_auth_context
 from amivapi.blacklist.model import blacklist
 from amivapi.utils import register_domain
 
@@ -14,3 +15,8 @@ from amivapi.utils import register_domain
 def init_app(app):
     """Register resources and blueprints, add hooks and validation."""
     register_domain(app, blacklist)
+
+    # Blacklist status is part of the auth context of users
+    app.on_inserted_blacklist += clear_auth_context
+    app.on_updated_blacklist += clear_auth_context
+    app.on_deleted_item_blacklist += clear_auth_context
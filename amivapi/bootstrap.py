@@ -19,12 +19,14 @@ from amivapi import (
     beverages,
     cascade,
     cron,
+    cronstats,
     documentation,
     events,
     groups,
     blacklist,
     joboffers,
     ldap,
+    outbox,
     studydocs,
     users,
     utils
@@ -108,6 +110,8 @@ def create_app(config_file=None, **kwargs):
     studydocs.init_app(app)
     cascade.init_app(app)
     cron.init_app(app)
+    cronstats.init_app(app)
+    outbox.init_app(app)
     documentation.init_app(app)
 
     # Fix that eve doesn't run hooks on embedded documents
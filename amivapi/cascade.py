@@ -9,57 +9,315 @@ This adds an option 'cascade_delete' to data_relations in the schema. If it is
 set to true, then deleting the referenced object will also delete the
 referencing object. If false, the reference will be set to NULL, when the
 referenced object is deleted.
+
+The relations are collected once when the app is initialized, and only
+collected again if resources are added or removed later.
+
+Referencing objects are deleted or updated in bulk, i.e. with one query per
+relation, and nested cascades are processed breadth-first. Only the hooks of
+the referencing resources are called for each object, e.g. to update the
+waiting list of an event when a signup is deleted. References which are not
+nullable in the schema are left untouched.
+
+Deleting a whole collection can cascade to many objects. If `CASCADE_QUEUE`
+is enabled, these cascades are stored in the `cascade_queue` collection and
+processed in bulk by `amivapi cron` instead of within the request. Entries
+which still fail after `CASCADE_MAX_ATTEMPTS` are kept in the queue with
+their last error, but not retried anymore.
 """
 
-from eve.methods.delete import deleteitem_internal
+from collections import deque
+from datetime import datetime, timedelta
+
+from eve.methods.common import resolve_document_etag
 from eve.methods.patch import patch_internal
-from flask import current_app
+from flask import current_app, g
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
 from werkzeug.exceptions import NotFound
 
+from amivapi.cron import periodic, schedule_task
 from amivapi.utils import admin_permissions
 
 
+def build_relations(domain):
+    """Find all data relations in the domain.
+
+    Returns:
+        dict: For every referenced resource, a list of all referencing
+            `(resource, field, cascade_delete)` tuples.
+    """
+    relations = {}
+    for res, res_domain in domain.items():
+        for field, field_def in res_domain['schema'].items():
+            data_relation = field_def.get('data_relation')
+            if data_relation is not None:
+                relations.setdefault(data_relation.get('resource'), []).append(
+                    (res, field, data_relation.get('cascade_delete', False)))
+    return relations
+
+
+def get_relations(resource):
+    """Get all `(resource, field, cascade_delete)` referencing `resource`."""
+    domain = current_app.config['DOMAIN']
+    resources, relations = current_app.cascade_relations
+    if resources != domain.keys():
+        # Resources were added or removed since the relations were built
+        resources, relations = current_app.cascade_relations = \
+            (frozenset(domain), build_relations(domain))
+    return relations.get(resource, [])
+
+
 def cascade_delete(resource, item):
     """Cascade DELETE.
 
     Hook to delete all objects, which have the 'cascade_delete' option set
     in the data_relation and relate to the object, which was just deleted.
+    References of all other objects are set to None.
+    """
+    id_field = current_app.config['DOMAIN'][resource]['id_field']
+    cascade_delete_many(resource, [item[id_field]])
+
+
+def cascade_delete_many(resource, ids):
+    """Cascade the deletion of several objects of a resource at once."""
+    pending = deque([(resource, ids)])
+    while pending:
+        _cascade(*pending.popleft(),
+                 found=lambda res, ids: pending.append((res, ids)))
+
+
+def _cascade(resource, ids, found):
+    """Delete or update all objects directly referencing the deleted ones.
+
+    `found(resource, ids)` is called with the objects to be deleted before
+    they are deleted, to continue the cascade with them.
     """
     domain = current_app.config['DOMAIN']
-    deleted_id = item[domain[resource]['id_field']]
+    for res, field, cascade in get_relations(resource):
+        lookup = {field: {'$in': ids}}
+        if cascade:
+            _delete_many(res, lookup, found)
+        elif domain[res]['schema'][field].get('nullable'):
+            _remove_references(res, field, lookup)
 
-    for res, res_domain in domain.items():
-        # Filter schema of `res` to get all fields containing references
-        # to the resource of the deleted item
-        relations = ((field, field_def['data_relation'])
-                     for field, field_def in res_domain['schema'].items()
-                     if 'data_relation' in field_def and
-                     field_def['data_relation'].get('resource') == resource)
-        for field, data_relation in relations:
-            # All items in `res` with reference to the deleted item
-            lookup = {field: deleted_id}
-            with admin_permissions():
+
+def _hooks(name):
+    """Get the app event `name`, None if no hooks are registered for it."""
+    event = getattr(current_app, name)
+    return event if len(event) else None
+
+
+def _collection(resource):
+    """Get the database collection of a resource."""
+    source = current_app.config['DOMAIN'][resource]['datasource']['source']
+    return current_app.data.driver.db[source]
+
+
+def _delete_many(resource, lookup, found):
+    """Delete all objects matching the lookup with a single query.
+
+    Calls the item delete hooks of the resource and removes media files.
+    """
+    resource_def = current_app.config['DOMAIN'][resource]
+    id_field = resource_def['id_field']
+    media_fields = resource_def['_media']
+    before = _hooks('on_delete_item_' + resource)
+    after = _hooks('on_deleted_item_' + resource)
+
+    collection = _collection(resource)
+    full = before or after or media_fields
+    items = list(collection.find(lookup, None if full else {id_field: 1}))
+    if not items:
+        return
+
+    ids = [item[id_field] for item in items]
+    if get_relations(resource):
+        found(resource, ids)
+
+    if before:
+        for item in items:
+            before(item)
+
+    collection.delete_many({id_field: {'$in': ids}})
+
+    for item in items:
+        for field in media_fields:
+            if item.get(field):
+                current_app.media.delete(item[field], resource)
+        if after:
+            after(item)
+
+
+def _remove_references(resource, field, lookup):
+    """Set the reference `field` of all objects matching the lookup to None.
+
+    Resources with update hooks are patched one by one, as the hooks may
+    change the updates. All other objects get a new etag (if etags are
+    enabled) and are updated with a single query. Afterwards, only the
+    `on_updated_<resource>` hooks are called. The generic `on_update` and
+    `on_updated` hooks are skipped, like for deleted objects: they check
+    permissions of the request, which do not apply to a cascade.
+    """
+    if _hooks('on_update_' + resource):
+        with admin_permissions():
+            for item in _collection(resource).find(lookup, {'_id': 1}):
                 try:
-                    if data_relation.get('cascade_delete'):
-                        # Delete the item as well
-                        deleteitem_internal(res, concurrency_check=False,
-                                            **lookup)
-                    else:
-                        # Don't delete, only remove reference
-                        patch_internal(res, payload={field: None},
-                                       concurrency_check=False,
-                                       **lookup)
+                    patch_internal(resource, payload={field: None},
+                                   concurrency_check=False, _id=item['_id'])
                 except NotFound:
                     pass
+        return
 
+    resource_def = current_app.config['DOMAIN'][resource]
+    id_field = resource_def['id_field']
+    collection = _collection(resource)
+    originals = list(collection.find(lookup))
+    if not originals:
+        return
+
+    # Timestamps in the database have no microseconds, see Eve
+    now = datetime.utcnow().replace(microsecond=0)
+    updated = [dict(original, **{field: None, '_updated': now})
+               for original in originals]
+    resolve_document_etag(updated, resource)
+    changes = []
+    for item in updated:
+        item_changes = {field: None, '_updated': now}
+        if item.get('_etag'):
+            item_changes['_etag'] = item['_etag']
+        changes.append(item_changes)
+
+    collection.bulk_write([
+        UpdateOne({id_field: item[id_field]}, {'$set': item_changes})
+        for item, item_changes in zip(updated, changes)], ordered=False)
+
+    after = _hooks('on_updated_' + resource)
+    if after:
+        for original, item_changes in zip(originals, changes):
+            after(item_changes, original)
+
+
+def remember_deleted_collection(resource, originals, lookup):
+    """Remember which objects are deleted by a resource-level DELETE.
+
+    The cascade has to wait until the objects are actually deleted, see
+    `cascade_delete_collection`.
+    """
+    if get_relations(resource):
+        id_field = current_app.config['DOMAIN'][resource]['id_field']
+        g.setdefault('cascade_collections', {})[resource] = [
+            item[id_field] for item in originals]
+
+
+def cascade_delete_collection(resource):
+    """Hook to propagate the deletion of a whole collection.
+
+    If `CASCADE_QUEUE` is enabled, the cascade is left to the cron runner.
+    """
+    ids = g.get('cascade_collections', {}).pop(resource, None)
+    if ids:
+        if current_app.config.get('CASCADE_QUEUE'):
+            enqueue_cascade(resource, ids)
+        else:
+            cascade_delete_many(resource, ids)
+
+
+"""
+Cascade queue
+
+Every entry of the queue contains deleted objects of one resource. Processing
+an entry deletes or updates the objects referencing them, and adds deleted
+objects to the queue before deleting them. Thus, an entry can be processed
+again if the processing fails at any point, and no object is left behind.
+"""
 
-def cascade_delete_collection(resource, items):
-    """Hook to propagate the deletion of objects."""
-    for item in items:
-        cascade_delete(resource, item)
+
+def enqueue_cascade(resource, ids, schedule=True):
+    """Add deleted objects to the queue.
+
+    The objects are split into chunks of `CASCADE_QUEUE_CHUNK_SIZE`.
+    """
+    now = datetime.utcnow()
+    chunk_size = current_app.config['CASCADE_QUEUE_CHUNK_SIZE']
+    current_app.data.driver.db['cascade_queue'].insert_many([{
+        'resource': resource,
+        'ids': ids[start:start + chunk_size],
+        'attempts': 0,
+        'next_attempt': now,
+    } for start in range(0, len(ids), chunk_size)])
+
+    if schedule:
+        # Run the queue soon instead of waiting for the next period
+        schedule_task(now, run_cascade_queue)
+
+
+@periodic(timedelta(hours=1))
+def run_cascade_queue():
+    """Process the cascade queue with the cron runner."""
+    process_cascade_queue()
+
+
+def process_cascade_queue():
+    """Process all due entries of the cascade queue.
+
+    Entries are claimed for `CASCADE_QUEUE_LEASE`, failed entries are retried
+    once the lease is over. After `CASCADE_MAX_ATTEMPTS`, failed entries are
+    parked: They stay in the queue with the error, but are not retried.
+
+    Returns:
+        int: Number of processed entries
+    """
+    queue = current_app.data.driver.db['cascade_queue']
+    lease = current_app.config['CASCADE_QUEUE_LEASE']
+    max_attempts = current_app.config['CASCADE_MAX_ATTEMPTS']
+    processed = 0
+
+    def found(resource, ids):
+        enqueue_cascade(resource, ids, schedule=False)
+
+    while True:
+        now = datetime.utcnow()
+        entry = queue.find_one_and_update(
+            {'next_attempt': {'$lte': now}},
+            {'$set': {'next_attempt': now + lease},
+             '$inc': {'attempts': 1}},
+            sort=[('next_attempt', ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+        if entry is None:
+            return processed
+
+        try:
+            # patch_internal requires a request context
+            with current_app.test_request_context():
+                _cascade(entry['resource'], entry['ids'], found)
+        except Exception as e:
+            if entry['attempts'] >= max_attempts:
+                current_app.logger.error(
+                    "Cascading delete of %i %s failed after %i attempts, "
+                    "giving up: %s" % (len(entry['ids']), entry['resource'],
+                                       entry['attempts'], e))
+                queue.update_one({'_id': entry['_id']},
+                                 {'$set': {'error': str(e)},
+                                  '$unset': {'next_attempt': ''}})
+            else:
+                current_app.logger.error(
+                    "Cascading delete of %i %s failed (attempt %i), retrying "
+                    "after %s: %s" % (len(entry['ids']), entry['resource'],
+                                      entry['attempts'], lease, e))
+            continue
+
+        queue.delete_one({'_id': entry['_id']})
+        processed += 1
 
 
 def init_app(app):
-    """Add hooks to app."""
+    """Collect relations and add hooks to app."""
+    domain = app.config['DOMAIN']
+    app.cascade_relations = (frozenset(domain), build_relations(domain))
+
     app.on_deleted_item += cascade_delete
-    app.on_deleted += cascade_delete_collection
+    app.on_delete_resource_originals += remember_deleted_collection
+    app.on_deleted_resource += cascade_delete_collection
+
+    with app.app_context():
+        app.data.driver.db['cascade_queue'].create_index('next_attempt')
@@ -9,12 +9,24 @@ from os.path import join, isdir
 from datetime import datetime as dt
 from time import sleep
 
-from click import argument, echo, group, option, Path, Choice, ClickException
+from click import (
+    argument,
+    echo,
+    group,
+    option,
+    pass_context,
+    Path,
+    Choice,
+    ClickException
+)
 
 from amivapi.bootstrap import create_app
-from amivapi.cron import run_scheduled_tasks
+from amivapi.cron import get_stats, migrate_tasks, run_scheduled_tasks
+from amivapi.events.counters import rebuild_counters
+from amivapi.outbox import SMTPSession, send_queued_mails
 from amivapi import ldap
-from amivapi.groups.mailing_lists import updated_group
+from amivapi.groups.mailing_lists import make_files_for_groups
+from amivapi.users.security import calibrate_rounds, measure_hashing
 
 try:
     import bjoern
@@ -37,31 +49,49 @@ config_option = option("--config",
 def recreate_mailing_lists(config):
     """(Re-)create mailing lists for all groups.
 
-    1. Delete all mailing list files.
+    1. Delete all local mailing list files.
 
-    2. Create new mailing list files.
+    2. Create new mailing list files, locally and remotely.
 
-    For every group, we call the update_group function for this
+    Files are written even if their content has not changed. All remote files
+    are uploaded with a single ssh connection.
     """
     app = create_app(config_file=config)
     directory = app.config.get('MAILING_LIST_DIR')
     prefix = app.config['MAILING_LIST_FILE_PREFIX']
 
-    if not directory:
-        echo('No directory for mailing lists specified in config.')
+    if not (directory or app.config.get('REMOTE_MAILING_LIST_ADDRESS')):
+        echo('No directory or remote address for mailing lists specified '
+             'in config.')
         return
 
     # Delete existing files
-    if isdir(directory):
+    if directory and isdir(directory):
         for filename in listdir(directory):
             if filename.startswith(prefix):
                 remove(join(directory, filename))
 
     # Create new files
     with app.app_context():
-        groups = app.data.driver.db['groups'].find({})
-        for g in groups:
-            updated_group(g, g)  # Use group as update and original
+        groups = app.data.driver.db['groups'].find({}, {'_id': 1})
+        make_files_for_groups([item['_id'] for item in groups], force=True)
+
+
+@cli.command()
+@config_option
+def signup_counters(config):
+    """Rebuild the signup counters of all events.
+
+    Required after enabling `EVENT_SIGNUP_COUNTERS`.
+    """
+    app = create_app(config_file=config)
+    if not app.config['EVENT_SIGNUP_COUNTERS']:
+        echo('Signup counters are not enabled (EVENT_SIGNUP_COUNTERS).')
+        return
+
+    with app.app_context():
+        fixed = rebuild_counters()
+    echo('Updated signup counters of %i events.' % fixed)
 
 
 def run_cron(app):
@@ -71,15 +101,20 @@ def run_cron(app):
         run_scheduled_tasks()
 
 
-@cli.command()
+@cli.group(invoke_without_command=True)
 @config_option
 @option("--continuous", is_flag=True,
         help="If set, continue running in a loop.")
-def cron(config, continuous):
+@pass_context
+def cron(ctx, config, continuous):
     """Run scheduled tasks.
 
     Use --continuous to keep running and execute tasks periodically.
+    Use `cron stats` to show statistics instead.
     """
+    if ctx.invoked_subcommand is not None:
+        return
+
     app = create_app(config_file=config)
 
     if not continuous:
@@ -100,7 +135,103 @@ def cron(config, continuous):
             if execution_time > interval:
                 echo('Warning: Execution time exceeds interval length.')
 
-            sleep((interval - execution_time).total_seconds())
+            sleep(max((interval - execution_time).total_seconds(), 0))
+
+
+@cron.command()
+@config_option
+def stats(config):
+    """Show statistics of scheduled tasks.
+
+    For every function: number of runs and failures, average and maximum
+    duration, number of due tasks (backlog) and seconds since the oldest
+    of them is due (lag).
+    """
+    app = create_app(config_file=config)
+    with app.app_context():
+        items = get_stats()
+
+    if not items:
+        echo('No statistics yet.')
+        return
+
+    row = '{:<60} {:>6} {:>6} {:>9} {:>9} {:>7} {:>9}'
+    echo(row.format('Function', 'Runs', 'Fails', 'Avg [s]', 'Max [s]',
+                    'Backlog', 'Lag [s]'))
+    for item in items:
+        average = item['total_duration'] / item['runs'] if item['runs'] else 0
+        echo(row.format(item['function'], item['runs'], item['failures'],
+                        '%.3f' % average,
+                        '%.3f' % item.get('max_duration', 0),
+                        item['backlog'], '%.0f' % item['lag']))
+
+
+@cron.command()
+@config_option
+def migrate(config):
+    """Migrate tasks scheduled by older versions.
+
+    Enable CRON_PICKLE_ARGS in the config to migrate tasks with pickled
+    arguments.
+    """
+    app = create_app(config_file=config)
+    with app.app_context():
+        migrated = migrate_tasks()
+    echo('Migrated %i scheduled tasks.' % migrated)
+
+
+@cli.command()
+@config_option
+@option("--continuous", is_flag=True,
+        help="If set, continue running in a loop.")
+def send_mails(config, continuous):
+    """Send queued mails.
+
+    Mails are only queued if `MAIL_QUEUE` is enabled.
+    Use --continuous to keep running and send new mails as they arrive.
+    """
+    app = create_app(config_file=config)
+    if not app.config['MAIL_QUEUE']:
+        echo('Warning: The mail queue is not enabled (MAIL_QUEUE).')
+
+    interval = app.config['MAIL_QUEUE_INTERVAL']
+    if continuous:
+        echo('Sending queued mails (checking every %i seconds).'
+             % interval.total_seconds())
+
+    with app.app_context(), SMTPSession() as session:
+        while True:
+            sent = send_queued_mails(session)
+            if sent or not continuous:
+                echo('Sent %i mails.' % sent)
+
+            if not continuous:
+                break
+            sleep(interval.total_seconds())
+
+
+@cli.command()
+@config_option
+@option("--target", type=float, default=0.1, show_default=True,
+        help="Time in seconds to hash a password.")
+def calibrate_password(config, target):
+    """Find the password hashing cost for this machine.
+
+    Prints the number of rounds for which hashing a password takes the target
+    time, to be used in the `PASSWORD_CONTEXT` setting. Existing passwords
+    are rehashed with the new cost after the next login, if their rounds are
+    below `min_rounds`.
+    """
+    app = create_app(config_file=config)
+    with app.app_context():
+        scheme = app.config['PASSWORD_CONTEXT'].handler().name
+        current = measure_hashing()
+        rounds = calibrate_rounds(target)
+
+    echo("Hashing a password currently takes %.3f seconds." % current)
+    echo("For %.3f seconds, use:\n" % target)
+    echo("    %s__default_rounds=%i," % (scheme, rounds))
+    echo("    %s__min_rounds=%i," % (scheme, int(rounds * 0.8)))
 
 
 @cli.command()
@@ -122,8 +253,12 @@ def ldap_sync(config, sync_all, nethz):
     else:
         with app.test_request_context():
             if sync_all:
-                res = ldap.sync_all()
-                echo("Synchronized %i users." % len(res))
+                res = {'created': 0, 'updated': 0, 'unchanged': 0}
+                for res in ldap.sync_all_chunked():
+                    echo("Processed %i users..." % sum(res.values()))
+                echo("Synchronized %i users: %i created, %i updated, "
+                     "%i unchanged." % (sum(res.values()), res['created'],
+                                        res['updated'], res['unchanged']))
             else:
                 for user in nethz:
                     if ldap.sync_one(user) is not None:
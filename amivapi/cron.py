@@ -20,7 +20,13 @@ Now you can schedule the task to be executed at a specific time:
 schedule_task(datetime(2012, 12, 21, 12, 0, 0), end_of_world,
               "Maya's calendar ran out of paper or something")
 
-This is of course possible multiple times.
+This is of course possible multiple times. However, a function is pending
+at most once with the same arguments.
+
+Arguments are stored as BSON, so only primitives, ObjectIds, datetimes and
+lists or dicts of those are supported natively. Other arguments are pickled
+if `CRON_PICKLE_ARGS` is enabled. Tasks scheduled by older versions can be
+converted with `amivapi cron migrate`.
 
 
 2. Periodic tasks
@@ -46,11 +52,20 @@ run every day at the same time, but will drift into the future slowly. This
 might sum up to a missing period, so after a year the function might have been
 called only 364 times.
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from functools import wraps
+from hashlib import sha1
+from os import getpid
 import pickle
+from socket import gethostname
+from time import monotonic
+from uuid import uuid4
 
+from bson import BSON, ObjectId
 from flask import current_app
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 
 #
@@ -97,45 +112,43 @@ def periodic(period, *args):
 
 
 def schedule_task(time, func, *args):
-    """ Schedule a task at some point in the future. """
-    func_s = func_str(func)
+    """ Schedule a task at some point in the future.
 
-    if func_s not in schedulable_functions:
-        raise NotSchedulable("%s is not schedulable. Did you forget the "
-                             "@schedulable decorator?" % func.__name__)
-
-    current_app.data.driver.db['scheduled_tasks'].insert_one({
-        'time': time,
-        'function': func_s,
-        'args': pickle.dumps(args)
-    })
+    A function is pending at most once with the same arguments. If it is
+    already pending, it will be run at the earlier of both times.
+    """
+    task = _new_task(time, func, args)
+    tasks = current_app.data.driver.db['scheduled_tasks']
+    try:
+        tasks.insert_one(task)
+    except DuplicateKeyError:
+        tasks.update_one({'dedupe_key': task['dedupe_key'], 'pending': True},
+                         {'$min': {'time': time}})
 
 
 def update_scheduled_task(time, func, *args):
     """ Update a scheduled task that was previously registered. """
-    func_s = func_str(func)
-
-    if func_s not in schedulable_functions:
-        raise NotSchedulable("%s is not schedulable. Did you forget the "
-                             "@schedulable decorator?" % func.__name__)
-
-    current_app.data.driver.db['scheduled_tasks'].update_one({
-        'function': func_s
-    },
-        {'$set': {
-                 'time': time,
-                 'args': pickle.dumps(args)
-        }})
+    task = _new_task(time, func, args)
+    tasks = current_app.data.driver.db['scheduled_tasks']
+    try:
+        tasks.update_one({'function': task['function'], 'pending': True},
+                         {'$set': task})
+    except DuplicateKeyError:
+        # Already pending with the new arguments, keep only one task
+        tasks.delete_one({'function': task['function'], 'pending': True,
+                          'dedupe_key': {'$ne': task['dedupe_key']}})
+        schedule_task(time, func, *args)
 
 
 def schedule_once_soon(func, *args):
     """ Schedules a function to be run as soon as the scheduler is run the next
     time. Also check, that it is not already scheduled to be run first.
     """
-    if current_app.data.driver.db['scheduled_tasks'].count_documents(
-            {'function': func_str(func)}) != 0:
-        return
-    schedule_task(datetime.utcnow(), func, *args)
+    try:
+        current_app.data.driver.db['scheduled_tasks'].insert_one(
+            _new_task(datetime.utcnow(), func, args))
+    except DuplicateKeyError:
+        pass
 
 
 #
@@ -151,25 +164,288 @@ def func_str(func):
     return "%s.%s" % (func.__module__, func.__name__)
 
 
+def _is_native(value):
+    """Check if a value can be stored in BSON without conversion."""
+    if value is None or isinstance(value, (bool, float, str, ObjectId,
+                                           datetime)):
+        return True
+    if isinstance(value, int):
+        return -2 ** 63 <= value < 2 ** 63
+    if isinstance(value, list):
+        return all(_is_native(item) for item in value)
+    if isinstance(value, dict):
+        return all(isinstance(key, str) and '.' not in key and
+                   not key.startswith('$') and _is_native(item)
+                   for key, item in value.items())
+    return False
+
+
+def encode_args(args):
+    """Encode task arguments for the database.
+
+    Arguments consisting of primitives, ObjectIds, datetimes and lists or
+    dicts of those are stored as BSON. Note that datetimes are only stored
+    with millisecond precision. Other arguments (e.g. tuples) are pickled if
+    `CRON_PICKLE_ARGS` is enabled.
+    """
+    args = list(args)
+    if _is_native(args):
+        return args
+    if not current_app.config['CRON_PICKLE_ARGS']:
+        raise NotSchedulable("Arguments can not be stored without pickle: "
+                             "%r" % (args,))
+    return pickle.dumps(tuple(args))
+
+
+def decode_args(stored):
+    """Decode task arguments from the database, see `encode_args`."""
+    if isinstance(stored, bytes):
+        if not current_app.config['CRON_PICKLE_ARGS']:
+            raise NotSchedulable("Pickled arguments are not allowed.")
+        return pickle.loads(stored)
+    return tuple(stored)
+
+
+def _dedupe_key(func_s, stored_args):
+    """Hash of function and arguments to find identical tasks."""
+    return sha1(BSON.encode({'function': func_s,
+                             'args': stored_args})).hexdigest()
+
+
+def _new_task(time, func, args):
+    """Create the database document of a task."""
+    func_s = func_str(func)
+
+    if func_s not in schedulable_functions:
+        raise NotSchedulable("%s is not schedulable. Did you forget the "
+                             "@schedulable decorator?" % func.__name__)
+
+    stored_args = encode_args(args)
+    return {
+        'time': time,
+        'function': func_s,
+        'args': stored_args,
+        'dedupe_key': _dedupe_key(func_s, stored_args),
+        'pending': True,
+    }
+
+
 def run_scheduled_tasks():
     """ Check for scheduled task, which have passed the deadline and run them.
     This needs an app context.
+
+    Tasks are claimed with a lease (`CRON_LEASE`) and only removed after they
+    have been run, so several cron processes can run at the same time and
+    the tasks of a crashed process are run again once the lease has expired.
+    With `CRON_WORKERS` > 1, due tasks are run in parallel threads.
+
+    Failed one time tasks are retried after `CRON_RETRY_DELAY`, which doubles
+    with every attempt, until `CRON_MAX_ATTEMPTS` is reached. Failed periodic
+    tasks are not retried, as they have already scheduled their next run.
     """
-    while True:
-        task = (current_app.data.driver.db['scheduled_tasks']
-                .find_one_and_delete(
-                    {'time': {'$lte': datetime.utcnow()}}))
+    workers = current_app.config['CRON_WORKERS']
+    run_id = "%s:%i:%s" % (gethostname(), getpid(), uuid4().hex[:8])
+
+    if workers <= 1:
+        _run_worker(run_id)
+        return
+
+    app = current_app._get_current_object()
+
+    def worker(index):
+        with app.app_context():
+            _run_worker("%s:%i" % (run_id, index))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Wait for all workers and propagate unexpected errors
+        list(executor.map(worker, range(workers)))
+
+
+def _claim_task(worker_id):
+    """Claim the next due task, which is not claimed by another worker."""
+    now = datetime.utcnow()
+    return current_app.data.driver.db['scheduled_tasks'].find_one_and_update(
+        {'time': {'$lte': now},
+         'lease_until': {'$not': {'$gt': now}}},  # unclaimed or expired
+        {'$set': {'claimed_by': worker_id,
+                  'lease_until': now + current_app.config['CRON_LEASE']},
+         '$unset': {'pending': ''},
+         '$inc': {'attempts': 1}},
+        sort=[('time', ASCENDING)],
+        return_document=ReturnDocument.AFTER)
 
+
+def _run_worker(worker_id):
+    """Claim and run due tasks until there are none left."""
+    tasks = current_app.data.driver.db['scheduled_tasks']
+
+    while True:
+        task = _claim_task(worker_id)
         if task is None:
             return
 
-        args = pickle.loads(task['args'])
-        func = schedulable_functions[task['function']]
-        func(*args)
+        started = datetime.utcnow()
+        checkpoint = monotonic()
+        try:
+            args = decode_args(task['args'])
+            func = schedulable_functions[task['function']]
+            func(*args)
+        except Exception:
+            _record_run(task, started, monotonic() - checkpoint, failed=True)
+            current_app.logger.exception(
+                "Scheduled task %s failed (attempt %i)."
+                % (task['function'], task['attempts']))
+
+            periodic = task['function'] in map(func_str, periodic_functions)
+            if (not periodic and
+                    task['attempts'] < current_app.config['CRON_MAX_ATTEMPTS']):
+                delay = (current_app.config['CRON_RETRY_DELAY'] *
+                         2 ** (task['attempts'] - 1))
+                try:
+                    tasks.update_one(
+                        {'_id': task['_id'], 'claimed_by': worker_id},
+                        {'$set': {'time': datetime.utcnow() + delay,
+                                  'pending': True},
+                         '$unset': {'claimed_by': '', 'lease_until': ''}})
+                    continue
+                except DuplicateKeyError:
+                    # The same task has been scheduled again in the meantime
+                    pass
+        else:
+            _record_run(task, started, monotonic() - checkpoint, failed=False)
+
+        tasks.delete_one({'_id': task['_id'], 'claimed_by': worker_id})
+
+
+#
+# Statistics
+#
+
+# Upper bounds (in seconds) of the buckets of the duration histogram
+DURATION_BUCKETS = [(0.01, '10ms'), (0.1, '100ms'), (1, '1s'), (10, '10s'),
+                    (60, '1min'), (600, '10min')]
+
+
+def _duration_bucket(duration):
+    for bound, name in DURATION_BUCKETS:
+        if duration <= bound:
+            return name
+    return 'longer'
+
+
+def _record_run(task, started, duration, failed):
+    """Add a task execution to the statistics of its function.
+
+    Args:
+        task (dict): The task from the database
+        started (datetime): Time the execution started
+        duration (float): Execution time in seconds
+        failed (bool): True if the task raised an exception
+    """
+    lag = (started - task['time']).total_seconds()
+    now = datetime.utcnow()
+    update = {
+        '$inc': {'runs': 1,
+                 'failures': int(failed),
+                 'total_duration': duration,
+                 'histogram.' + _duration_bucket(duration): 1},
+        '$max': {'max_duration': duration, 'max_lag': lag},
+        '$set': {'last_run': started,
+                 'last_duration': duration,
+                 'last_lag': lag,
+                 'last_failed': failed,
+                 '_updated': now},
+        '$setOnInsert': {'_created': now},
+    }
+    stats = current_app.data.driver.db['cronstats']
+    try:
+        stats.update_one({'function': task['function']}, update, upsert=True)
+    except DuplicateKeyError:
+        # Another worker has inserted the statistics at the same time
+        stats.update_one({'function': task['function']}, update)
+
+
+def get_backlog():
+    """Get the tasks which are due, but have not been run yet.
+
+    Returns:
+        dict: For every function, the number of due tasks (`backlog`) and the
+            seconds since the oldest of them is due (`lag`).
+    """
+    now = datetime.utcnow()
+    result = current_app.data.driver.db['scheduled_tasks'].aggregate([
+        {'$match': {'time': {'$lte': now}}},
+        {'$group': {'_id': '$function',
+                    'backlog': {'$sum': 1},
+                    'oldest': {'$min': '$time'}}},
+    ])
+    return {item['_id']: {'backlog': item['backlog'],
+                          'lag': (now - item['oldest']).total_seconds()}
+            for item in result}
+
+
+def get_stats():
+    """Get statistics and backlog of all functions.
+
+    Returns:
+        list: A dict for every function, sorted by name.
+    """
+    backlog = get_backlog()
+    stats = {item['function']: item for item in
+             current_app.data.driver.db['cronstats'].find({}, {'_id': 0})}
+
+    result = []
+    for function in sorted(set(stats) | set(backlog)):
+        item = stats.get(function, {'function': function, 'runs': 0,
+                                    'failures': 0, 'total_duration': 0})
+        item.update(backlog.get(function, {'backlog': 0, 'lag': 0}))
+        result.append(item)
+    return result
+
+
+def migrate_tasks():
+    """Add dedupe keys to tasks scheduled by older versions.
+
+    Pickled arguments are stored as BSON if possible. Loading them requires
+    `CRON_PICKLE_ARGS`.
+
+    Returns:
+        int: Number of migrated tasks
+    """
+    tasks = current_app.data.driver.db['scheduled_tasks']
+    migrated = 0
+    for task in tasks.find({'dedupe_key': {'$exists': False},
+                            'claimed_by': {'$exists': False}}):
+        try:
+            stored_args = encode_args(decode_args(task['args']))
+        except NotSchedulable as e:
+            current_app.logger.error("Can't migrate scheduled task %s: %s"
+                                     % (task['function'], e))
+            continue
+
+        try:
+            tasks.update_one({'_id': task['_id']}, {'$set': {
+                'args': stored_args,
+                'dedupe_key': _dedupe_key(task['function'], stored_args),
+                'pending': True,
+            }})
+        except DuplicateKeyError:
+            # The same task is already pending
+            tasks.delete_one({'_id': task['_id']})
+        migrated += 1
+    return migrated
 
 
 def init_app(app):
     # Periodic functions: If no execution is scheduled so far, schedule one
     with app.app_context():  # this is needed to run db queries
+        tasks = app.data.driver.db['scheduled_tasks']
+        tasks.create_index('time')
+        # Every function is pending at most once with the same arguments
+        tasks.create_index('dedupe_key', unique=True,
+                           partialFilterExpression={'pending': True})
+        app.data.driver.db['cronstats'].create_index('function',
+                                                     unique=True)
+
         for func in periodic_functions:
             schedule_once_soon(func)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Statistics of scheduled tasks.
+
+The statistics are collected by `amivapi.cron` and can be viewed with
+`amivapi cron stats` or by admins with the `cronstats` resource.
+"""
+
+from amivapi.auth.auth import AdminOnlyAuth
+from amivapi.cron import get_backlog
+from amivapi.utils import register_domain
+
+
+description = ("""
+Statistics of the tasks which are executed by `amivapi cron`, e.g. the daily
+removal of expired sessions, with one entry per function.
+
+`backlog` is the number of tasks of the function which are due, but have not
+been run yet, and `lag` the time in seconds since the oldest of them is due.
+If these numbers grow, the cron jobs can't keep up.
+
+Only admins have access to the statistics.
+""")
+
+
+def _stat(desc, field_type='number'):
+    return {'description': desc, 'readonly': True, 'type': field_type}
+
+
+cronstatsdomain = {
+    'cronstats': {
+        'description': description,
+
+        'resource_methods': ['GET'],
+        'item_methods': ['GET'],
+
+        'authentication': AdminOnlyAuth,
+
+        'schema': {
+            'function': _stat('Name of the scheduled function.', 'string'),
+            'runs': _stat('Number of executions.', 'integer'),
+            'failures': _stat('Number of failed executions.', 'integer'),
+            'total_duration': _stat('Total execution time in seconds.'),
+            'max_duration': _stat('Longest execution time in seconds.'),
+            'histogram': _stat('Number of executions by duration, e.g. '
+                               '`{"1s": 5, "10s": 2}` means that five '
+                               'executions took between 0.1 and 1 seconds '
+                               'and two between 1 and 10 seconds.', 'dict'),
+            'last_run': _stat('Start of the last execution.', 'datetime'),
+            'last_duration': _stat('Duration of the last execution.'),
+            'last_failed': _stat('Whether the last execution failed.',
+                                 'boolean'),
+            'last_lag': _stat('Seconds the last execution started after it '
+                              'was due.'),
+            'max_lag': _stat('Longest time in seconds an execution started '
+                             'after it was due.'),
+            'backlog': _stat('Number of due tasks, which have not been run.',
+                             'integer'),
+            'lag': _stat('Seconds since the oldest due task is due.'),
+        },
+    }
+}
+
+
+def add_backlog(item, backlog=None):
+    """Add current backlog and lag to the statistics of a function."""
+    if backlog is None:
+        backlog = get_backlog()
+    item.update(backlog.get(item.get('function'), {'backlog': 0, 'lag': 0}))
+
+
+def add_backlog_to_collection(response):
+    """Add backlog and lag to all functions with one query."""
+    backlog = get_backlog()
+    for item in response['_items']:
+        add_backlog(item, backlog)
+
+
+def init_app(app):
+    """Register resource and hooks."""
+    register_domain(app, cronstatsdomain)
+
+    app.on_fetched_item_cronstats += add_backlog
+    app.on_fetched_resource_cronstats += add_backlog_to_collection
@@ -9,7 +9,15 @@ logic needed for signup of non members to events.
 """
 
 
+from amivapi.auth.context import clear_auth_context
 from amivapi.events.authorization import EventAuthValidator
+from amivapi.events.counters import (
+    decrement_counters_after_delete,
+    increment_counters_after_insert,
+    init_counters_before_insert,
+    rebuild_counters_after_delete,
+    update_counters_after_update,
+)
 from amivapi.events.emails import (
     add_confirmed_before_insert,
     email_blueprint,
@@ -26,7 +34,11 @@ from amivapi.events.projections import (
 )
 from amivapi.events.queue import (
     add_accepted_before_insert,
+    add_sequence_before_insert,
+    remove_sequence_after_delete,
+    remove_sequences_after_delete,
     update_waiting_list_after_delete,
+    update_waiting_list_after_event_update,
     update_waiting_list_after_insert,
 )
 from amivapi.events.validation import EventValidator
@@ -59,11 +71,30 @@ def init_app(app):
     # Sending confirmation mails
     app.on_inserted_eventsignups += send_confirmmail_to_unregistered_users
 
+    # Number signups to keep their order
+    app.on_insert_eventsignups += add_sequence_before_insert
+    app.on_deleted_item_events += remove_sequence_after_delete
+    app.on_deleted_resource_events += remove_sequences_after_delete
+
     # Auto accept registrations for fcfs system
     app.on_insert_eventsignups += add_accepted_before_insert
 
+    # Maintain signup counters of events (if enabled). Must run before the
+    # waiting list is updated, which changes the counters as well.
+    app.on_insert_events += init_counters_before_insert
+    app.on_inserted_eventsignups += increment_counters_after_insert
+    app.on_updated_eventsignups += update_counters_after_update
+    app.on_deleted_item_eventsignups += decrement_counters_after_delete
+    app.on_deleted_resource_eventsignups += rebuild_counters_after_delete
+
     # Update waiting list after insert or delete of signups
     app.on_inserted_eventsignups += update_waiting_list_after_insert
     app.on_deleted_item_eventsignups += update_waiting_list_after_delete
+    app.on_updated_events += update_waiting_list_after_event_update
+
+    # Moderators are part of the auth context of users
+    app.on_inserted_events += clear_auth_context
+    app.on_updated_events += clear_auth_context
+    app.on_deleted_item_events += clear_auth_context
 
     app.register_blueprint(email_blueprint)
@@ -4,11 +4,10 @@
 #          you to buy us beer if we meet and you like the software.
 """Authorization for events and eventsignups resources"""
 
-from bson import ObjectId
-
 from flask import g, current_app
 from datetime import datetime as dt
 from amivapi.auth import AmivTokenAuth
+from amivapi.auth.context import get_auth_context
 from amivapi.utils import get_id
 
 
@@ -27,10 +26,7 @@ class EventSignupAuth(AmivTokenAuth):
         """Users can see own signups and signups for moderated events.
         """
         # Find events the user moderates
-        event_collection = current_app.data.driver.db['events']
-        events = event_collection.find({'moderator': ObjectId(user_id)},
-                                       {'_id': 1})
-        moderated_events = [event['_id'] for event in events]
+        moderated_events = list(get_auth_context(user_id).moderated_events)
 
         return {'$or': [
             {'user': user_id},
@@ -48,6 +44,33 @@ class EventSignupAuth(AmivTokenAuth):
             lookup = {current_app.config['ID_FIELD']: item['event']}
             event = current_app.data.find_one('events', None, **lookup)
 
+        return self._can_modify(user_id, item, event)
+
+    def has_item_write_permission_many(self, user_id, items):
+        """Fetch the events of all signups which are not embedded at once."""
+        event_ids = set(item['event'] for item in items
+                        if not isinstance(item['event'], dict))
+        events = {}
+        if event_ids:
+            cursor = current_app.data.driver.db['events'].find(
+                {'_id': {'$in': list(event_ids)}},
+                {'time_register_start': 1, 'time_register_end': 1})
+            events = {event['_id']: event for event in cursor}
+
+        permissions = []
+        for item in items:
+            event = item['event']
+            if not isinstance(event, dict):
+                event = events.get(event)
+            permissions.append(self._can_modify(user_id, item, event))
+        return permissions
+
+    @staticmethod
+    def _can_modify(user_id, item, event):
+        """Check registration window and owner of the signup."""
+        if event is None:
+            return False
+
         # Remove tzinfo to compare to utcnow (API only accepts UTC anyways)
         time_register_start = event['time_register_start'].replace(tzinfo=None)
         time_register_end = event['time_register_end'].replace(tzinfo=None)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Signup counters stored in events.
+
+Per default, `signup_count` and `unaccepted_count` are counted whenever
+events are fetched (see `amivapi.events.projections`).
+
+If `EVENT_SIGNUP_COUNTERS` is enabled, events store both counters instead.
+They are updated with `$inc` whenever a signup is created, deleted or
+accepted, so reading events requires no counting and the counters can be used
+in `where` and `sort` queries. The waiting list uses them to reserve spots
+atomically with `reserve_spot`, which keeps concurrent signups from
+accepting more people than there are spots.
+
+After enabling the counters, the counters of existing events must be built
+with `amivapi signup_counters`. Counters are reconciled daily, which fixes
+drift caused e.g. by direct database modifications.
+"""
+
+from collections import Counter
+from datetime import timedelta
+
+from flask import current_app
+from pymongo import UpdateOne
+
+from amivapi.cron import periodic
+
+
+def counters_enabled():
+    """Check if events store their signup counters."""
+    return current_app.config.get('EVENT_SIGNUP_COUNTERS', False)
+
+
+def increment_counters(event_id, signup_count=0, unaccepted_count=0):
+    """Change the counters of an event (if enabled).
+
+    Events without counters (created before they were enabled) are skipped,
+    they are counted on read until the counters are rebuilt.
+    """
+    if counters_enabled() and (signup_count or unaccepted_count):
+        current_app.data.driver.db['events'].update_one(
+            {'_id': event_id, 'signup_count': {'$exists': True}},
+            {'$inc': {'signup_count': signup_count,
+                      'unaccepted_count': unaccepted_count}})
+
+
+def reserve_spot(event_id):
+    """Atomically move one signup of an event from the waiting list to the
+    accepted signups, if there is a free spot.
+
+    The counter is only incremented if it is below the spots of the event
+    (0 spots means unlimited). As this is a single atomic update, concurrent
+    requests can never reserve more spots than available.
+
+    Returns:
+        bool: True if a spot was reserved.
+    """
+    result = current_app.data.driver.db['events'].update_one(
+        {'_id': event_id,
+         '$or': [{'spots': 0},
+                 {'$expr': {'$lt': ['$signup_count', '$spots']}}]},
+        {'$inc': {'signup_count': 1, 'unaccepted_count': -1}})
+    return result.modified_count == 1
+
+
+def release_spot(event_id):
+    """Give back a spot reserved with `reserve_spot`."""
+    increment_counters(event_id, -1, 1)
+
+
+def count_signups(event_ids):
+    """Count accepted and unaccepted signups of several events at once.
+
+    Returns:
+        dict: Counts by event id, events without signups are included.
+    """
+    counts = {_id: {'signup_count': 0, 'unaccepted_count': 0}
+              for _id in event_ids}
+    if not counts:
+        return counts
+
+    result = current_app.data.driver.db['eventsignups'].aggregate([
+        {'$match': {'event': {'$in': list(counts)}}},
+        {'$group': {
+            '_id': '$event',
+            'signup_count': {
+                '$sum': {'$cond': [{'$eq': ['$accepted', True]}, 1, 0]}},
+            'unaccepted_count': {
+                '$sum': {'$cond': [{'$eq': ['$accepted', False]}, 1, 0]}},
+        }},
+    ])
+    for item in result:
+        counts[item.pop('_id')].update(item)
+    return counts
+
+
+def rebuild_counters():
+    """Recount the signups of all events and fix wrong counters.
+
+    A counter is only overwritten if it did not change while counting,
+    otherwise a concurrent `$inc` could get lost. Such events are fixed by
+    the next run.
+
+    Returns:
+        int: Number of events with corrected counters.
+    """
+    events = current_app.data.driver.db['events']
+    stored = {event['_id']: event for event in events.find(
+        {}, {'signup_count': 1, 'unaccepted_count': 1})}
+
+    updates = []
+    for _id, counts in count_signups(list(stored)).items():
+        current = {key: stored[_id].get(key) for key in counts}
+        if current != counts:
+            updates.append(UpdateOne(dict(_id=_id, **current),
+                                     {'$set': counts}))
+
+    if not updates:
+        return 0
+    return events.bulk_write(updates, ordered=False).modified_count
+
+
+@periodic(timedelta(days=1))
+def reconcile_counters():
+    """Periodically fix drifted signup counters."""
+    if counters_enabled():
+        fixed = rebuild_counters()
+        if fixed:
+            current_app.logger.warning(
+                "Corrected signup counters of %i events." % fixed)
+
+
+"""
+Hooks to maintain the counters
+"""
+
+
+def init_counters_before_insert(events):
+    """New events have no signups."""
+    if counters_enabled():
+        for event in events:
+            event['signup_count'] = event['unaccepted_count'] = 0
+
+
+def increment_counters_after_insert(signups):
+    """New signups are not accepted yet, they start on the waiting list."""
+    for event_id, count in Counter(signup['event']
+                                   for signup in signups).items():
+        increment_counters(event_id, unaccepted_count=count)
+
+
+def update_counters_after_update(updates, original):
+    """Admins can accept signups or move them back to the waiting list."""
+    accepted = updates.get('accepted', original['accepted'])
+    if accepted != original['accepted']:
+        change = 1 if accepted else -1
+        increment_counters(original['event'], change, -change)
+
+
+def decrement_counters_after_delete(signup):
+    """Remove a deleted signup from the counters."""
+    if signup['accepted']:
+        increment_counters(signup['event'], signup_count=-1)
+    else:
+        increment_counters(signup['event'], unaccepted_count=-1)
+
+
+def rebuild_counters_after_delete(*args):
+    """Recount everything if the whole signup collection is deleted."""
+    if counters_enabled():
+        rebuild_counters()
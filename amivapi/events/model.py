@@ -504,6 +504,12 @@ eventdomain = {
 
         'public_methods': ['POST'],
 
+        'mongo_indexes': {
+            # Order of signups of an event, used for positions
+            'event_order': ([('event', 1), ('_created', 1), ('sequence', 1)],
+                            {'background': True}),
+        },
+
         'schema': {
             'event': {
                 'description': "The event to sign up to (must require "
@@ -6,46 +6,77 @@
 
 from flask import current_app
 
+from amivapi.events.counters import count_signups, counters_enabled
+from amivapi.events.queue import SIGNUP_ORDER
+from amivapi.utils import get_id
+
 
 def add_email_to_signup(item):
-    if 'email' not in item:
-        if isinstance(item['user'], dict):
-            # If user is embedded just copy the email
-            item['email'] = item['user']['email']
-        else:
-            # User is not embedded, get the user and insert email
-            lookup = {current_app.config['ID_FIELD']: item['user']}
-            user = current_app.data.find_one('users', None, **lookup)
-            item['email'] = user['email']
+    """Add the email of the user to a signup."""
+    add_email_to_signup_collection({'_items': [item]})
 
 
 def add_email_to_signup_collection(response):
-    for item in response['_items']:
-        add_email_to_signup(item)
+    """Add emails to all signups, fetching all users with a single query."""
+    missing = [item for item in response['_items'] if 'email' not in item]
+
+    # If user is embedded just copy the email, otherwise get the user
+    user_ids = set(item['user'] for item in missing
+                   if not isinstance(item['user'], dict))
+    emails = {}
+    if user_ids:
+        users = current_app.data.driver.db['users'].find(
+            {'_id': {'$in': list(user_ids)}}, {'email': 1})
+        emails = {user['_id']: user['email'] for user in users}
+
+    for item in missing:
+        if isinstance(item['user'], dict):
+            item['email'] = item['user']['email']
+        else:
+            item['email'] = emails.get(item['user'])
 
 
 def add_position_to_signup(item):
-    signup_time = item['_created']
-    position = current_app.data.driver.db['eventsignups'].find({
-        '_created': {'$lte': signup_time},
-        'event': item['event']}).count()
-    item['position'] = position
+    """Add the position of the signup in the list of its event."""
+    add_position_to_signup_collection({'_items': [item]})
 
 
 def add_position_to_signup_collection(response):
+    """Add positions to all signups with one query per event.
+
+    The signups of every event are scanned in order up to the last signup
+    on the page, which only needs the index and no count per signup.
+    """
+    by_event = {}
     for item in response['_items']:
-        add_position_to_signup(item)
+        by_event.setdefault(get_id(item['event']), []).append(item)
+
+    signups = current_app.data.driver.db['eventsignups']
+    for event_id, items in by_event.items():
+        last_created = max(item['_created'] for item in items)
+        cursor = signups.find(
+            {'event': event_id, '_created': {'$lte': last_created}},
+            {'_id': 1}).sort(SIGNUP_ORDER)
+        positions = {signup['_id']: position
+                     for position, signup in enumerate(cursor, 1)}
+        for item in items:
+            item['position'] = positions.get(item['_id'])
 
 
 def add_signup_count_to_event(item):
     """After an event is fetched from the database we add the current signup
     count"""
-    item['signup_count'] = current_app.data.driver.db['eventsignups'].find(
-        {'event': item['_id'], 'accepted': True}).count()
-    item['unaccepted_count'] = current_app.data.driver.db['eventsignups'].find(
-        {'event': item['_id'], 'accepted': False}).count()
+    add_signup_count_to_event_collection({'_items': [item]})
 
 
 def add_signup_count_to_event_collection(items):
-    for item in items['_items']:
-        add_signup_count_to_event(item)
+    """Count the signups of all events on the page with one aggregation.
+
+    If the events store their counters, only events without counters are
+    counted (see `amivapi.events.counters`).
+    """
+    missing = [item for item in items['_items']
+               if not (counters_enabled() and 'signup_count' in item)]
+    counts = count_signups([item['_id'] for item in missing])
+    for item in missing:
+        item.update(counts[item['_id']])
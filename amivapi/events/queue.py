@@ -6,12 +6,26 @@
 
 from flask import current_app, url_for
 from itsdangerous import URLSafeSerializer
-from pymongo import ASCENDING
+from pymongo import ASCENDING, ReturnDocument
 
-from amivapi.utils import mail
+from amivapi.events.counters import (
+    counters_enabled,
+    increment_counters,
+    release_spot,
+    reserve_spot,
+)
+from amivapi.utils import mail_many
 from amivapi.events.utils import get_token_secret
 
 
+# Order of signups in the waiting list. The sequence number breaks ties of
+# signups created in the same second (signups created before sequence numbers
+# were introduced don't have one).
+SIGNUP_ORDER = [('_created', ASCENDING),
+                ('sequence', ASCENDING),
+                ('_id', ASCENDING)]
+
+
 def update_waiting_list(event_id):
     """Fill up missing people in an event with people from the waiting list.
     This gets triggered by different hooks, whenever the list needs to be
@@ -20,6 +34,11 @@ def update_waiting_list(event_id):
     1. After a new signup is created.
     2. After a signup was deleted.
     3. After an external signup was confirmed.
+    4. After the spots of an event were changed.
+
+    If the event stores its signup counters, spots are reserved atomically
+    (see `accept_reserved`), otherwise accepted signups are counted (see
+    `accept_counted`). The notifications are sent in one batch.
 
     Returns:
         list: ids of all singups which are newly accepted.
@@ -28,72 +47,147 @@ def update_waiting_list(event_id):
     lookup = {id_field: event_id}
     event = current_app.data.find_one('events', None, **lookup)
 
-    accepted_ids = []
+    if (event is None or event['selection_strategy'] != 'fcfs' or
+            event['spots'] is None):
+        # Event deleted in the meantime or no automatic acceptance
+        return []
+
+    if counters_enabled() and 'signup_count' in event:
+        accepted = accept_reserved(event_id)
+    else:
+        accepted = accept_counted(event)
+
+    if accepted:
+        # Notify users
+        title = event.get('title_en') or event.get('title_de')
+        notify_signups_accepted(title, accepted)
 
-    if event['selection_strategy'] == 'fcfs':
-        lookup = {'event': event_id, 'accepted': True}
-        signup_count = current_app.data.driver.db['eventsignups'].find(
-            lookup).count()
+    return [signup[id_field] for signup in accepted]
 
-        # 0 spots == infinite spots
-        if event['spots'] == 0 or signup_count < event['spots']:
-            lookup = {'event': event_id, 'accepted': False, 'confirmed': True}
-            new_list = current_app.data.driver.db['eventsignups'].find(
-                lookup).sort('_created', ASCENDING)
 
-            if event['spots'] > 0:
-                to_accept = new_list.limit(event['spots'] - signup_count)
-            else:
-                # infinite spots, so just accept everyone
-                to_accept = new_list
+def accept_counted(event):
+    """Accept signups after counting the free spots.
+
+    The signups to accept are selected with one query and accepted with a
+    single update. Concurrent requests may accept too many signups.
+
+    Returns:
+        list: the accepted signups.
+    """
+    id_field = current_app.config['ID_FIELD']
+    event_id = event[id_field]
+    signups = current_app.data.driver.db['eventsignups']
+    signup_count = signups.count_documents({'event': event_id,
+                                            'accepted': True})
 
-            for new_accepted in to_accept:
-                accepted_ids.append(new_accepted['_id'])
-                # Set accepted flag
-                current_app.data.update('eventsignups', new_accepted[id_field],
-                                        {'accepted': True}, new_accepted)
+    # 0 spots == infinite spots
+    if event['spots'] > 0 and signup_count >= event['spots']:
+        return []
 
-                # Notify user
-                title = event.get('title_en') or event.get('title_de')
-                notify_signup_accepted(title, new_accepted)
+    lookup = {'event': event_id, 'accepted': False, 'confirmed': True}
+    to_accept = signups.find(
+        lookup, {'user': 1, 'email': 1}).sort(SIGNUP_ORDER)
+    if event['spots'] > 0:
+        to_accept = to_accept.limit(event['spots'] - signup_count)
+    # else: infinite spots, so just accept everyone
+    to_accept = list(to_accept)
 
-    return accepted_ids
+    if to_accept:
+        accepted_ids = [signup[id_field] for signup in to_accept]
+        signups.update_many({id_field: {'$in': accepted_ids}},
+                            {'$set': {'accepted': True}})
+        increment_counters(event_id, len(accepted_ids), -len(accepted_ids))
+
+    return to_accept
+
+
+def accept_reserved(event_id):
+    """Accept signups by reserving a spot for each of them.
+
+    For every reserved spot, the first signup of the waiting list is accepted
+    with an atomic update. Concurrent requests can neither accept more
+    signups than there are spots, nor accept the same signup twice. If a
+    spot was reserved for nobody, the waiting list is checked again after
+    releasing it, so no concurrent signup is left waiting for the spot.
+
+    Returns:
+        list: the accepted signups.
+    """
+    signups = current_app.data.driver.db['eventsignups']
+    lookup = {'event': event_id, 'accepted': False, 'confirmed': True}
+
+    accepted = []
+    while reserve_spot(event_id):
+        signup = signups.find_one_and_update(
+            lookup, {'$set': {'accepted': True}},
+            projection={'user': 1, 'email': 1}, sort=SIGNUP_ORDER)
+        if signup is None:
+            # Nobody waiting (anymore)
+            release_spot(event_id)
+            # A signup added in the meantime may have failed to reserve the
+            # spot we were holding, so try again if anyone is waiting now
+            if signups.count_documents(lookup, limit=1):
+                continue
+            break
+        accepted.append(signup)
+
+    return accepted
 
 
 def notify_signup_accepted(event_name, signup):
     """Send an email to a user, that his signup was accepted"""
-    id_field = current_app.config['ID_FIELD']
+    notify_signups_accepted(event_name, [signup])
 
-    if signup.get('user'):
-        lookup = {id_field: signup['user']}
-        user = current_app.data.find_one('users', None, **lookup)
-        name = user['firstname']
-        email = user['email']
-    else:
-        name = 'Guest of AMIV'
-        email = signup['email']
 
-    s = URLSafeSerializer(get_token_secret())
-    token = s.dumps(str(signup[id_field]))
+def notify_signups_accepted(event_name, signups):
+    """Send an email to all users whose signup was accepted.
+
+    The users are fetched with a single query and all mails are sent using
+    the same connection.
+    """
+    id_field = current_app.config['ID_FIELD']
+
+    user_ids = [signup['user'] for signup in signups if signup.get('user')]
+    users = {}
+    if user_ids:
+        cursor = current_app.data.driver.db['users'].find(
+            {id_field: {'$in': user_ids}}, {'firstname': 1, 'email': 1})
+        users = {user[id_field]: user for user in cursor}
 
     if current_app.config.get('SERVER_NAME') is None:
         current_app.logger.warning("SERVER_NAME is not set. E-Mail links "
                                    "will not work!")
 
-    deletion_link = url_for('emails.on_delete_signup', token=token,
-                            _external=True)
+    s = URLSafeSerializer(get_token_secret())
+    mails = []
+    for signup in signups:
+        if signup.get('user'):
+            user = users[signup['user']]
+            name = user['firstname']
+            email = user['email']
+        else:
+            name = 'Guest of AMIV'
+            email = signup['email']
+
+        token = s.dumps(str(signup[id_field]))
+        deletion_link = url_for('emails.on_delete_signup', token=token,
+                                _external=True)
 
-    mail(current_app.config['API_MAIL'], email,
-         '[AMIV] Eventsignup accepted',
-         'Hello %s!\n'
-         '\n'
-         'We are happy to inform you that your signup for %s was accepted and '
-         'you can come to the event! If you do not have time to attend the '
-         'event please click this link to free your spot for someone else:\n'
-         '\n%s\n\n'
-         'Best Regards,\n'
-         'The AMIV event bot'
-         % (name, event_name, deletion_link))
+        mails.append((
+            current_app.config['API_MAIL'], email,
+            '[AMIV] Eventsignup accepted',
+            'Hello %s!\n'
+            '\n'
+            'We are happy to inform you that your signup for %s was accepted '
+            'and you can come to the event! If you do not have time to attend '
+            'the event please click this link to free your spot for someone '
+            'else:\n'
+            '\n%s\n\n'
+            'Best Regards,\n'
+            'The AMIV event bot'
+            % (name, event_name, deletion_link)))
+
+    mail_many(mails)
 
 
 """
@@ -101,6 +195,36 @@ Hooks that trigger fcfs execution
 """
 
 
+def add_sequence_before_insert(signups):
+    """Number the signups of every event in the order they are created.
+
+    The next number of every event is kept in the `eventsignup_sequences`
+    collection and reserved atomically, so concurrent signups never get the
+    same number.
+    """
+    sequences = current_app.data.driver.db['eventsignup_sequences']
+    for signup in signups:
+        counter = sequences.find_one_and_update(
+            {'_id': signup['event']},
+            {'$inc': {'sequence': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        signup['sequence'] = counter['sequence']
+
+
+def remove_sequence_after_delete(event):
+    """Remove the signup sequence of a deleted event."""
+    current_app.data.driver.db['eventsignup_sequences'].delete_one(
+        {'_id': event['_id']})
+
+
+def remove_sequences_after_delete(*args):
+    """Remove the signup sequences of all events which have been deleted."""
+    events = current_app.data.driver.db['events'].distinct('_id')
+    current_app.data.driver.db['eventsignup_sequences'].delete_many(
+        {'_id': {'$nin': events}})
+
+
 def add_accepted_before_insert(signups):
     """Add the accepted field before inserting signups."""
     for signup in signups:
@@ -123,6 +247,12 @@ def update_waiting_list_after_insert(signups):
             signup['accepted'] = True
 
 
+def update_waiting_list_after_event_update(updates, original):
+    """Hook to accept signups from the waiting list if spots were added."""
+    if 'spots' in updates or 'selection_strategy' in updates:
+        update_waiting_list(original[current_app.config['ID_FIELD']])
+
+
 def update_waiting_list_after_delete(signup):
     """Hook to update the event waiting list after a signup is deleted."""
     if not signup['accepted']:
@@ -11,6 +11,8 @@ from flask import current_app, g, request
 from jsonschema import Draft4Validator, SchemaError
 import pytz
 
+from amivapi.auth.context import AuthContext, get_auth_context
+
 
 class EventValidator(object):
     """Custom Validator for event validation rules."""
@@ -70,11 +72,13 @@ class EventValidator(object):
         {'type': 'boolean'}
         """
         if enabled:
-            count = current_app.data.driver.db['blacklist'].count_documents({
-                        'user': user_id,
-                        '$or': [{'end_time': None},
-                                {'end_time': {'$gte': datetime.utcnow()}}]})
-            if count:
+            # Use the context of the current user, if it is used anyways
+            if str(user_id) == g.get('current_user'):
+                context = get_auth_context()
+            else:
+                context = AuthContext(str(user_id))
+
+            if context.is_blacklisted:
                 self._error(field, "the user with id %s is on the blacklist"
                             % user_id)
 
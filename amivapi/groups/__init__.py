@@ -13,8 +13,10 @@ from datetime import datetime, timedelta
 
 from flask import current_app
 
+from amivapi.auth.context import clear_auth_context
 from amivapi.cron import periodic
 from amivapi.groups.mailing_lists import (
+    flush_changes,
     new_groups,
     new_members,
     removed_group,
@@ -22,9 +24,13 @@ from amivapi.groups.mailing_lists import (
     updated_group,
     updated_user)
 from amivapi.groups.model import groupdomain
-from amivapi.groups.permissions import check_group_permissions
+from amivapi.groups.permissions import (
+    check_group_permissions,
+    clear_changed_member_permissions,
+    clear_group_permissions,
+    clear_member_permissions)
 from amivapi.groups.validation import GroupValidator
-from amivapi.utils import register_domain, register_validator
+from amivapi.utils import register_domain, register_validator, TTLCache
 
 
 def init_app(app):
@@ -35,6 +41,21 @@ def init_app(app):
     # authentication
     app.after_auth += check_group_permissions
 
+    # permission cache: group ids and granted permissions of every user,
+    # loaded by the auth context (amivapi.auth.context)
+    app.group_permissions_cache = TTLCache(
+        app.config['GROUP_PERMISSIONS_CACHE_SIZE'],
+        app.config['GROUP_PERMISSIONS_CACHE_TTL'])
+    app.on_inserted_groups += clear_auth_context
+    app.on_updated_groups += clear_group_permissions
+    app.on_deleted_item_groups += clear_group_permissions
+    app.on_deleted_resource_groups += clear_group_permissions
+    app.on_inserted_groupmemberships += clear_member_permissions
+    app.on_updated_groupmemberships += clear_changed_member_permissions
+    app.on_replaced_groupmemberships += clear_changed_member_permissions
+    app.on_deleted_item_groupmemberships += clear_member_permissions
+    app.on_deleted_resource_groupmemberships += clear_group_permissions
+
     # email lists
     app.on_inserted_groups += new_groups
     app.on_updated_groups += updated_group
@@ -45,8 +66,12 @@ def init_app(app):
 
     app.on_updated_users += updated_user
 
+    # Recreate the files of all changed groups once per request
+    app.teardown_appcontext(flush_changes)
+
 
 @periodic(timedelta(days=1))
 def remove_expired_group_members():
     current_app.data.driver.db['groupmemberships'].remove(
         {'expiry': {'$lte': datetime.utcnow()}})
+    current_app.group_permissions_cache.clear()
@@ -5,10 +5,13 @@
 """Api group emails.
 
 A email list can be generated for any group.
-Everytime a group changes or a groupmember is added/removed, the group mail
-files will be regenerated.
-(Since we do not get thousands of requests like this per second we don't need
- anything fancy.)
+Everytime a group changes or a groupmember is added/removed, the group is
+marked as changed. The files of all changed groups are regenerated once at the
+end of the request (or app context), so e.g. adding many members rebuilds the
+files only once. Files with unchanged content are not written again, and
+files of addresses which are no longer used are removed at the same time.
+If the files can't be written, the groups and removed addresses are stored in
+the `mailing_list_dirty` collection and retried periodically by `amivapi cron`.
 
  The files can be created locally or remotely via ssh, to support the current
  mailing list server solution in place.
@@ -18,13 +21,20 @@ files will be regenerated.
  If this changes, this implementation should be updated.
 """
 
+from datetime import datetime, timedelta
+from hashlib import sha1
+from io import BytesIO
 from itertools import chain
 from os import makedirs, path, remove
+from shlex import quote
 from subprocess import Popen, PIPE
+import tarfile
 
 from bson import ObjectId
+from flask import current_app, g
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
 
-from flask import current_app
+from amivapi.cron import periodic
 
 
 # Hooks
@@ -32,7 +42,7 @@ from flask import current_app
 def new_groups(groups):
     """Create mailing list files for all new groups."""
     for group in groups:
-        make_files(group['_id'])
+        mark_changed(group['_id'])
 
 
 def updated_group(updates, original):
@@ -40,31 +50,28 @@ def updated_group(updates, original):
     # Remove no longer needed forwards
     if 'receive_from' in updates:
         original_addresses = original.get('receive_from') or []
-        remove_files(address for address in original_addresses
+        mark_removed(address for address in original_addresses
                      if address not in updates['receive_from'])
     # Update remaining forwards
     if ('receive_from' in updates) or ('forward_to' in updates):
-        make_files(original['_id'])
+        mark_changed(original['_id'])
 
 
 def removed_group(group):
     """Delete all mailinglist files."""
     addresses = group.get('receive_from') or []
-    remove_files(addresses)
+    mark_removed(addresses)
 
 
 def new_members(new_memberships):
     """Post on memberships, recreate files for the groups"""
-    # Get group ids without duplicates
-    group_ids = set(m['group'] for m in new_memberships)
-
-    for group_id in group_ids:
-        make_files(group_id)
+    for membership in new_memberships:
+        mark_changed(membership['group'])
 
 
 def removed_member(member):
     """Update files for the group the user was in."""
-    make_files(member['group'])
+    mark_changed(member['group'])
 
 
 def updated_user(updates, original):
@@ -74,75 +81,165 @@ def updated_user(updates, original):
             {'user': ObjectId(original['_id'])}, {'group': 1})
 
         for membership in memberships:
-            make_files(str(membership['group']))
+            mark_changed(membership['group'])
+
+
+# Deferred updates
+
+def mark_changed(group_id):
+    """Remember to recreate the files of a group, see `flush_changes`."""
+    if _files_enabled():
+        g.setdefault('changed_mailing_lists', set()).add(ObjectId(group_id))
+
+
+def mark_removed(addresses):
+    """Remember to remove the files of the addresses with the next update."""
+    if _files_enabled():
+        g.setdefault('removed_mailing_lists', set()).update(addresses)
+
+
+def flush_changes(*args):
+    """Recreate the files of all changed groups and remove unused files.
+
+    Called when the app context ends, i.e. after every request. As the
+    response has already been created, errors are only logged and the changes
+    are stored to be retried by `retry_changes`.
+    """
+    changed = g.pop('changed_mailing_lists', set())
+    removed = g.pop('removed_mailing_lists', set())
+    if changed or removed:
+        try:
+            make_files_for_groups(changed, removed=removed)
+        except Exception as e:
+            current_app.logger.error(
+                "Failed to update mailing lists of groups %s (removed: %s), "
+                "retrying later: %s"
+                % (', '.join(str(_id) for _id in changed),
+                   ', '.join(removed), e))
+            now = datetime.utcnow()
+            current_app.data.driver.db['mailing_list_dirty'].bulk_write([
+                UpdateOne({'_id': _id}, {'$set': {'time': now,
+                                                  'removed': _id in removed}},
+                          upsert=True)
+                for _id in chain(changed, removed)])
+
+
+@periodic(timedelta(minutes=10))
+def retry_changes():
+    """Update the files of all groups and addresses which failed before."""
+    dirty = current_app.data.driver.db['mailing_list_dirty']
+    started = datetime.utcnow()
+    items = list(dirty.find())
+    if items:
+        make_files_for_groups(
+            [item['_id'] for item in items if not item['removed']],
+            removed=[item['_id'] for item in items if item['removed']])
+        # Changes which failed again in the meantime stay
+        dirty.delete_many({'_id': {'$in': [item['_id'] for item in items]},
+                           'time': {'$lte': started}})
 
 
 # File Handling
 
-def make_files(group_id):
-    """Create all mailing lists for a group.
+def _files_enabled():
+    """Check if local or remote mailing list files are used at all."""
+    return bool(current_app.config['MAILING_LIST_DIR'] or
+                current_app.config['REMOTE_MAILING_LIST_ADDRESS'])
 
-    If the file exists it will be overwritten.
-    If `MAILING_LIST_DIR` set in config, create a local file.
-    If `REMOTE_MAILING_LIST_ADDRESS` set in config, create remote file.
+
+def make_files(group_id, force=False):
+    """Create all mailing lists for a group, see `make_files_for_groups`.
 
     Args:
         group_id (str): The id of the group
+        force (bool): Write files even if the content has not changed
     """
-    # Check if any file will be created, otherwise avoid db access
-    if (current_app.config['MAILING_LIST_DIR'] or
-            current_app.config['REMOTE_MAILING_LIST_ADDRESS']):
-        group_objectid = ObjectId(group_id)
-
-        # Get group, ensure to include mail addresses
-        group = current_app.data.driver.db['groups'].find_one(
-            {'_id': group_objectid}, {'receive_from': 1, 'forward_to': 1})
-
-        if group:
-            # get mail addresses of all users in group
-            memberships = current_app.data.driver.db['groupmemberships'].find(
-                {'group': group_objectid}, {'user': 1})
-            user_ids = [membership['user'] for membership in memberships]
-            users = current_app.data.driver.db['users'].find(
-                {'_id': {'$in': user_ids}}, {'email': 1})
-            user_mails = (user['email'] for user in users)
-
-            # file content: user mails and 'forward_to' entries
-            # The empty string (last arg) ensures that the data ends with '\n'
-            content = '\n'.join(chain(group.get('forward_to') or [],
-                                      user_mails,
-                                      ''))
-
-            # A file is required for each 'receive_from' entry
-            for address in group.get('receive_from') or []:
-                # Local
-                local_dir = current_app.config['MAILING_LIST_DIR']
-                if local_dir:
-                    # Create directory if needed
-                    if not path.isdir(local_dir):
-                        makedirs(local_dir)
-
-                    with open(_get_local_path(address), 'w') as file:
-                        file.write(content)
-                        file.truncate()  # If old file was larger, cut of rest
-
-                # Remote
-                if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
-                    ssh_create(address, content)
+    make_files_for_groups([group_id], force=force)
 
 
-def remove_files(addresses):
-    """Remove several mailing list files.
+def make_files_for_groups(group_ids, force=False, removed=()):
+    """Create all mailing lists for several groups at once.
 
+    If the file exists it will be overwritten, unless the content has not
+    changed. Files of removed addresses are deleted at the same time.
     If `MAILING_LIST_DIR` set in config, create a local file.
-    If `REMOTE_MAILING_LIST_ADDRESS` set in config, create remote file.
+    If `REMOTE_MAILING_LIST_ADDRESS` set in config, create remote file. All
+    remote files are uploaded with a single ssh connection. The hashes of
+    remote files are stored in the `mailing_list_files` collection to detect
+    unchanged content.
 
     Args:
-        addresses (list): email addresses with a forward file to delete
+        group_ids (list): The ids of the groups
+        force (bool): Write files even if the content has not changed
+        removed (list): addresses with a forward file to delete
     """
-    for address in addresses:
-        # Local
-        if current_app.config['MAILING_LIST_DIR']:
+    # Check if any file will be created, otherwise avoid db access
+    if _files_enabled():
+        write_files(_get_contents(group_ids), force=force, removed=removed)
+
+
+def _get_contents(group_ids):
+    """Get the content of all mailing list files of the groups.
+
+    Returns:
+        dict: file content for each 'receive_from' address
+    """
+    db = current_app.data.driver.db
+    group_ids = [ObjectId(group_id) for group_id in group_ids]
+
+    # Get groups, ensure to include mail addresses
+    groups = list(db['groups'].find({'_id': {'$in': group_ids}},
+                                    {'receive_from': 1, 'forward_to': 1}))
+
+    # get mail addresses of all users in the groups
+    memberships = list(db['groupmemberships'].find(
+        {'group': {'$in': group_ids}}, {'user': 1, 'group': 1}))
+    users = db['users'].find(
+        {'_id': {'$in': [membership['user'] for membership in memberships]}},
+        {'email': 1})
+    emails = {user['_id']: user['email'] for user in users}
+
+    contents = {}
+    for group in groups:
+        user_mails = (emails[membership['user']]
+                      for membership in memberships
+                      if membership['group'] == group['_id'] and
+                      membership['user'] in emails)
+
+        # file content: user mails and 'forward_to' entries
+        # The empty string (last arg) ensures that the data ends with '\n'
+        content = '\n'.join(chain(group.get('forward_to') or [],
+                                  user_mails,
+                                  ''))
+
+        # A file is required for each 'receive_from' entry
+        for address in group.get('receive_from') or []:
+            contents[address] = content
+    return contents
+
+
+def write_files(contents, force=False, removed=()):
+    """Write mailing list files, skip files with unchanged content.
+
+    Files of removed addresses are only deleted if the address is not used by
+    any group anymore.
+
+    Args:
+        contents (dict): file content for each address
+        force (bool): Write files even if the content has not changed
+        removed (list): addresses with a forward file to delete
+    """
+    removed = set(removed).difference(contents)
+    if removed:
+        used = current_app.data.driver.db['groups'].find(
+            {'receive_from': {'$in': list(removed)}}, {'receive_from': 1})
+        for group in used:
+            removed.difference_update(group['receive_from'])
+
+    # Local
+    local_dir = current_app.config['MAILING_LIST_DIR']
+    if local_dir:
+        for address in removed:
             try:
                 remove(_get_local_path(address))
             except OSError as error:
@@ -151,9 +248,58 @@ def remove_files(addresses):
                     "mailing list database seems to be inconsistent!"
                     % address)
 
-        # Remote
-        if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
-            ssh_remove(address)
+        for address, content in contents.items():
+            if force or _read_local(address) != content:
+                # Create directory if needed
+                if not path.isdir(local_dir):
+                    makedirs(local_dir)
+
+                with open(_get_local_path(address), 'w') as file:
+                    file.write(content)
+                    file.truncate()  # If old file was larger, cut of rest
+
+    # Remote
+    if current_app.config['REMOTE_MAILING_LIST_ADDRESS']:
+        collection = current_app.data.driver.db['mailing_list_files']
+        hashes = {address: sha1(content.encode()).hexdigest()
+                  for address, content in contents.items()}
+        if not force:
+            stored = collection.find({'_id': {'$in': list(hashes)}})
+            for item in stored:
+                if hashes[item['_id']] == item['hash']:
+                    del hashes[item['_id']]
+
+        if hashes or removed:
+            ssh_upload({address: contents[address] for address in hashes},
+                       removed=removed)
+            collection.bulk_write(
+                [ReplaceOne({'_id': address}, {'hash': content_hash},
+                            upsert=True)
+                 for address, content_hash in hashes.items()] +
+                [DeleteOne({'_id': address}) for address in removed])
+
+
+def _read_local(address):
+    """Content of a local mailing list file, None if it does not exist."""
+    try:
+        with open(_get_local_path(address), 'r') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def remove_files(addresses):
+    """Remove several mailing list files.
+
+    If `MAILING_LIST_DIR` set in config, remove local files.
+    If `REMOTE_MAILING_LIST_ADDRESS` set in config, remove remote files with
+    a single ssh connection.
+
+    Args:
+        addresses (list): email addresses with a forward file to delete
+    """
+    if _files_enabled():
+        write_files({}, removed=addresses)
 
 
 def _get_local_path(email):
@@ -172,31 +318,52 @@ def _get_remote_path(email):
 
 def ssh_create(address, content):
     """Create a file with content remotely over ssh."""
-    # Create dir, then use 'cat - ' to listen to stdin
-    # Create temporary file first, if upload is completed replace
+    ssh_upload({address: content})
+
+
+def ssh_upload(contents, removed=()):
+    """Create and remove several files remotely with a single ssh connection.
+
+    The files are sent as tar archive and extracted into a temporary
+    directory first. Files are only removed and moved to their destination
+    once the upload is complete, so an interrupted upload changes no files.
+    The files are moved one by one, i.e. a failure while moving can leave
+    some of them unchanged.
+
+    Args:
+        contents (dict): file content for each address
+        removed (list): addresses with a forward file to delete
+    """
+    archive = BytesIO()
+    with tarfile.open(fileobj=archive, mode='w',
+                      format=tarfile.USTAR_FORMAT) as tar:
+        for address, content in contents.items():
+            data = content.encode()
+            info = tarfile.TarInfo(path.basename(_get_remote_path(address)))
+            info.size = len(data)
+            tar.addfile(info, BytesIO(data))
+
     folder = current_app.config['REMOTE_MAILING_LIST_DIR']
-    file = _get_remote_path(address)
-    tempfile = file + '.tmp'
-    ssh_command('mkdir -p %s; cat - > %s; mv %s %s;'
-                % (folder, tempfile, tempfile, file), input=content)
+    tempdir = path.join(folder, '.amivapi-upload.XXXXXX')
+    remove_command = ''
+    if removed:
+        # rm -f does not fail for missing files
+        remove_command = ' && rm -f -- ' + ' '.join(
+            quote(_get_remote_path(address)) for address in removed)
+    # tar -m: the mtime is set on extraction, the archive has none
+    # mv -t with + fails if any file can't be moved
+    ssh_command('mkdir -p {folder} && tmp=$(mktemp -d {tempdir}) && '
+                '{{ tar -xm -C "$tmp"{remove} && '
+                'find "$tmp" -mindepth 1 -maxdepth 1 -exec mv -f -t {folder} '
+                '{{}} + ; status=$?; rm -rf "$tmp"; exit $status; }}'
+                .format(folder=quote(folder), tempdir=quote(tempdir),
+                        remove=remove_command),
+                input=archive.getvalue())
 
 
 def ssh_remove(address):
-    """Remove a file remotely over ssh."""
-    path = _get_remote_path(address)
-    try:
-        ssh_command('rm %s' % path)
-    except RuntimeError as e:
-        # File does not exist: log issue, but do not raise exception
-        no_file_error = ("rm: cannot remove '%s': No such file or directory" %
-                         path)
-        if no_file_error in str(e):
-            current_app.logger.error(
-                "Cannot remove remote mailing list '%s' because the file does "
-                "not exist. The mailing list database seems to be"
-                "inconsistent." % address)
-        else:
-            raise e
+    """Remove a file remotely over ssh. Missing files are ignored."""
+    ssh_upload({}, removed=[address])
 
 
 def ssh_command(remote_command, input=None):
@@ -206,7 +373,7 @@ def ssh_command(remote_command, input=None):
 
     Args:
         remote_command(Str): Command to execute on remote server
-        input(Str): Input, is sent to remote process via stdin
+        input(Str or bytes): Input, is sent to remote process via stdin
 
     Returns:
         Str: stdout of command
@@ -216,16 +383,19 @@ def ssh_command(remote_command, input=None):
     """
     keyfile = current_app.config.get('REMOTE_MAILING_LIST_KEYFILE')  # optional
     address = current_app.config['REMOTE_MAILING_LIST_ADDRESS']
+    ssh = current_app.config.get('REMOTE_MAILING_LIST_SSH', 'ssh')
 
     # Construct local ssh command, use -i option if keyfile is specified
-    cmd = (["ssh"] + (['-i', keyfile] if keyfile else []) +
+    cmd = ([ssh] + (['-i', keyfile] if keyfile else []) +
            [address, remote_command])
 
     # Open subprocess, initialize pipes for input and errors
     process = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
     # Send input (as bytes) and receive errors (will also be bytes)
-    out, error = process.communicate(input=input.encode() if input else None)
+    if isinstance(input, str):
+        input = input.encode()
+    out, error = process.communicate(input=input)
 
     # Raise RuntimeError if anything went wrong
     if error:
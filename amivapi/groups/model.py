@@ -7,10 +7,10 @@
 Contains models for groups and group mmeberships.
 """
 from bson import ObjectId
-from flask import current_app
 
 from amivapi.utils import get_id
 from amivapi.auth import AmivTokenAuth
+from amivapi.auth.context import get_auth_context
 from amivapi.settings import EMAIL_REGEX
 
 
@@ -31,10 +31,7 @@ class GroupAuth(AmivTokenAuth):
         - everyone, if self enrollment is allowed
         """
         # Find groups the user is in
-        collection = current_app.data.driver.db['groupmemberships']
-        memberships = collection.find({'user': ObjectId(user_id)},
-                                      {'group': 1})
-        groups = [item['group'] for item in memberships]
+        groups = get_auth_context(user_id).member_groups
 
         return {'$or': [
             {'_id': {'$in': groups}},
@@ -61,13 +58,15 @@ class GroupMembershipAuth(AmivTokenAuth):
             return True
         else:
             # Check if moderator
-            # Note: Group must exist, otherwise membership would not exist
-            #   Furthermore user_id can't be None so if there is no moderator
-            #   we will correctly return False
-            collection = current_app.data.driver.db['groups']
-            group = collection.find_one({'_id': get_id(item['group'])},
-                                        {'moderator': 1})
-            return user_id == str(group.get('moderator'))
+            return (get_id(item['group']) in
+                    get_auth_context(user_id).moderated_groups)
+
+    def has_item_write_permission_many(self, user_id, items):
+        """Compare all memberships to the set of moderated groups."""
+        moderated_groups = get_auth_context(user_id).moderated_groups
+        return [user_id == str(get_id(item['user'])) or
+                get_id(item['group']) in moderated_groups
+                for item in items]
 
     def create_user_lookup_filter(self, user_id):
         """Lookup for group members.
@@ -75,26 +74,12 @@ class GroupMembershipAuth(AmivTokenAuth):
         Users can see memberships for groups:
         - they are members of
         - they moderate
-
-        Possible improvement: Currently we need to find groupmemberships to
-        create a filter for groupmemberships. Maybe this query can be done
-        more elegant.
         """
-        # Find groups the user moderates
-        group_collection = current_app.data.driver.db['groups']
-        groups = group_collection.find({'moderator': ObjectId(user_id)},
-                                       {'_id': 1})
-        moderated_groups = [group['_id'] for group in groups]
-
-        # Find groups the user is in
-        membership_collection = current_app.data.driver.db['groupmemberships']
-        memberships = membership_collection.find({'user': ObjectId(user_id)},
-                                                 {'group': 1})
-        member_groups = [membership['group'] for membership in memberships]
+        context = get_auth_context(user_id)
 
         return {'$or': [
-            {'group': {'$in': moderated_groups}},
-            {'group': {'$in': member_groups}}
+            {'group': {'$in': list(context.moderated_groups)}},
+            {'group': {'$in': context.member_groups}}
         ]}
 
 
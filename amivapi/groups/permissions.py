@@ -3,12 +3,32 @@
 # license: AGPLv3, see LICENSE for details. In addition we strongly encourage
 #          you to buy us beer if we meet and you like the software.
 
-"""Permissions for group members."""
+"""Permissions for group members.
 
-from bson import ObjectId
+The permissions of all groups of a user are loaded once with the auth
+context (see `amivapi.auth.context`) and kept for the rest of the request
+(the home endpoint checks permissions for every resource). Optionally, they
+are cached per user for `GROUP_PERMISSIONS_CACHE_TTL`. The group and
+membership hooks invalidate both.
+"""
 
 from flask import current_app, g
 
+from amivapi.auth.context import clear_auth_context, get_auth_context
+
+
+def get_group_permissions(user_id):
+    """Get the permissions all groups of a user grant.
+
+    Args:
+        user_id (str): The id of the user
+
+    Returns:
+        dict: resource as key, set of permissions ('read', 'readwrite') as
+            value. Contains only resources for which permissions are granted.
+    """
+    return get_auth_context(user_id).group_permissions
+
 
 def check_group_permissions(resource):
     """Retrieve groups for current user and apply permissions for resource.
@@ -20,17 +40,36 @@ def check_group_permissions(resource):
     user = g.get('current_user')
 
     if user:
-        # Find the users groups giving permission for a resource
-        memberships = current_app.data.driver.db['groupmemberships'].find(
-            {'user': ObjectId(user)}, {'group': 1})
-        group_ids = [m['group'] for m in memberships]
-        permission_key = 'permissions.%s' % resource
-        groups = current_app.data.driver.db['groups'].find(
-            {'_id': {'$in': group_ids}, permission_key: {'$exists': True}},
-            {permission_key: 1})
-        permissions = [group['permissions'][resource] for group in groups]
+        permissions = get_group_permissions(user).get(resource, ())
 
         if 'read' in permissions:
             g.resource_admin_readonly = True
         if 'readwrite' in permissions:
             g.resource_admin = True
+
+
+# Invalidation hooks
+
+def clear_group_permissions(*args):
+    """Hook to discard all known permissions, e.g. if a group changes."""
+    clear_auth_context()
+    current_app.group_permissions_cache.clear()
+
+
+def clear_member_permissions(memberships):
+    """Hook to discard the permissions of users with changed memberships."""
+    if isinstance(memberships, dict):
+        # Hook for a single item
+        memberships = [memberships]
+
+    clear_auth_context()
+    for membership in memberships:
+        current_app.group_permissions_cache.pop(str(membership['user']))
+
+
+def clear_changed_member_permissions(updates, original):
+    """Hook to discard permissions if a membership is updated or replaced.
+
+    The user of the membership may change, so both users are affected.
+    """
+    clear_member_permissions([original, dict(original, **updates)])
@@ -17,6 +17,10 @@ Possible improvements:
 - `_create_or_patch_user' is also not very straightforward, maybe the ldap
   importing logic could be simplified?
 
+`sync_all' processes the members in chunks, compares the ldap data with the
+database in memory and only writes users which have changed, so regular syncs
+are cheap and need constant memory.
+
 
 Note on department info in ldap:
 
@@ -34,6 +38,9 @@ check for the department. In the app settings, we define which substring
 is mapped to which department.
 """
 
+from itertools import islice
+import string
+
 from eve.methods.patch import patch_internal
 from eve.methods.post import post_internal
 from flask import current_app
@@ -41,6 +48,10 @@ from nethz.ldap import AuthenticatedLdap
 
 from amivapi.utils import admin_permissions
 
+# The member search is split up by the first letter of the nethz name,
+# so no single search has to return all members at once
+SEARCH_PREFIXES = string.ascii_lowercase + string.digits
+
 
 def init_app(app):
     """Attach an ldap connection to the app."""
@@ -92,19 +103,125 @@ def sync_one(cn):
 def sync_all():
     """Query the ETH LDAP for all our members. Adds non-existing ones to db.
 
-    Updates existing ones if ldap data has changed.
-    Depending on the system, this can take 30 seconds or longer.
+    Updates existing ones if ldap data has changed. See `sync_all_chunked`.
 
     Returns:
-        list: Data of all updated users.
+        dict: Number of `created`, `updated` and `unchanged` users.
+    """
+    result = {'created': 0, 'updated': 0, 'unchanged': 0}
+    for result in sync_all_chunked():
+        pass
+    return result
+
+
+def sync_all_chunked(chunk_size=None):
+    """Synchronize all members chunk by chunk.
+
+    The members are searched piecewise and processed in chunks, so the memory
+    usage does not depend on the number of members. For every chunk, the
+    existing users are fetched with a single query and compared in memory,
+    only users with changes are written to the database.
+
+    Args:
+        chunk_size (int): Users per chunk, defaults to `LDAP_SYNC_CHUNK_SIZE`
+
+    Yields:
+        dict: Number of `created`, `updated` and `unchanged` users so far,
+              after every chunk.
     """
+    if chunk_size is None:
+        chunk_size = current_app.config['LDAP_SYNC_CHUNK_SIZE']
+
     # See file docstring for explanation of `deparmentNumber` field
     keywords = ''.join(u"(departmentNumber=*%s*)" % _escape(item)
                        for item in current_app.config['LDAP_DEPARTMENT_MAP'])
     query = u"(& (ou=VSETH Mitglied) (| %s) )" % keywords
-    ldap_data = _search(query)
+    ldap_data = iter(_search_split(query))
+
+    total = {'created': 0, 'updated': 0, 'unchanged': 0}
+    chunk = list(islice(ldap_data, chunk_size))
+    while chunk:
+        for key, value in _sync_users(chunk).items():
+            total[key] += value
+        yield dict(total)
+        chunk = list(islice(ldap_data, chunk_size))
+
+
+def _search_split(query):
+    """Search the LDAP piecewise, one search per first letter of the cn.
+
+    A last search returns all entries which don't start with any of the
+    `SEARCH_PREFIXES`, so no entry is left out.
+    """
+    prefixes = [u"(cn=%s*)" % prefix for prefix in SEARCH_PREFIXES]
+    for prefix in prefixes:
+        yield from _search(u"(& %s %s)" % (query, prefix))
+    yield from _search(u"(& %s (!(| %s)))" % (query, ''.join(prefixes)))
+
+
+def _sync_users(ldap_users):
+    """Create or update several users at once.
+
+    Args:
+        ldap_users (list): Processed ldap data, see `_process_data`.
+
+    Returns:
+        dict: Number of `created`, `updated` and `unchanged` users.
+    """
+    nethz = [user['nethz'] for user in ldap_users]
+    projection = {field: 1 for user in ldap_users for field in user}
+    existing = {user['nethz']: user for user in
+                current_app.data.driver.db['users'].find(
+                    {'nethz': {'$in': nethz}}, projection)}
+
+    result = {'created': 0, 'updated': 0, 'unchanged': 0}
+    new_users = []
+    with admin_permissions():
+        for ldap_data in ldap_users:
+            db_data = existing.get(ldap_data['nethz'])
+            if db_data is None:
+                new_users.append(ldap_data)
+                continue
 
-    return [_create_or_update_user(user) for user in ldap_data]
+            changes = {key: value for key, value
+                       in _prepare_update(ldap_data, db_data).items()
+                       if db_data.get(key) != value}
+            if changes:
+                patch_internal('users', changes, _id=db_data['_id'])
+                result['updated'] += 1
+            else:
+                result['unchanged'] += 1
+
+        result['created'] = _create_users(new_users)
+
+    return result
+
+
+def _create_users(new_users):
+    """Create users with a single bulk insert.
+
+    If any user is rejected, the whole insert fails. In this case, users are
+    created one by one, so only the invalid ones are left out.
+
+    Returns:
+        int: Number of created users.
+    """
+    if not new_users:
+        return 0
+
+    status = post_internal('users', new_users)[3]
+    if status == 201:
+        return len(new_users)
+
+    created = 0
+    for ldap_data in new_users:
+        response, _, _, status = post_internal('users', ldap_data)
+        if status == 201:
+            created += 1
+        else:
+            current_app.logger.error("Could not create user '%s': %s"
+                                     % (ldap_data['nethz'], response))
+    return created
 
 
 def _search(query):
@@ -175,6 +292,19 @@ def _process_data(data):
     return res
 
 
+def _prepare_update(ldap_data, db_data):
+    """Remove all fields from ldap data that must not change existing users.
+
+    Membership will not be downgraded and email not be overwritten.
+    Newletter settings will also not be adjusted.
+    """
+    ldap_data.pop('email', None)
+    ldap_data.pop('send_newsletter', None)
+    if db_data.get('membership') != u"none":
+        ldap_data.pop('membership', None)
+    return ldap_data
+
+
 def _create_or_update_user(ldap_data):
     """Try to find user in database. Update if it exists, create otherwise."""
     query = {'nethz': ldap_data['nethz']}
@@ -182,15 +312,8 @@ def _create_or_update_user(ldap_data):
 
     with admin_permissions():
         if db_data:
-            # Membership will not be downgraded and email not be overwritten
-            # Newletter settings will also not be adjusted
-            ldap_data.pop('email', None)
-            ldap_data.pop('send_newsletter', None)
-            if db_data.get('membership') != u"none":
-                ldap_data.pop('membership', None)
-
             user = patch_internal('users',
-                                  ldap_data,
+                                  _prepare_update(ldap_data, db_data),
                                   _id=db_data['_id'])[0]
         else:
             # For new members,
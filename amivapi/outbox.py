@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+
+"""Sending of mails.
+
+Per default, `amivapi.utils.mail` sends mails immediately, i.e. within the
+request.
+
+If `MAIL_QUEUE` is enabled, mails are stored in the `mail_outbox` collection
+instead and sent by a separate worker:
+
+    amivapi send_mails --continuous
+
+The worker keeps its SMTP connection open and sends all mails over it.
+Mails which can't be sent are retried after `MAIL_RETRY_DELAY`, which is
+doubled for every failed attempt, until `MAIL_MAX_ATTEMPTS` is reached.
+Every mail is claimed for `LEASE` before it is sent, so several workers can
+run at the same time, and mails of a crashed worker are sent again later.
+Claims count as attempts, so a mail which repeatedly crashes the worker is
+dropped as well. Mails failing with an unexpected error are not retried,
+they are kept in the outbox with the `error` and without `next_attempt`.
+
+For local testing, a debugging SMTP server is sufficient, e.g.
+
+    python -m aiosmtpd -n -l localhost:8025
+
+with `SMTP_SERVER = 'localhost'`, `SMTP_PORT = 8025` and
+`SMTP_STARTTLS = False`.
+"""
+
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+import smtplib
+
+from flask import current_app
+from pymongo import ASCENDING, ReturnDocument
+
+# Time a worker has to send a claimed mail before other workers may retry it
+LEASE = timedelta(minutes=5)
+
+
+class SMTPSession(object):
+    """SMTP connection, which is kept open to send many mails.
+
+    Connects on first use and reconnects once if the server has closed the
+    connection in the meantime, e.g. after a long idle time.
+    """
+
+    def __init__(self):
+        self.config = current_app.config
+        self._smtp = None
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.config['SMTP_SERVER'],
+                            port=self.config['SMTP_PORT'],
+                            timeout=self.config['SMTP_TIMEOUT'])
+        try:
+            if self.config.get('SMTP_STARTTLS', True):
+                status_code, _ = smtp.starttls()
+                if status_code != 220:
+                    raise smtplib.SMTPException(
+                        "Failed to create secure SMTP connection!")
+
+            if (self.config.get('SMTP_USERNAME') and
+                    self.config.get('SMTP_PASSWORD')):
+                smtp.login(self.config['SMTP_USERNAME'],
+                           self.config['SMTP_PASSWORD'])
+            else:
+                smtp.ehlo()
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def send(self, sender, to, subject, text):
+        """Send a mail, see `amivapi.utils.mail` for arguments."""
+        msg = MIMEText(text)
+        msg['Subject'] = subject
+        msg['From'] = sender
+        msg['To'] = ';'.join([to] if isinstance(to, str) else to)
+
+        reconnected = self._smtp is None
+        while True:
+            if self._smtp is None:
+                self._smtp = self._connect()
+            try:
+                self._smtp.sendmail(sender, to, msg.as_string())
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
+                if reconnected:
+                    raise
+                reconnected = True
+
+    def close(self):
+        """Close the connection, if open."""
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except smtplib.SMTPException:
+                pass
+            self._smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def deliver(session, mail):
+    """Send a single mail, or store it in `test_mails` while testing.
+
+    Args:
+        session (SMTPSession): Connection to use
+        mail (tuple): `(sender, to, subject, text)`
+    """
+    if current_app.config.get('TESTING', False):
+        sender, to, subject, text = mail
+        current_app.test_mails.append({
+            'subject': subject,
+            'from': sender,
+            'receivers': to,
+            'text': text
+        })
+    else:
+        session.send(*mail)
+
+
+def send_now(mails):
+    """Send mails immediately, using one connection for all of them."""
+    if not (current_app.config.get('TESTING', False) or
+            (current_app.config.get('SMTP_SERVER') and
+             current_app.config.get('SMTP_PORT'))):
+        return
+
+    with SMTPSession() as session:
+        for mail in mails:
+            try:
+                deliver(session, mail)
+            except smtplib.SMTPRecipientsRefused:
+                error = ("Failed to send mail:\n"
+                         "From: %s\nTo: %s\n"
+                         "Subject: %s\n\n%s")
+                current_app.logger.error(error % mail)
+            except smtplib.SMTPException as e:
+                current_app.logger.error(
+                    "SMTP error trying to send mails: %s" % e)
+                return
+
+
+def enqueue(mails):
+    """Store mails in the outbox to be sent by the worker."""
+    now = datetime.utcnow()
+    current_app.data.driver.db['mail_outbox'].insert_many([{
+        'sender': sender,
+        'to': to,
+        'subject': subject,
+        'text': text,
+        'attempts': 0,
+        'next_attempt': now,
+    } for sender, to, subject, text in mails])
+
+
+def send_queued_mails(session):
+    """Send all mails in the outbox which are due.
+
+    Needs an app context.
+
+    Args:
+        session (SMTPSession): Connection used for all mails
+
+    Returns:
+        int: Number of mails sent
+    """
+    outbox = current_app.data.driver.db['mail_outbox']
+    sent = 0
+
+    while True:
+        now = datetime.utcnow()
+        item = outbox.find_one_and_update(
+            {'next_attempt': {'$lte': now}},
+            {'$set': {'next_attempt': now + LEASE}, '$inc': {'attempts': 1}},
+            sort=[('next_attempt', ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+
+        if item is None:
+            return sent
+
+        if item['attempts'] > current_app.config['MAIL_MAX_ATTEMPTS']:
+            # All attempts were claimed without a result, e.g. because the
+            # worker crashed while sending this mail
+            current_app.logger.error(
+                "Failed to send mail to %s after %i unfinished attempts, "
+                "dropping it: %s"
+                % (item['to'], item['attempts'] - 1, item['subject']))
+            outbox.delete_one({'_id': item['_id']})
+            continue
+
+        mail = (item['sender'], item['to'], item['subject'], item['text'])
+        try:
+            deliver(session, mail)
+        except smtplib.SMTPRecipientsRefused:
+            # Retrying won't help
+            current_app.logger.error("Recipients refused, dropping mail to "
+                                     "%s: %s" % (item['to'], item['subject']))
+        except (smtplib.SMTPException, OSError) as e:
+            session.close()
+            if item['attempts'] >= current_app.config['MAIL_MAX_ATTEMPTS']:
+                current_app.logger.error(
+                    "Failed to send mail to %s after %i attempts, dropping "
+                    "it: %s" % (item['to'], item['attempts'], e))
+            else:
+                delay = (current_app.config['MAIL_RETRY_DELAY'] *
+                         2 ** (item['attempts'] - 1))
+                outbox.update_one({'_id': item['_id']},
+                                  {'$set': {'next_attempt': now + delay}})
+                current_app.logger.warning(
+                    "Failed to send mail to %s, retrying in %s: %s"
+                    % (item['to'], delay, e))
+                continue
+        except Exception as e:
+            # Retrying won't help either, but the worker has to go on
+            session.close()
+            current_app.logger.exception(
+                "Failed to send mail to %s, parking it: %s" % (item['to'], e))
+            outbox.update_one({'_id': item['_id']},
+                              {'$set': {'error': str(e)},
+                               '$unset': {'next_attempt': ''}})
+            continue
+        else:
+            sent += 1
+
+        outbox.delete_one({'_id': item['_id']})
+
+
+def init_app(app):
+    """Create index to find due mails."""
+    with app.app_context():
+        app.data.driver.db['mail_outbox'].create_index('next_attempt')
@@ -62,23 +62,110 @@ MAILING_LIST_DIR = None
 REMOTE_MAILING_LIST_ADDRESS = None
 REMOTE_MAILING_LIST_KEYFILE = None
 REMOTE_MAILING_LIST_DIR = './'  # Use home directory on remote by default
+# Program used to connect to the remote, called like ssh:
+# `<program> [-i keyfile] address command`, e.g. a local stand-in for testing
+REMOTE_MAILING_LIST_SSH = 'ssh'
 
 # SMTP server defaults
 API_MAIL = 'api@amiv.ethz.ch'
 SMTP_HOST = 'localhost'
 SMTP_PORT = 587
 SMTP_TIMEOUT = 10
+SMTP_STARTTLS = True  # Disable only for local testing
+
+# Store mails in a queue instead of sending them within the request. The
+# queue is processed by the mail worker (`amivapi send_mails --continuous`),
+# which checks for new mails every MAIL_QUEUE_INTERVAL. Failed mails are
+# retried after MAIL_RETRY_DELAY, doubled for every further attempt.
+MAIL_QUEUE = False
+MAIL_QUEUE_INTERVAL = timedelta(seconds=5)
+MAIL_RETRY_DELAY = timedelta(minutes=1)
+MAIL_MAX_ATTEMPTS = 6
 
 # LDAP
 LDAP_USERNAME = None
 LDAP_PASSWORD = None
+# A successful LDAP login synchronizes the user with LDAP. With a
+# LDAP_SYNC_CACHE_TTL, e.g. `timedelta(hours=12)`, every worker process skips
+# the synchronization for users it has synchronized within this time.
+LDAP_SYNC_CACHE_TTL = None
+# After LDAP_MAX_FAILED_BINDS failed LDAP logins, a username is not sent to
+# LDAP anymore until LDAP_FAILED_BIND_TIMEOUT has passed since the last
+# failure (counted per worker process), only the API password is checked.
+# `None` disables the limit.
+LDAP_MAX_FAILED_BINDS = None
+LDAP_FAILED_BIND_TIMEOUT = timedelta(minutes=5)
+# Number of usernames stored by both of the above
+LDAP_LOGIN_CACHE_SIZE = 1024
+# `amivapi ldap_sync --all` processes users in chunks of this size
+LDAP_SYNC_CHUNK_SIZE = 500
+
+# Store `signup_count` and `unaccepted_count` in events instead of counting
+# signups for every read, which also allows to filter and sort by them.
+# The counters are also used to reserve spots atomically, which prevents
+# concurrent signups from accepting more people than the event has spots.
+# Run `amivapi signup_counters` after enabling to initialize existing events.
+EVENT_SIGNUP_COUNTERS = False
 
 # Execution of periodic tasks with `amivapi run cron`
 CRON_INTERVAL = timedelta(minutes=5)  # per default, check tasks every 5 min
+CRON_WORKERS = 1  # Number of threads running due tasks in parallel
+# Tasks of a crashed cron process are run again after CRON_LEASE. Failed
+# tasks are retried after CRON_RETRY_DELAY, doubled for every further attempt.
+CRON_LEASE = timedelta(hours=1)
+CRON_RETRY_DELAY = timedelta(minutes=5)
+CRON_MAX_ATTEMPTS = 3
+# Arguments of scheduled tasks are stored as BSON. If enabled, arguments which
+# can't be stored as BSON are pickled, and pickled arguments of tasks
+# scheduled by older versions can be loaded. Only enable this to migrate
+# such tasks with `amivapi cron migrate`.
+CRON_PICKLE_ARGS = False
+
+# Deleting a whole resource (DELETE on the collection) cascades to all objects
+# referencing the deleted ones. With CASCADE_QUEUE, this is done by the cron
+# runner instead of within the request.
+CASCADE_QUEUE = False
+# Deleted objects per entry of the cascade queue. Entries are claimed for
+# CASCADE_QUEUE_LEASE, failed entries are retried after the lease until
+# CASCADE_MAX_ATTEMPTS is reached.
+CASCADE_QUEUE_CHUNK_SIZE = 1000
+CASCADE_QUEUE_LEASE = timedelta(minutes=10)
+CASCADE_MAX_ATTEMPTS = 5
 
 # Security
 ROOT_PASSWORD = u"root"  # Will be overwridden by config.py
 SESSION_TIMEOUT = timedelta(days=365)
+
+# Sessions are cached by every worker process to avoid a database lookup for
+# each request. A session deleted by another process may stay valid for up
+# to SESSION_CACHE_TTL. Set SESSION_CACHE_SIZE to 0 to disable the cache.
+# API key tokens are cached as well, so requests with a key only look for a
+# session once per SESSION_CACHE_TTL. The key itself is still touched, i.e.
+# updated in the database, on every request unless TOUCH_GRANULARITY is set.
+SESSION_CACHE_SIZE = 1024
+SESSION_CACHE_TTL = timedelta(seconds=30)
+
+# All API keys are cached by every worker process, changes made by another
+# process are noticed after at most APIKEY_CACHE_TTL. `None` disables the cache.
+APIKEY_CACHE_TTL = timedelta(seconds=30)
+
+# Group permissions are loaded once per request. They can additionally be
+# cached per user by every worker process; permission changes made by another
+# process are then noticed after at most GROUP_PERMISSIONS_CACHE_TTL.
+GROUP_PERMISSIONS_CACHE_SIZE = 1024
+GROUP_PERMISSIONS_CACHE_TTL = None  # disabled, e.g. `timedelta(seconds=30)`
+
+# Every request updates the `_updated` timestamp of the session or API key.
+# With a TOUCH_GRANULARITY, e.g. `timedelta(minutes=5)`, the timestamp is only
+# written if it is older than that, and the writes of a worker are collected
+# and flushed in bulk after TOUCH_FLUSH_INTERVAL (by the next request or a
+# background timer, and at exit). `None` updates every time.
+TOUCH_GRANULARITY = None
+TOUCH_FLUSH_INTERVAL = timedelta(seconds=10)
+
+# Run `amivapi calibrate_password` to find the rounds for this machine.
+# Passwords with fewer than min_rounds are rehashed after the next login, once
+# the response has been sent, so the login itself is not slowed down.
 PASSWORD_CONTEXT = CryptContext(
     schemes=["pbkdf2_sha256"],
 
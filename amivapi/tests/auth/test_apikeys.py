@@ -106,6 +106,62 @@ class ApiKeyPermissionsTest(WebTest):
         self.api.get('/apikeys', token=token, status_code=403)
 
 
+class ApiKeyCacheTest(WebTest):
+    """Test that the cached API keys are reloaded after changes."""
+    def test_permission_change(self):
+        """Changed permissions are used immediately."""
+        key = self.new_object("apikeys", permissions={'users': 'read'})
+        token = key['token']
+        self.api.get('/apikeys', token=token, status_code=403)
+
+        self.api.patch('/apikeys/%s' % key['_id'],
+                       data={'permissions': {'apikeys': 'read'}},
+                       headers={'If-Match': key['_etag']},
+                       token=self.get_root_token(), status_code=200)
+        self.api.get('/apikeys', token=token, status_code=200)
+
+    def test_deleted_key(self):
+        """Deleted keys can not be used anymore."""
+        key = self.new_object("apikeys", permissions={'apikeys': 'read'})
+        token = key['token']
+        self.api.get('/apikeys', token=token, status_code=200)
+
+        self.api.delete('/apikeys/%s' % key['_id'],
+                        headers={'If-Match': key['_etag']},
+                        token=self.get_root_token(), status_code=204)
+        self.api.get('/apikeys', token=token, status_code=401)
+
+    def test_cached_key(self):
+        """Keys are not looked up in the database for every request."""
+        key = self.new_object("apikeys", permissions={'apikeys': 'read'})
+        token = key['token']
+        self.api.get('/apikeys', token=token, status_code=200)
+
+        self.db['apikeys'].remove({})
+        self.api.get('/apikeys', token=token, status_code=200)
+
+        self.app.apikey_cache.clear()
+        self.api.get('/apikeys', token=token, status_code=401)
+
+    def test_no_session_lookup(self):
+        """Keys are remembered as tokens without session."""
+        key = self.new_object("apikeys", permissions={'apikeys': 'read'})
+        token = key['token']
+        self.api.get('/apikeys', token=token, status_code=200)
+        self.assertIs(self.app.session_cache.get(token), False)
+
+        # A session with the same token is not looked up
+        user = self.new_object('users')
+        self.db['sessions'].insert_one({'token': token, 'user': user['_id']})
+        self.api.get('/apikeys', token=token, status_code=200)
+        self.assertIs(self.app.session_cache.get(token), False)
+
+        self.app.session_cache.clear()
+        self.api.get('/apikeys', token=token, status_code=200)
+        self.assertEqual(self.app.session_cache.get(token)['user'],
+                         user['_id'])
+
+
 class ApiKeyModelTests(WebTestNoAuth):
     """Test that tokens are correctly generated and permissions validation."""
     def test_token_generation(self):
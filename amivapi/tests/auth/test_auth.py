@@ -6,6 +6,7 @@
 
 from base64 import b64encode
 from datetime import datetime, timedelta
+from time import monotonic, sleep
 
 from bson import ObjectId
 from flask import g
@@ -323,6 +324,68 @@ class AuthFunctionTest(FakeAuthTest):
                 self.assertGreater(g.current_session['_updated'],
                                    session['_updated'])
 
+    def test_session_touch_granularity(self):
+        """Test that timestamps are only written if older than granularity.
+
+        The writes are buffered and flushed in bulk after the request.
+        """
+        self.app.config['TOUCH_GRANULARITY'] = timedelta(minutes=5)
+        self.app.config['TOUCH_FLUSH_INTERVAL'] = timedelta(hours=1)
+        recent = datetime.utcnow().replace(microsecond=0)
+        old = recent - timedelta(minutes=10)
+        self.db['sessions'].insert([
+            {'user': ObjectId(24 * 'a'), 'token': 'recent', '_updated': recent},
+            {'user': ObjectId(24 * 'b'), 'token': 'old', '_updated': old},
+        ])
+
+        for token in 'recent', 'old':
+            with self.app.test_request_context(
+                    headers={'Authorization': token}):
+                authenticate()
+
+        # Nothing written yet, only buffered
+        old_session = self.db['sessions'].find_one({'token': 'old'})
+        self.assertEqual(old_session['_updated'], old)
+
+        with self.app.app_context():
+            self.app.touch_buffer.flush(self.db)
+
+        recent_session = self.db['sessions'].find_one({'token': 'recent'})
+        self.assertEqual(recent_session['_updated'], recent)
+        old_session = self.db['sessions'].find_one({'token': 'old'})
+        self.assertGreater(old_session['_updated'], old)
+
+        # Requests flush the buffer as well
+        self.app.config['TOUCH_FLUSH_INTERVAL'] = timedelta(0)
+        self.db['sessions'].update_one({'token': 'old'},
+                                       {'$set': {'_updated': old}})
+        self.app.session_cache.clear()
+        self.api.get('/', token='old', status_code=200)
+        self.assertTouched('old', old)
+
+    def test_idle_touch_flush(self):
+        """Test that buffered timestamps are written without new requests."""
+        self.app.config['TOUCH_GRANULARITY'] = timedelta(minutes=5)
+        self.app.config['TOUCH_FLUSH_INTERVAL'] = timedelta(milliseconds=50)
+        old = datetime.utcnow().replace(microsecond=0) - timedelta(minutes=10)
+        self.db['sessions'].insert({'user': ObjectId(24 * 'a'),
+                                    'token': 'old', '_updated': old})
+
+        with self.app.test_request_context(headers={'Authorization': 'old'}):
+            authenticate()
+
+        # No further request, the timer writes the timestamp
+        self.assertTouched('old', old)
+
+    def assertTouched(self, token, old, timeout=5):
+        """Wait until the timestamp of the session is newer than `old`."""
+        deadline = monotonic() + timeout
+        while (self.db['sessions'].find_one({'token': token})['_updated'] <=
+               old and monotonic() < deadline):
+            sleep(0.01)
+        session = self.db['sessions'].find_one({'token': token})
+        self.assertGreater(session['_updated'], old)
+
     def test_admin_rights_for_root(self):
         """Test that login with root sets `g.resource_admin` to True.
 
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the authorization context."""
+
+from flask import g
+
+from amivapi.auth.context import get_auth_context
+from amivapi.tests.utils import WebTestNoAuth
+
+
+class AuthContextTest(WebTestNoAuth):
+    """Test that the context contains the correct data."""
+
+    def test_context(self):
+        """Test all fields of the context."""
+        user = self.new_object('users', membership='regular')
+        other = self.new_object('users')
+        uid = str(user['_id'])
+        member_group = self.new_object('groups', moderator=str(other['_id']),
+                                       permissions={'users': 'read'})
+        moderated_group = self.new_object('groups', moderator=uid)
+        self.new_object('groupmemberships', user=uid,
+                        group=str(member_group['_id']))
+        event = self.new_object('events', moderator=uid)
+
+        with self.app.test_request_context():
+            context = get_auth_context(uid)
+
+            self.assertTrue(context.is_member)
+            self.assertEqual(context.member_groups, [member_group['_id']])
+            self.assertEqual(context.group_permissions, {'users': {'read'}})
+            self.assertEqual(context.moderated_groups,
+                             {moderated_group['_id']})
+            self.assertEqual(context.moderated_events, {event['_id']})
+            self.assertFalse(context.is_blacklisted)
+
+            # The context is kept for the request
+            self.assertIs(g.auth_context, context)
+            self.assertIs(get_auth_context(uid), context)
+
+    def test_no_user(self):
+        """Without user, the context is empty."""
+        with self.app.test_request_context():
+            context = get_auth_context(None)
+
+            self.assertFalse(context.is_member)
+            self.assertEqual(context.member_groups, [])
+            self.assertEqual(context.moderated_groups, set())
+            self.assertEqual(context.moderated_events, set())
+            self.assertFalse(context.is_blacklisted)
+
+    def test_blacklisted(self):
+        """Test that open blacklist entries are found."""
+        user = self.new_object('users')
+        self.new_object('blacklist', user=str(user['_id']), end_time=None)
+
+        with self.app.test_request_context():
+            self.assertTrue(get_auth_context(str(user['_id'])).is_blacklisted)
@@ -230,6 +230,34 @@ class LinkTest(FakeAuthTest):
             for item in data['_items']:
                 self.assertMethodsAdded(item)
 
+    def test_read_resource_checks_items_at_once(self):
+        """The write permission of all items is checked with one call."""
+        data = {
+            '_items': [
+                {'_id': 'A', '_links': {'self': {}}},
+                {'_id': 'B', '_links': {'self': {}}}
+            ],
+            '_links': {'self': {},
+                       'parent': {}}
+        }
+        auth = self.app.config['DOMAIN']['fake']['authentication']
+        calls = []
+
+        def has_item_write_permission_many(user_id, items):
+            calls.append([item['_id'] for item in items])
+            return [user_id == item['_id'] for item in items]
+        auth.has_item_write_permission_many = has_item_write_permission_many
+
+        with self._init_context(current_user='A'):
+            add_permitted_methods_after_fetch_resource('fake', data)
+
+        self.assertEqual(calls, [['A', 'B']])
+        item_a, item_b = data['_items']
+        self.assertItemsEqual(item_a['_links']['self']['methods'],
+                              self.admin_item_methods)
+        self.assertItemsEqual(item_b['_links']['self']['methods'],
+                              self.public_item_methods)
+
     def test_add_permitted_methods_after_insert(self):
         """Test insert.
 
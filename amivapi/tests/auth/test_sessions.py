@@ -4,11 +4,16 @@
 #          you to buy us beer if we meet and you like the software.
 """Tests for session."""
 
+from datetime import timedelta
+from unittest.mock import patch
+
 from bson import ObjectId
+from freezegun import freeze_time
 from passlib.context import CryptContext
 from passlib.hash import pbkdf2_sha256
 
-from amivapi.auth.sessions import verify_password
+from amivapi.auth.sessions import rehash_password, verify_password
+from amivapi.cron import run_scheduled_tasks
 from amivapi.tests.utils import WebTest
 
 
@@ -233,12 +238,9 @@ class PasswordVerificationTest(WebTest):
         """Test that verify_password rehashes password.
 
         This is supposed to happen if the security of the crypt context
-        is increased.
-
-        Needs request context because Eve requires this for "patch_internal"
-        which is used to updated the hash.
+        is increased. Outside of requests, the hash is updated immediately.
         """
-        with self.app.test_request_context():
+        with self.app.app_context():
             db = self.db['users']
             password = "some_pw"
             weak_hash = self._get_weak_hash(password)
@@ -271,7 +273,109 @@ class PasswordVerificationTest(WebTest):
             'password': password
         }
 
-        self.api.post("/sessions", data=login_data, status_code=201)
+        # The hash is updated once the response is closed
+        with patch('amivapi.auth.sessions.rehash_password') as rehash:
+            response = self.api.post("/sessions", data=login_data,
+                                     status_code=201)
+            rehash.assert_not_called()
+            response.close()
+            rehash.assert_called_once()
+
+        self.api.post("/sessions", data=login_data, status_code=201,
+                      buffered=True)
 
         # Check database
         self.assertRehashed(user_id, password, weak_hash)
+
+    def test_rehash_keeps_changed_password(self):
+        """Test that a password changed in the meantime is not overwritten."""
+        db = self.db['users']
+        weak_hash = self._get_weak_hash("old_pw")
+        user_id = db.insert({'password': weak_hash})
+        db.update_one({'_id': user_id},
+                      {'$set': {'password': pbkdf2_sha256.encrypt("new_pw")}})
+
+        with self.app.app_context():
+            rehash_password(user_id, weak_hash, "old_pw")
+
+        self.assertTrue(pbkdf2_sha256.verify(
+            "new_pw", db.find_one({'_id': user_id})['password']))
+
+    def test_rehash_updates_etag(self):
+        """Test that the rehash changes the etag, like any other update."""
+        user = self.new_object('users', password="some_pw")
+        weak_hash = self._get_weak_hash("some_pw")
+        self.db['users'].update_one({'_id': user['_id']},
+                                    {'$set': {'password': weak_hash}})
+        original = self.db['users'].find_one({'_id': user['_id']})
+
+        with self.app.app_context():
+            rehash_password(user['_id'], weak_hash, "some_pw")
+
+        updated = self.db['users'].find_one({'_id': user['_id']})
+        self.assertRehashed(user['_id'], "some_pw", weak_hash)
+        self.assertNotEqual(updated['_etag'], original['_etag'])
+        self.assertGreaterEqual(updated['_updated'], original['_updated'])
+
+
+class SessionCacheTest(WebTest):
+    """Test that sessions are cached and the cache is invalidated."""
+
+    def test_cached_session_is_used(self):
+        """After the first request, the session is not looked up again."""
+        user = self.new_object('users')
+        token = self.get_user_token(user['_id'])
+
+        self.api.get("/users/%s" % user['_id'], token=token, status_code=200)
+
+        # Remove the session behind the back of the API, cache is still used
+        self.db['sessions'].remove({'token': token})
+        self.api.get("/users/%s" % user['_id'], token=token, status_code=200)
+
+        with self.app.app_context():
+            self.app.session_cache.clear()
+        self.api.get("/users/%s" % user['_id'], token=token, status_code=401)
+
+    def test_polled_session_expires_from_cache(self):
+        """Frequent requests don't keep a session in the cache forever."""
+        user = self.new_object('users')
+        token = self.get_user_token(user['_id'])
+        url = "/users/%s" % user['_id']
+        ttl = self.app.config['SESSION_CACHE_TTL'].total_seconds()
+
+        with patch('amivapi.utils.monotonic') as monotonic:
+            monotonic.return_value = 0
+            self.api.get(url, token=token, status_code=200)
+            self.db['sessions'].remove({'token': token})
+
+            # Poll the whole time, the session is cached until the TTL ends
+            for second in range(int(ttl)):
+                monotonic.return_value = second
+                self.api.get(url, token=token, status_code=200)
+
+            monotonic.return_value = ttl + 1
+            self.api.get(url, token=token, status_code=401)
+
+    def test_cache_disabled(self):
+        """Without cache size, every request looks up the session."""
+        self.app.session_cache.maxsize = 0
+        user = self.new_object('users')
+        token = self.get_user_token(user['_id'])
+
+        self.api.get("/users/%s" % user['_id'], token=token, status_code=200)
+        self.db['sessions'].remove({'token': token})
+        self.api.get("/users/%s" % user['_id'], token=token, status_code=401)
+
+    def test_expired_sessions_are_removed_from_cache(self):
+        """Sessions deleted by the cron job are removed from the cache."""
+        with self.app.app_context(), freeze_time() as frozen_time:
+            user = self.new_object('users')
+            token = self.get_user_token(user['_id'])
+            url = "/users/%s" % user['_id']
+            self.api.get(url, token=token, status_code=200)
+
+            frozen_time.tick(delta=self.app.config['SESSION_TIMEOUT'] +
+                             timedelta(days=1))
+            run_scheduled_tasks()
+
+            self.api.get(url, token=token, status_code=401)
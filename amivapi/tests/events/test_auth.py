@@ -313,3 +313,42 @@ class EventAuthTest(WebTest):
         print("/eventsignups/" + str(signup['_id']))
         self.api.delete("/eventsignups/" + str(signup['_id']),
                         headers=etag, token=moderator_token, status_code=403)
+
+    def test_signup_list_link_methods(self):
+        """Test that the signup listing shows write methods per signup."""
+        t_open = datetime(2016, 1, 1)
+        t_close = datetime(2016, 12, 31)
+
+        user = self.new_object("users")
+        other = self.new_object("users")
+        token = self.get_user_token(user['_id'])
+
+        open_event = self.new_object("events", spots=100,
+                                     time_register_start=t_open,
+                                     time_register_end=t_close)
+        closed_event = self.new_object("events", spots=100,
+                                       time_register_start=t_open,
+                                       time_register_end=datetime(2016, 2,
+                                                                  1))
+        moderated_event = self.new_object("events", spots=100,
+                                          moderator=user['_id'],
+                                          time_register_start=t_open,
+                                          time_register_end=t_close)
+
+        writable = self.new_object("eventsignups", event=open_event['_id'],
+                                   user=user['_id'])
+        closed = self.new_object("eventsignups", event=closed_event['_id'],
+                                 user=user['_id'])
+        foreign = self.new_object("eventsignups",
+                                  event=moderated_event['_id'],
+                                  user=other['_id'])
+
+        with freeze_time(datetime(2016, 6, 1)):
+            items = self.api.get("/eventsignups", token=token,
+                                 status_code=200).json['_items']
+
+        methods = {item['_id']: item['_links']['self']['methods']
+                   for item in items}
+        self.assertIn('DELETE', methods[str(writable['_id'])])
+        self.assertNotIn('DELETE', methods[str(closed['_id'])])
+        self.assertNotIn('DELETE', methods[str(foreign['_id'])])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Test stored signup counters of events."""
+
+import json
+from datetime import datetime
+from unittest.mock import patch
+
+from bson import ObjectId
+
+from amivapi.events.counters import (
+    rebuild_counters,
+    release_spot,
+    reserve_spot,
+)
+from amivapi.events.queue import update_waiting_list
+from amivapi.tests.utils import WebTestNoAuth
+
+
+class SignupCounterTest(WebTestNoAuth):
+    """Test that counters are maintained if enabled."""
+
+    def setUp(self):
+        """Enable counters."""
+        super().setUp(EVENT_SIGNUP_COUNTERS=True)
+
+    def assertCounters(self, event, signup_count, unaccepted_count):
+        """Check the counters in the database."""
+        stored = self.db['events'].find_one({'_id': event['_id']})
+        self.assertEqual(stored['signup_count'], signup_count)
+        self.assertEqual(stored['unaccepted_count'], unaccepted_count)
+
+    def signup(self, event):
+        """Sign up a new user."""
+        user = self.new_object('users')
+        return self.api.post('/eventsignups', data={
+            'event': str(event['_id']),
+            'user': str(user['_id'])
+        }, status_code=201).json
+
+    def test_counters_maintained(self):
+        """Test insert, accept and delete of signups."""
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        self.assertCounters(event, 0, 0)
+
+        first = self.signup(event)
+        self.assertCounters(event, 1, 0)
+        self.signup(event)
+        self.assertCounters(event, 1, 1)
+
+        # Deleting the accepted signup accepts the waiting one
+        self.api.delete('/eventsignups/%s' % first['_id'],
+                        headers={'If-Match': first['_etag']},
+                        status_code=204)
+        self.assertCounters(event, 1, 0)
+
+        # The counters are returned without counting
+        fetched = self.api.get('/events/%s' % event['_id'],
+                               status_code=200).json
+        self.assertEqual(fetched['signup_count'], 1)
+        self.assertEqual(fetched['unaccepted_count'], 0)
+
+    def test_manual_acceptance(self):
+        """Test that admins accepting signups update the counters."""
+        event = self.new_object('events', spots=10,
+                                selection_strategy='manual')
+        signup = self.signup(event)
+        self.assertCounters(event, 0, 1)
+
+        self.api.patch('/eventsignups/%s' % signup['_id'],
+                       data={'accepted': True},
+                       headers={'If-Match': signup['_etag']},
+                       status_code=200)
+        self.assertCounters(event, 1, 0)
+
+    def test_filter_and_sort(self):
+        """Test that counters can be used in queries."""
+        empty = self.new_object('events', spots=10)
+        full = self.new_object('events', spots=10,
+                               selection_strategy='fcfs')
+        self.signup(full)
+
+        where = json.dumps({'signup_count': {'$gt': 0}})
+        events = self.api.get('/events?where=%s' % where,
+                              status_code=200).json['_items']
+        self.assertEqual([item['_id'] for item in events], [str(full['_id'])])
+
+        events = self.api.get('/events?sort=signup_count',
+                              status_code=200).json['_items']
+        self.assertEqual([item['_id'] for item in events],
+                         [str(empty['_id']), str(full['_id'])])
+
+    def test_rebuild(self):
+        """Test that wrong or missing counters are fixed."""
+        event = self.new_object('events', spots=10,
+                                selection_strategy='fcfs')
+        other = self.new_object('events', spots=10)
+        self.signup(event)
+        self.signup(event)
+
+        self.db['events'].update_one({'_id': event['_id']},
+                                     {'$set': {'signup_count': 5}})
+        self.db['events'].update_one(
+            {'_id': other['_id']},
+            {'$unset': {'signup_count': '', 'unaccepted_count': ''}})
+
+        with self.app.app_context():
+            self.assertEqual(rebuild_counters(), 2)
+            self.assertEqual(rebuild_counters(), 0)
+
+        self.assertCounters(event, 2, 0)
+        self.assertCounters(other, 0, 0)
+
+    def test_reserved_spots_are_respected(self):
+        """Test that no more signups are accepted than spots are free.
+
+        Concurrent requests only see the counters, so a counter which is
+        already at the limit must prevent acceptance.
+        """
+        event = self.new_object('events', spots=2, selection_strategy='fcfs')
+        first = self.signup(event)
+        self.assertTrue(first['accepted'])
+
+        # Another request has reserved the last spot in the meantime
+        self.db['events'].update_one({'_id': event['_id']},
+                                     {'$inc': {'signup_count': 1}})
+        second = self.signup(event)
+        self.assertFalse(second['accepted'])
+        self.assertCounters(event, 2, 1)
+
+        with self.app.app_context():
+            self.assertEqual(update_waiting_list(event['_id']), [])
+
+        # The other request gives back its spot, the waiting signup is
+        # accepted exactly once
+        self.db['events'].update_one({'_id': event['_id']},
+                                     {'$inc': {'signup_count': -1}})
+        with self.app.test_request_context():
+            accepted = update_waiting_list(event['_id'])
+            self.assertEqual(accepted, [ObjectId(second['_id'])])
+            self.assertEqual(update_waiting_list(event['_id']), [])
+        self.assertCounters(event, 2, 0)
+
+    def test_signup_while_spot_reserved(self):
+        """Test that a signup is accepted if it was added while another
+        request held the free spot without anybody to accept."""
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        user = self.new_object('users')
+        inserted = []
+
+        def concurrent_signup(event_id):
+            # Another request inserts a signup, but can't reserve the spot
+            if not inserted:
+                inserted.append(self.db['eventsignups'].insert_one({
+                    'event': event_id,
+                    'user': user['_id'],
+                    'accepted': False,
+                    'confirmed': True,
+                    '_created': datetime.utcnow(),
+                }).inserted_id)
+                self.db['events'].update_one(
+                    {'_id': event_id}, {'$inc': {'unaccepted_count': 1}})
+                self.assertFalse(reserve_spot(event_id))
+            release_spot(event_id)
+
+        with self.app.test_request_context(), \
+                patch('amivapi.events.queue.release_spot',
+                      side_effect=concurrent_signup):
+            self.assertEqual(update_waiting_list(event['_id']), inserted)
+
+        self.assertTrue(
+            self.db['eventsignups'].find_one({'_id': inserted[0]})['accepted'])
+        self.assertCounters(event, 1, 0)
@@ -63,6 +63,25 @@ class EventProjectionTest(WebTestNoAuth):
         self.assertEqual(event['signup_count'], 100)
         self.assertEqual(event['unaccepted_count'], 1)
 
+    def test_signup_count_projected_for_each_event(self):
+        """Test that every event in a listing gets its own counts"""
+        full = self.new_object('events', spots=2, selection_strategy='fcfs')
+        empty = self.new_object('events', spots=2)
+
+        for _ in range(3):
+            user = self.new_object('users')
+            self.api.post('/eventsignups', data={
+                'event': str(full['_id']),
+                'user': str(user['_id'])
+            }, status_code=201)
+
+        events = self.api.get('/events', status_code=200).json['_items']
+        counts = {event['_id']: (event['signup_count'],
+                                 event['unaccepted_count'])
+                  for event in events}
+        self.assertEqual(counts, {str(full['_id']): (2, 1),
+                                  str(empty['_id']): (0, 0)})
+
     def test_waitinglist_position_projection(self):
         """Test that waiting list position is correctly inserted into a
         signup information"""
@@ -105,6 +124,48 @@ class EventProjectionTest(WebTestNoAuth):
             self.assertEqual(event['signup_count'], 3)
             self.assertEqual(event['unaccepted_count'], 1)
 
+    def test_position_projection_same_second(self):
+        """Test that signups created in the same second get distinct
+        positions in the order of their creation"""
+        with freeze_time("2016-01-01 00:00:00"):
+            event = self.new_object('events', spots=1,
+                                    selection_strategy='fcfs')
+            other_event = self.new_object('events', spots=1,
+                                          selection_strategy='fcfs')
+
+            signups = []
+            for _ in range(4):
+                user = self.new_object('users')
+                signups.append(self.api.post('/eventsignups', data={
+                    'event': str(event['_id']),
+                    'user': str(user['_id'])
+                }, status_code=201).json)
+            other = self.api.post('/eventsignups', data={
+                'event': str(other_event['_id']),
+                'user': str(user['_id'])
+            }, status_code=201).json
+
+            # Only the first signup was accepted
+            self.assertEqual([signup['accepted'] for signup in signups],
+                             [True, False, False, False])
+
+            # Positions in listing
+            items = self.api.get('/eventsignups',
+                                 status_code=200).json['_items']
+            positions = {item['_id']: item['position'] for item in items}
+            self.assertEqual(positions, {
+                signups[0]['_id']: 1,
+                signups[1]['_id']: 2,
+                signups[2]['_id']: 3,
+                signups[3]['_id']: 4,
+                other['_id']: 1,
+            })
+
+            # Position of a single item
+            signup = self.api.get('/eventsignups/%s' % signups[2]['_id'],
+                                  status_code=200).json
+            self.assertEqual(signup['position'], 3)
+
     def test_signup_email_correct(self):
         """Test that signups display the correct email address"""
         event = self.new_object('events', spots=100)
@@ -124,6 +185,28 @@ class EventProjectionTest(WebTestNoAuth):
                               status_code=200).json
         self.assertEqual(signup['email'], 'testemail@amiv.com')
 
+    def test_signup_emails_in_collection(self):
+        """Test that every signup in a listing gets the email of its user"""
+        event = self.new_object('events', spots=100,
+                                allow_email_signup=True)
+        emails = ['first@amiv.com', 'second@amiv.com']
+        for email in emails:
+            user = self.new_object('users', email=email)
+            self.api.post('/eventsignups', data={
+                'user': str(user['_id']),
+                'event': str(event['_id'])
+            }, status_code=201)
+        self.api.post('/eventsignups', data={
+            'email': 'external@amiv.com',
+            'event': str(event['_id'])
+        }, status_code=201)
+
+        for query in ['', '?embedded={"user":1}']:
+            signups = self.api.get('/eventsignups' + query,
+                                   status_code=200).json['_items']
+            self.assertItemsEqual([signup['email'] for signup in signups],
+                                  emails + ['external@amiv.com'])
+
     def test_confirmed_projected(self):
         """Test that an external signups gets the confirmed field"""
         event = self.new_object('events', spots=100, additional_fields=None,
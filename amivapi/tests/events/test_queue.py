@@ -4,7 +4,12 @@
 #          you to buy us beer if we meet and you like the software.
 """Test that people are correctly added and removed from the waiting list"""
 
+from bson import ObjectId
+from eve.methods.delete import delete
+
+from amivapi.events.queue import update_waiting_list
 from amivapi.tests.utils import WebTestNoAuth
+from amivapi.utils import admin_permissions
 
 
 class EventsignupQueueTest(WebTestNoAuth):
@@ -95,3 +100,53 @@ class EventsignupQueueTest(WebTestNoAuth):
         self.api.delete('/eventsignups/%s' % signup2['_id'],
                         headers={'If-Match': signup2['_etag']},
                         status_code=204)
+
+    def test_more_spots_accept_waiting_list(self):
+        """Test that adding spots to an event accepts the waiting list."""
+        event = self.new_object('events', spots=1, selection_strategy='fcfs')
+        emails = ['user%i@amiv.com' % i for i in range(4)]
+        users = [self.new_object('users', email=email) for email in emails]
+        signups = [self.api.post('/eventsignups', data={
+            'user': str(user['_id']),
+            'event': str(event['_id'])
+        }, status_code=201).json for user in users]
+        self.assertEqual([signup['accepted'] for signup in signups],
+                         [True, False, False, False])
+
+        mails_before = len(self.app.test_mails)
+        self.api.patch('/events/%s' % event['_id'], data={'spots': 3},
+                       headers={'If-Match': event['_etag']},
+                       status_code=200)
+
+        accepted = [self.db['eventsignups'].find_one(
+            {'_id': ObjectId(signup['_id'])})['accepted']
+            for signup in signups]
+        self.assertEqual(accepted, [True, True, True, False])
+
+        # The accepted users are notified
+        mails = self.app.test_mails[mails_before:]
+        self.assertItemsEqual([mail['receivers'] for mail in mails],
+                              emails[1:3])
+
+    def test_sequence_removed_with_event(self):
+        """Test that the signup numbering is removed with the event."""
+        events = [self.new_object('events', spots=3) for _ in range(2)]
+        for event in events:
+            self.new_object('eventsignups', event=event['_id'])
+        sequences = self.db['eventsignup_sequences']
+        self.assertEqual(sequences.count_documents({}), 2)
+
+        self.api.delete('/events/%s' % events[0]['_id'],
+                        headers={'If-Match': events[0]['_etag']},
+                        status_code=204)
+        self.assertEqual(sequences.count_documents({}), 1)
+
+        # Delete all events, there is no endpoint for this
+        with self.app.test_request_context(), admin_permissions():
+            delete('events')
+        self.assertEqual(sequences.count_documents({}), 0)
+
+    def test_deleted_event_does_not_crash(self):
+        """Test that the waiting list ignores deleted events."""
+        with self.app.app_context():
+            self.assertEqual(update_waiting_list(ObjectId()), [])
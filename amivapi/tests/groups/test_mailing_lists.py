@@ -9,17 +9,26 @@ To run integration tests for remote files, you need to set some environment
 variables (see below)
 """
 
-from os import getenv
+from os import chmod, getenv, listdir
 from os.path import isfile, join
 from shutil import rmtree
 from tempfile import mkdtemp
 
-from unittest.mock import patch, call
+from unittest.mock import patch
+
+from bson import ObjectId
 
 from amivapi.tests.utils import WebTestNoAuth, skip_if_false
 
 from amivapi.groups.mailing_lists import (
-    make_files, remove_files, ssh_command, ssh_create, ssh_remove)
+    make_files,
+    make_files_for_groups,
+    remove_files,
+    retry_changes,
+    ssh_command,
+    ssh_create,
+    ssh_remove
+)
 
 
 class MailingListTest(WebTestNoAuth):
@@ -163,6 +172,54 @@ class MailingListTest(WebTestNoAuth):
 
         self.assertFileContent('a', ['new@amiv.ch'])
 
+    def test_files_created_once_per_request(self):
+        """Test that adding many members recreates the files only once."""
+        self._add_user_and_group()
+        data = [{'user': 24 * '0', 'group': 24 * '2'},
+                {'user': 24 * '1', 'group': 24 * '2'}]
+
+        with patch('amivapi.groups.mailing_lists.make_files_for_groups',
+                   wraps=make_files_for_groups) as patched:
+            self.api.post('/groupmemberships', data=data, status_code=201)
+            patched.assert_called_once_with({ObjectId(24 * '2')},
+                                            removed=set())
+
+    def test_failed_files_are_retried(self):
+        """Test that groups are retried by cron if the files can't be
+        written."""
+        self._add_user_and_group()
+        failure = OSError('Disk full')
+
+        with patch('amivapi.groups.mailing_lists.write_files',
+                   side_effect=failure):
+            self.api.post('/groupmemberships',
+                          data={'user': 24 * '0', 'group': 24 * '2'},
+                          status_code=201)
+        self.assertFileContent('a', ['b@amiv.ch'])
+        self.assertEqual(
+            self.db['mailing_list_dirty'].count_documents({}), 1)
+
+        with self.app.app_context():
+            retry_changes()
+
+        self.assertFileContent('a', ['user@amiv.ch', 'b@amiv.ch'])
+        self.assertEqual(
+            self.db['mailing_list_dirty'].count_documents({}), 0)
+
+    def test_unchanged_file_not_written(self):
+        """Test that files are only written if the content changes."""
+        self._add_user_and_group()
+
+        with patch('amivapi.groups.mailing_lists.open',
+                   side_effect=open, create=True) as patched, \
+                self.app.app_context():
+            make_files(24 * '2')
+            # Only read, not written
+            patched.assert_called_once_with(self._full_name('a'), 'r')
+
+            make_files(24 * '2', force=True)
+            patched.assert_called_with(self._full_name('a'), 'w')
+
 
 class RemoteMailingListTest(WebTestNoAuth):
     """Test creation and removal of remote mailing list files via ssh.
@@ -181,31 +238,122 @@ class RemoteMailingListTest(WebTestNoAuth):
         self.app.config['REMOTE_MAILING_LIST_ADDRESS'] = 'not none!'
 
     def test_remote_create_called(self):
-        """Test that creating the file over ssh is attempted."""
-        with patch('amivapi.groups.mailing_lists.ssh_create') as create:
+        """Test that creating the files over ssh is attempted."""
+        with patch('amivapi.groups.mailing_lists.ssh_upload') as upload:
             group_id = 24 * '0'
             receive_from = ['a', 'b']
             self.load_fixture({
                 'groups': [{'_id': group_id, 'receive_from': receive_from}]
             })
+            # Both files in one upload, there will be no content
+            upload.assert_called_once_with({'a': '', 'b': ''})
+
+    def test_remote_unchanged_skipped(self):
+        """Test that unchanged files are not uploaded again."""
+        with patch('amivapi.groups.mailing_lists.ssh_upload') as upload:
+            group_id = 24 * '0'
+            self.load_fixture({
+                'groups': [{'_id': group_id, 'receive_from': ['a']}]
+            })
+            upload.reset_mock()
+
             with self.app.app_context():
                 make_files(group_id)
-                # Both times there will be no content
-                create.assert_has_calls(
-                    [call(address, '') for address in receive_from],
-                    any_order=True
-                )
+                upload.assert_not_called()
+
+                # The content changes
+                self.db['groups'].update_one(
+                    {'_id': ObjectId(group_id)},
+                    {'$set': {'forward_to': ['new@amiv.ch']}})
+                make_files(group_id)
+                upload.assert_called_once_with({'a': 'new@amiv.ch\n'})
 
     def test_remote_remove_called(self):
-        """Test that removing the file over ssh is attempted."""
+        """Test that removing the files over ssh is attempted."""
         addresses = ['a', 'b']
-        with patch('amivapi.groups.mailing_lists.ssh_remove') as remove:
+        with patch('amivapi.groups.mailing_lists.ssh_upload') as upload:
             with self.app.app_context():
                 remove_files(addresses)
-                remove.assert_has_calls(
-                    [call(address) for address in addresses],
-                    any_order=True
-                )
+                upload.assert_called_once_with({}, removed={'a', 'b'})
+
+
+# Replaces ssh: ignores all options and the address and runs the command
+# locally. Every call is logged to count the connections.
+FAKE_SSH = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/calls"
+while [ $# -gt 1 ]; do shift; done
+exec sh -c "$1"
+"""
+
+
+class FakeSSHTest(WebTestNoAuth):
+    """Test remote files with a local stand-in for ssh."""
+
+    def setUp(self):
+        """Install the stand-in and use a temporary 'remote' directory."""
+        super().setUp()
+        self.base_dir = mkdtemp(prefix='amivapi_test')
+        fake_ssh = join(self.base_dir, 'ssh')
+        with open(fake_ssh, 'w') as file:
+            file.write(FAKE_SSH)
+        chmod(fake_ssh, 0o755)
+
+        self.remote_dir = join(self.base_dir, 'remote')
+        self.app.config.update({
+            'REMOTE_MAILING_LIST_ADDRESS': 'user@remote',
+            'REMOTE_MAILING_LIST_DIR': self.remote_dir,
+            'REMOTE_MAILING_LIST_SSH': fake_ssh,
+        })
+
+    def tearDown(self):
+        """Remove temporary directory."""
+        rmtree(self.base_dir, ignore_errors=True)
+        super().tearDown()
+
+    def count_connections(self):
+        """Number of times ssh was called."""
+        try:
+            with open(join(self.base_dir, 'calls')) as file:
+                return len(file.readlines())
+        except OSError:
+            return 0
+
+    def test_single_connection(self):
+        """Test that all files of a request are uploaded at once."""
+        data = [{'name': 'first', 'receive_from': ['a', 'b'],
+                 'forward_to': ['c@amiv.ch']},
+                {'name': 'second', 'receive_from': ['d'],
+                 'forward_to': ['e@amiv.ch']}]
+        self.api.post('/groups', data=data, status_code=201)
+
+        self.assertEqual(self.count_connections(), 1)
+        prefix = self.app.config['MAILING_LIST_FILE_PREFIX']
+        # No temporary files are left
+        self.assertItemsEqual(listdir(self.remote_dir),
+                              [prefix + name for name in 'abd'])
+        with open(join(self.remote_dir, prefix + 'd')) as file:
+            self.assertEqual(file.read(), 'e@amiv.ch\n')
+
+        # Nothing to upload if nothing changed
+        with self.app.app_context():
+            make_files_for_groups(
+                [item['_id'] for item in self.db['groups'].find()])
+        self.assertEqual(self.count_connections(), 1)
+
+    def test_removal_in_same_connection(self):
+        """Test that removed addresses are handled with the upload."""
+        group = self.new_object('groups', receive_from=['a', 'b'],
+                                forward_to=['c@amiv.ch'])
+        self.assertEqual(self.count_connections(), 1)
+
+        self.api.patch('/groups/' + str(group['_id']),
+                       headers={'If-Match': group['_etag']},
+                       data={'receive_from': ['b', 'd']}, status_code=200)
+
+        self.assertEqual(self.count_connections(), 2)
+        prefix = self.app.config['MAILING_LIST_FILE_PREFIX']
+        self.assertItemsEqual(listdir(self.remote_dir),
+                              [prefix + name for name in 'bd'])
 
 
 # Decorator to mark tests to be skipped if ssh envvars are missing.
@@ -7,9 +7,13 @@
 Since this hook will be added for all requests (the after auth hook) and this
 is tested for auth.py we only get get on resource level to test functionality.
 """
+from datetime import timedelta
+
+from eve.methods.patch import patch_internal
 from flask import g
 
 from amivapi.tests.utils import WebTest
+from amivapi.utils import admin_permissions
 
 
 class PermissionsTest(WebTest):
@@ -60,3 +64,66 @@ class PermissionsTest(WebTest):
         """Test that 'readwrite' gives admin permissions."""
         self.permission_fixture({'groups': 'read'})
         self.assertAdminReadonly()
+
+
+class PermissionsCacheTest(WebTest):
+    """Test that cached permissions are discarded if groups change."""
+
+    def setUp(self):
+        """Enable the permission cache."""
+        super().setUp(GROUP_PERMISSIONS_CACHE_TTL=timedelta(minutes=1))
+
+    def test_membership_changes(self):
+        """Permissions are granted and revoked with memberships."""
+        user = self.new_object('users')
+        group = self.new_object('groups', permissions={'apikeys': 'read'})
+        token = self.get_user_token(user['_id'])
+        root = self.get_root_token()
+
+        self.api.get('/apikeys', token=token, status_code=403)
+
+        membership = self.api.post('/groupmemberships', data={
+            'user': str(user['_id']),
+            'group': str(group['_id'])
+        }, token=root, status_code=201).json
+        self.api.get('/apikeys', token=token, status_code=200)
+
+        self.api.delete('/groupmemberships/%s' % membership['_id'],
+                        headers={'If-Match': membership['_etag']},
+                        token=root, status_code=204)
+        self.api.get('/apikeys', token=token, status_code=403)
+
+    def test_membership_updates(self):
+        """Permissions change if a membership is moved to another group."""
+        user = self.new_object('users')
+        group = self.new_object('groups', permissions={'apikeys': 'read'})
+        other_group = self.new_object('groups')
+        membership = self.new_object('groupmemberships',
+                                     user=str(user['_id']),
+                                     group=str(group['_id']))
+        token = self.get_user_token(user['_id'])
+
+        self.api.get('/apikeys', token=token, status_code=200)
+
+        # There is no endpoint to patch memberships
+        with self.app.test_request_context(), admin_permissions():
+            patch_internal('groupmemberships',
+                           {'group': other_group['_id']},
+                           _id=membership['_id'])
+        self.api.get('/apikeys', token=token, status_code=403)
+
+    def test_group_changes(self):
+        """Permissions are updated if the group permissions change."""
+        user = self.new_object('users')
+        group = self.new_object('groups', permissions={'apikeys': 'read'})
+        self.new_object('groupmemberships', user=str(user['_id']),
+                        group=str(group['_id']))
+        token = self.get_user_token(user['_id'])
+
+        self.api.get('/apikeys', token=token, status_code=200)
+
+        self.api.patch('/groups/%s' % group['_id'],
+                       data={'permissions': {'users': 'read'}},
+                       headers={'If-Match': group['_etag']},
+                       token=self.get_root_token(), status_code=200)
+        self.api.get('/apikeys', token=token, status_code=403)
@@ -4,9 +4,16 @@
 #          you to buy us beer if we meet and you like the software.
 """Test for cascading deletes"""
 
+from datetime import datetime
+from unittest.mock import patch
+
 from bson import ObjectId
+from eve.methods.delete import delete
+from freezegun import freeze_time
 
+from amivapi.cascade import get_relations, process_cascade_queue
 from amivapi.tests.utils import WebTestNoAuth
+from amivapi.utils import admin_permissions
 
 
 class CascadingDeleteTest(WebTestNoAuth):
@@ -51,3 +58,159 @@ class CascadingDeleteTest(WebTestNoAuth):
         sessions = self.db['sessions'].find({
             'user': ObjectId('deadbeefdeadbeefdeadbeef')})
         self.assertEqual(sessions.count(), 0)
+
+    def test_relations_are_precomputed(self):
+        """Test that the schema is not searched for every delete."""
+        with self.app.app_context():
+            self.assertIn(('sessions', 'user', True), get_relations('users'))
+
+            with patch('amivapi.cascade.build_relations') as build:
+                get_relations('users')
+                build.assert_not_called()
+
+    def test_relations_rebuilt_for_new_resource(self):
+        """Test that resources registered later are found as well."""
+        self.app.register_resource('notes', {'schema': {
+            'user': {'type': 'objectid',
+                     'data_relation': {'resource': 'users',
+                                       'cascade_delete': True}},
+        }})
+
+        with self.app.app_context():
+            self.assertIn(('notes', 'user', True), get_relations('users'))
+
+    def test_all_references_are_handled(self):
+        """Test that all referencing objects are deleted or updated."""
+        user = self.new_object('users')
+        other = self.new_object('users')
+        self.db['sessions'].insert_many(
+            [{'user': user['_id'], 'token': str(i)} for i in range(3)] +
+            [{'user': other['_id'], 'token': 'other'}])
+        group = self.new_object('groups', moderator=user['_id'])
+        self.new_object('groupmemberships', user=user['_id'],
+                        group=group['_id'])
+        beverage = self.new_object('beverages', user=user['_id'])
+
+        with patch.object(self.app.session_cache, 'pop') as invalidate:
+            self.api.delete('/users/%s' % user['_id'],
+                            headers={'If-Match': user['_etag']},
+                            status_code=204)
+            # Hooks of the referencing resource are called for every item
+            self.assertEqual(invalidate.call_count, 3)
+
+        self.assertEqual(
+            self.db['sessions'].count_documents({'user': user['_id']}), 0)
+        self.assertEqual(self.db['sessions'].count_documents({}), 1)
+        self.assertEqual(self.db['groupmemberships'].count_documents({}), 0)
+
+        # The reference is removed with a new etag
+        updated = self.db['groups'].find_one({'_id': group['_id']})
+        self.assertIsNone(updated['moderator'])
+        self.assertNotEqual(updated['_etag'], group['_etag'])
+
+        # Not nullable references are kept
+        self.assertEqual(
+            self.db['beverages'].find_one({'_id': beverage['_id']})['user'],
+            user['_id'])
+
+    def test_nested_cascade(self):
+        """Test that deletes cascade through several resources."""
+        self.app.register_resource('notes', {'schema': {
+            'session': {'type': 'objectid',
+                        'data_relation': {'resource': 'sessions',
+                                          'cascade_delete': True}},
+        }})
+        user = self.new_object('users')
+        session = self.db['sessions'].insert_one(
+            {'user': user['_id'], 'token': 'token'}).inserted_id
+        self.db['notes'].insert_many([{'session': session},
+                                      {'session': session}])
+
+        self.api.delete('/users/%s' % user['_id'],
+                        headers={'If-Match': user['_etag']},
+                        status_code=204)
+
+        self.assertEqual(self.db['notes'].count_documents({}), 0)
+
+    def test_references_removed_without_etags(self):
+        """Test that references are removed if etags are disabled."""
+        self.app.register_resource('notes', {'schema': {
+            'user': {'type': 'objectid', 'nullable': True,
+                     'data_relation': {'resource': 'users'}},
+        }})
+        user = self.new_object('users')
+        note = self.db['notes'].insert_one({'user': user['_id']}).inserted_id
+        self.app.config['IF_MATCH'] = False
+
+        self.api.delete('/users/%s' % user['_id'], status_code=204)
+
+        updated = self.db['notes'].find_one({'_id': note})
+        self.assertIsNone(updated['user'])
+        self.assertNotIn('_etag', updated)
+
+    def delete_groups(self):
+        """Delete all groups with memberships, like DELETE /groups."""
+        for _ in range(2):
+            group = self.new_object('groups')
+            self.new_object('groupmemberships', group=group['_id'])
+
+        with self.app.test_request_context(), admin_permissions():
+            delete('groups')
+
+    def test_collection_delete_cascades(self):
+        """Test that deleting all objects of a resource cascades."""
+        self.delete_groups()
+        self.assertEqual(self.db['groupmemberships'].count_documents({}), 0)
+
+    def test_collection_delete_queued(self):
+        """Test that the cascade is processed later if queued."""
+        self.app.config['CASCADE_QUEUE'] = True
+        self.delete_groups()
+
+        self.assertEqual(self.db['groupmemberships'].count_documents({}), 2)
+        self.assertEqual(self.db['cascade_queue'].count_documents({}), 1)
+
+        with self.app.app_context():
+            self.assertEqual(process_cascade_queue(), 1)
+
+        self.assertEqual(self.db['groupmemberships'].count_documents({}), 0)
+        self.assertEqual(self.db['cascade_queue'].count_documents({}), 0)
+
+    def test_failed_cascade_is_retried(self):
+        """Test that queued cascades are retried after the lease."""
+        self.app.config['CASCADE_QUEUE'] = True
+        self.delete_groups()
+
+        with freeze_time(datetime.utcnow()) as frozen_time:
+            with patch('amivapi.cascade._cascade', side_effect=Exception), \
+                    self.app.app_context():
+                self.assertEqual(process_cascade_queue(), 0)
+
+            # Not retried before the lease is over
+            with self.app.app_context():
+                self.assertEqual(process_cascade_queue(), 0)
+
+            frozen_time.tick(delta=self.app.config['CASCADE_QUEUE_LEASE'])
+            with self.app.app_context():
+                self.assertEqual(process_cascade_queue(), 1)
+
+        self.assertEqual(self.db['groupmemberships'].count_documents({}), 0)
+
+    def test_failed_cascade_is_parked(self):
+        """Test that queued cascades are not retried after the last attempt."""
+        self.app.config['CASCADE_QUEUE'] = True
+        self.app.config['CASCADE_MAX_ATTEMPTS'] = 2
+        self.delete_groups()
+
+        with freeze_time(datetime.utcnow()) as frozen_time, \
+                patch('amivapi.cascade._cascade',
+                      side_effect=Exception('Broken')), \
+                self.app.app_context():
+            for _ in range(3):
+                self.assertEqual(process_cascade_queue(), 0)
+                frozen_time.tick(delta=self.app.config['CASCADE_QUEUE_LEASE'])
+
+        entry = self.db['cascade_queue'].find_one()
+        self.assertEqual(entry['attempts'], 2)
+        self.assertEqual(entry['error'], 'Broken')
+        self.assertNotIn('next_attempt', entry)
@@ -7,10 +7,14 @@
 """ Test scheduler """
 
 from datetime import datetime, timedelta
+import pickle
+
+from bson import ObjectId
 from freezegun import freeze_time
 
 from amivapi import cron
 from amivapi.cron import (
+    migrate_tasks,
     NotSchedulable,
     periodic,
     run_scheduled_tasks,
@@ -19,7 +23,7 @@ from amivapi.cron import (
     schedule_task,
     update_scheduled_task
 )
-from amivapi.tests.utils import WebTestNoAuth
+from amivapi.tests.utils import WebTest, WebTestNoAuth
 
 
 class CronTest(WebTestNoAuth):
@@ -139,3 +143,230 @@ class CronTest(WebTestNoAuth):
 
             self.assertTrue(CronTest.has_run)
             self.assertEqual(CronTest.received_arg, "new-arg")
+
+    def test_failed_task_is_retried(self):
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def failing():
+                CronTest.run_count += 1
+                raise ValueError("Task failed")
+
+            schedule_task(datetime.utcnow(), failing)
+
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+            # Retried after the delay, which doubles
+            delay = self.app.config['CRON_RETRY_DELAY']
+            frozen_time.tick(delta=delay)
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 2)
+
+            frozen_time.tick(delta=delay)
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 2)
+
+            frozen_time.tick(delta=delay)
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 3)
+
+            # Dropped after CRON_MAX_ATTEMPTS
+            self.assertEqual(
+                self.db['scheduled_tasks'].count_documents(
+                    {'function': cron.func_str(failing)}), 0)
+
+    def test_claimed_task_is_skipped(self):
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def claimed():
+                CronTest.run_count += 1
+
+            schedule_task(datetime.utcnow(), claimed)
+
+            # Another process has claimed the task, but crashed
+            lease = self.app.config['CRON_LEASE']
+            self.db['scheduled_tasks'].update_one(
+                {'function': cron.func_str(claimed)},
+                {'$set': {'claimed_by': 'other',
+                          'lease_until': datetime.utcnow() + lease}})
+
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 0)
+
+            # After the lease has expired, the task is run again
+            frozen_time.tick(delta=lease)
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+    def test_parallel_workers(self):
+        self.app.config['CRON_WORKERS'] = 4
+
+        with self.app.app_context():
+            @schedulable
+            def collect(arg):
+                CronTest.received_arg.append(arg)
+
+            CronTest.received_arg = []
+            for index in range(20):
+                schedule_task(datetime.utcnow(), collect, index)
+
+            run_scheduled_tasks()
+
+            self.assertItemsEqual(CronTest.received_arg, range(20))
+            self.assertEqual(
+                self.db['scheduled_tasks'].count_documents(
+                    {'function': cron.func_str(collect)}), 0)
+
+    def test_args_stored_as_bson(self):
+        with self.app.app_context():
+            @schedulable
+            def with_args(*args):
+                CronTest.received_arg = args
+
+            args = (ObjectId(), datetime(2016, 1, 1), {'key': [1, 'a']})
+            schedule_task(datetime.utcnow(), with_args, *args)
+
+            task = self.db['scheduled_tasks'].find_one(
+                {'function': cron.func_str(with_args)})
+            self.assertEqual(task['args'], list(args))
+
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.received_arg, args)
+
+    def test_pickle_fallback(self):
+        with self.app.app_context():
+            @schedulable
+            def with_tuple(arg):
+                CronTest.received_arg = arg
+
+            with self.assertRaises(NotSchedulable):
+                schedule_task(datetime.utcnow(), with_tuple, (1, 2))
+
+            self.app.config['CRON_PICKLE_ARGS'] = True
+            schedule_task(datetime.utcnow(), with_tuple, (1, 2))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.received_arg, (1, 2))
+
+    def test_legacy_pickled_task(self):
+        self.app.config['CRON_PICKLE_ARGS'] = True
+        with self.app.app_context():
+            @schedulable
+            def legacy(arg):
+                CronTest.received_arg = arg
+
+            # Task as stored by older versions
+            self.db['scheduled_tasks'].insert_one({
+                'time': datetime.utcnow(),
+                'function': cron.func_str(legacy),
+                'args': pickle.dumps(('arg',))
+            })
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.received_arg, 'arg')
+
+    def test_migrate_tasks(self):
+        self.app.config['CRON_PICKLE_ARGS'] = True
+        with self.app.app_context():
+            @schedulable
+            def legacy(arg):
+                CronTest.run_count += 1
+
+            # Identical tasks as stored by older versions
+            for _ in range(2):
+                self.db['scheduled_tasks'].insert_one({
+                    'time': datetime.utcnow(),
+                    'function': cron.func_str(legacy),
+                    'args': pickle.dumps(('arg',))
+                })
+
+            self.assertEqual(migrate_tasks(), 2)
+            task = self.db['scheduled_tasks'].find_one(
+                {'function': cron.func_str(legacy)})
+            self.assertEqual(task['args'], ['arg'])
+
+            # Migrated tasks no longer need pickle
+            self.app.config['CRON_PICKLE_ARGS'] = False
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 1)
+
+    def test_same_task_pending_once(self):
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def count(arg):
+                CronTest.run_count += 1
+
+            schedule_task(datetime(2016, 1, 1, 2), count, 'a')
+            schedule_task(datetime(2016, 1, 1, 1), count, 'a')
+            schedule_task(datetime(2016, 1, 1, 3), count, 'a')
+            schedule_task(datetime(2016, 1, 1, 1), count, 'b')
+
+            # The earliest time is kept
+            frozen_time.tick(delta=timedelta(hours=1))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 2)
+
+            frozen_time.tick(delta=timedelta(hours=2))
+            run_scheduled_tasks()
+            self.assertEqual(CronTest.run_count, 2)
+
+
+class CronStatsTest(WebTest):
+    """Test statistics of scheduled tasks."""
+
+    def test_stats(self):
+        with self.app.app_context(), freeze_time(
+                "2016-01-01 00:00:00") as frozen_time:
+            @schedulable
+            def succeeding():
+                pass
+
+            @schedulable
+            def failing():
+                raise ValueError("Task failed")
+
+            schedule_task(datetime.utcnow(), succeeding)
+            schedule_task(datetime.utcnow(), failing)
+
+            frozen_time.tick(delta=timedelta(seconds=30))
+            run_scheduled_tasks()
+            # Scheduled after the run, as pending tasks are not duplicated
+            schedule_task(datetime(2016, 1, 1, 1), succeeding)
+
+            # The second task is due, but was not run yet
+            frozen_time.tick(delta=timedelta(hours=1))
+            stats = {item['function']: item for item in cron.get_stats()}
+
+        success = stats[cron.func_str(succeeding)]
+        self.assertEqual(success['runs'], 1)
+        self.assertEqual(success['failures'], 0)
+        self.assertEqual(success['last_lag'], 30)
+        self.assertEqual(success['histogram'], {'10ms': 1})
+        self.assertEqual(success['backlog'], 1)
+        self.assertEqual(success['lag'], 30)
+
+        failure = stats[cron.func_str(failing)]
+        self.assertEqual(failure['runs'], 1)
+        self.assertEqual(failure['failures'], 1)
+        self.assertTrue(failure['last_failed'])
+
+    def test_endpoint_admin_only(self):
+        with self.app.app_context():
+            @schedulable
+            def task():
+                pass
+
+            schedule_task(datetime.utcnow(), task)
+            run_scheduled_tasks()
+
+        user = self.new_object('users')
+        self.api.get('/cronstats', token=self.get_user_token(user['_id']),
+                     status_code=403)
+
+        items = self.api.get('/cronstats', token=self.get_root_token(),
+                             status_code=200).json['_items']
+        item = next(item for item in items
+                    if item['function'] == cron.func_str(task))
+        self.assertEqual(item['runs'], 1)
+        self.assertEqual(item['backlog'], 0)
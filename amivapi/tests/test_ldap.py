@@ -11,14 +11,16 @@ There is another file, "ldap_integration.py", which can be used to test
 integration with the real ldap. More info there.
 """
 
-from unittest.mock import MagicMock, patch, call
+from unittest.mock import MagicMock, patch
 import warnings
 
 from os import getenv
 from pprint import pformat
+import re
 
 from amivapi import ldap
 from amivapi.tests.utils import WebTest, WebTestNoAuth, skip_if_false
+from amivapi.utils import TTLCache
 
 
 class LdapTest(WebTestNoAuth):
@@ -68,6 +70,43 @@ class LdapTest(WebTestNoAuth):
             # But we will assert that sync_one is called for successful auth
             patched_sync.assert_called_with(nethz)
 
+    def test_ldap_sync_cached(self):
+        """Test that recently synchronized users are not synchronized again."""
+        self.app.ldap_sync_cache = TTLCache(10, 60)
+        self.mock_ldap.authenticate = MagicMock(return_value=True)
+        login_data = {'username': 'pablo', 'password': 'p4bl0'}
+        user = {'_id': self.new_object('users', nethz='pablo')['_id']}
+
+        with patch('amivapi.ldap.sync_one', return_value=user) as sync:
+            response = self.api.post("/sessions", data=login_data,
+                                     status_code=201)
+            self.assertIn('ldap;dur=', response.headers['Server-Timing'])
+            self.api.post("/sessions", data=login_data, status_code=201)
+            sync.assert_called_once_with('pablo')
+
+            # Deleted users are synchronized again
+            self.db['users'].delete_one(user)
+            self.new_object('users', nethz='pablo')
+            self.api.post("/sessions", data=login_data, status_code=201)
+            self.assertEqual(sync.call_count, 2)
+
+    def test_failed_binds_throttled(self):
+        """Test that LDAP is not asked again after too many failures."""
+        self.app.config['LDAP_MAX_FAILED_BINDS'] = 2
+        self.app.ldap_failed_binds = TTLCache(10, 60)
+        self.mock_ldap.authenticate = MagicMock(return_value=False)
+        login_data = {'username': 'pablo', 'password': 'wrong'}
+
+        for _ in range(3):
+            self.api.post("/sessions", data=login_data, status_code=401)
+        self.assertEqual(self.mock_ldap.authenticate.call_count, 2)
+
+        # Other users are not affected
+        self.api.post("/sessions", data={'username': 'other',
+                                         'password': 'wrong'},
+                      status_code=401)
+        self.assertEqual(self.mock_ldap.authenticate.call_count, 3)
+
     def test_escape(self):
         """Test proper escaping of all characters."""
         to_escape = "thisisok*()\\" + chr(0)
@@ -274,19 +313,104 @@ class LdapTest(WebTestNoAuth):
         """Test if sync_all builds the query correctly and creates users."""
         # Shorten ou list
         self.app.config['LDAP_DEPARTMENT_MAP'] = {'a': 'itet'}
-        expected_query = '(& (ou=VSETH Mitglied) (| (departmentNumber=*a*)) )'
-        search_results = (i for i in [1, 2])
+        self.app.config['LDAP_SYNC_CHUNK_SIZE'] = 2
+        query = '(& (ou=VSETH Mitglied) (| (departmentNumber=*a*)) )'
+        prefixes = ''.join('(cn=%s*)' % p for p in ldap.SEARCH_PREFIXES)
         search = 'amivapi.ldap._search'
-        create = 'amivapi.ldap._create_or_update_user'
+        sync = 'amivapi.ldap._sync_users'
+        counts = {'created': 1, 'updated': 0, 'unchanged': 0}
 
-        with patch(search, return_value=search_results) as mock_search:
-            with patch(create, return_value=3) as mock_create:
+        with patch(search, side_effect=lambda q: iter([1, 2])) as mock_search:
+            with patch(sync, return_value=counts) as mock_sync:
                 with self.app.app_context():
                     result = ldap.sync_all()
 
-                mock_search.assert_called_with(expected_query)
-                mock_create.assert_has_calls([call(1), call(2)])
-                self.assertEqual(result, [3, 3])
+                # One search per prefix and one for everything else
+                mock_search.assert_any_call('(& %s (cn=a*))' % query)
+                mock_search.assert_called_with(
+                    '(& %s (!(| %s)))' % (query, prefixes))
+                self.assertEqual(mock_search.call_count,
+                                 len(ldap.SEARCH_PREFIXES) + 1)
+
+                # Processed in chunks
+                mock_sync.assert_called_with([1, 2])
+                chunks = mock_sync.call_count
+                self.assertEqual(result['created'], chunks)
+
+    def test_sync_all_chunked(self):
+        """Test that progress is reported after every chunk."""
+        self.app.config['ldap_connector'] = FakeLdap([
+            self.fake_ldap_data(cn=[nethz]) for nethz in ('a', 'b', 'c')])
+
+        with self.app.test_request_context():
+            progress = list(ldap.sync_all_chunked(chunk_size=2))
+
+        self.assertEqual(progress, [
+            {'created': 2, 'updated': 0, 'unchanged': 0},
+            {'created': 3, 'updated': 0, 'unchanged': 0},
+        ])
+
+    def test_sync_all_changes_only(self):
+        """Test that only new and changed users are written."""
+        self.app.config['ldap_connector'] = FakeLdap([
+            self.fake_ldap_data(cn=['unchanged']),
+            self.fake_ldap_data(cn=['changed'], sn=['New']),
+            self.fake_ldap_data(cn=['new']),
+        ])
+        with self.app.test_request_context():
+            for nethz in ('unchanged', 'changed'):
+                ldap.sync_one(nethz)
+        self.db['users'].update_one({'nethz': 'changed'},
+                                    {'$set': {'lastname': 'Old'}})
+        unchanged = self.db['users'].find_one({'nethz': 'unchanged'})
+
+        with self.app.test_request_context():
+            result = ldap.sync_all()
+
+        self.assertEqual(result,
+                         {'created': 1, 'updated': 1, 'unchanged': 1})
+        self.assertEqual(
+            self.db['users'].find_one({'nethz': 'changed'})['lastname'],
+            'New')
+        self.assertEqual(self.db['users'].find_one({'nethz': 'unchanged'}),
+                         unchanged)
+        self.assertEqual(self.db['users'].count_documents({'nethz': 'new'}),
+                         1)
+
+        # Nothing to do for the next sync
+        with self.app.test_request_context():
+            result = ldap.sync_all()
+        self.assertEqual(result,
+                         {'created': 0, 'updated': 0, 'unchanged': 3})
+
+
+class FakeLdap(object):
+    """Stand-in for `AuthenticatedLdap` with a fixed set of entries.
+
+    Only supports the queries used by `amivapi.ldap`: a single cn, all
+    entries with a cn prefix, or all entries without any of the prefixes.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+
+    def authenticate(self, cn, password):
+        return any(entry['cn'][0] == cn for entry in self.entries)
+
+    def search(self, query, attributes=None):
+        cns = [entry['cn'][0] for entry in self.entries]
+        exact = re.search(r'\(cn=([^*)]+)\)', query)
+        prefix = re.search(r'\(cn=([^*)]+)\*\)\)$', query)
+        if exact:
+            matches = [cn == exact.group(1) for cn in cns]
+        elif query.endswith(')))'):
+            # Everything not starting with any prefix
+            matches = [cn[0] not in ldap.SEARCH_PREFIXES for cn in cns]
+        elif prefix:
+            matches = [cn.startswith(prefix.group(1)) for cn in cns]
+        else:
+            matches = [True for cn in cns]
+        return [entry for entry, match in zip(self.entries, matches) if match]
 
 
 # Integration Tests
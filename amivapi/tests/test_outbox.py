@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# license: AGPLv3, see LICENSE for details. In addition we strongly encourage
+#          you to buy us beer if we meet and you like the software.
+"""Tests for the mail outbox."""
+
+from datetime import datetime, timedelta
+import smtplib
+from unittest.mock import MagicMock, patch
+
+from freezegun import freeze_time
+
+from amivapi.outbox import SMTPSession, send_queued_mails
+from amivapi.tests.utils import WebTest
+from amivapi.utils import mail, mail_many
+
+
+class OutboxTest(WebTest):
+    """Test queueing and sending of mails."""
+
+    def setUp(self):
+        """Enable the mail queue."""
+        super().setUp(MAIL_QUEUE=True)
+
+    def send_queued(self):
+        """Run the worker once."""
+        with self.app.app_context(), SMTPSession() as session:
+            return send_queued_mails(session)
+
+    def test_queued_mails_are_sent(self):
+        """Mails are only sent by the worker."""
+        with self.app.app_context():
+            mail_many([('api@amiv.ch', 'a@amiv.ch', 'First', 'Text'),
+                       ('api@amiv.ch', 'b@amiv.ch', 'Second', 'Text')])
+
+        self.assertEqual(self.app.test_mails, [])
+        self.assertEqual(self.db['mail_outbox'].count_documents({}), 2)
+
+        self.assertEqual(self.send_queued(), 2)
+        self.assertEqual([item['receivers'] for item in self.app.test_mails],
+                         ['a@amiv.ch', 'b@amiv.ch'])
+        self.assertEqual(self.db['mail_outbox'].count_documents({}), 0)
+
+        # Nothing left
+        self.assertEqual(self.send_queued(), 0)
+
+    def test_retry_with_backoff(self):
+        """Failed mails are retried later and dropped eventually."""
+        self.app.config['MAIL_MAX_ATTEMPTS'] = 2
+        delay = self.app.config['MAIL_RETRY_DELAY']
+        failure = smtplib.SMTPServerDisconnected('Gone')
+
+        with self.app.app_context():
+            mail('api@amiv.ch', 'a@amiv.ch', 'Subject', 'Text')
+
+        with patch('amivapi.outbox.deliver', side_effect=failure), \
+                freeze_time(datetime.utcnow()) as frozen_time:
+            self.assertEqual(self.send_queued(), 0)
+            item = self.db['mail_outbox'].find_one()
+            self.assertEqual(item['attempts'], 1)
+
+            # Not due yet
+            frozen_time.tick(delta=delay - timedelta(seconds=1))
+            self.send_queued()
+            self.assertEqual(self.db['mail_outbox'].find_one()['attempts'], 1)
+
+            # Second attempt fails as well, the mail is dropped
+            frozen_time.tick(delta=timedelta(seconds=1))
+            self.send_queued()
+            self.assertEqual(self.db['mail_outbox'].count_documents({}), 0)
+
+    def test_unexpected_error(self):
+        """Mails failing unexpectedly are parked, the others are sent."""
+        with self.app.app_context():
+            mail_many([('api@amiv.ch', 'a@amiv.ch', 'First', 'Text'),
+                       ('api@amiv.ch', 'b@amiv.ch', 'Second', 'Text')])
+
+        with patch('amivapi.outbox.deliver',
+                   side_effect=[ValueError('Broken'), None]):
+            self.assertEqual(self.send_queued(), 1)
+
+        item = self.db['mail_outbox'].find_one()
+        self.assertEqual(item['subject'], 'First')
+        self.assertEqual(item['error'], 'Broken')
+        self.assertNotIn('next_attempt', item)
+
+        # Not claimed again
+        self.assertEqual(self.send_queued(), 0)
+        self.assertEqual(self.db['mail_outbox'].find_one()['attempts'], 1)
+
+    def test_unfinished_attempts(self):
+        """Mails whose attempts never finished are dropped eventually."""
+        with self.app.app_context():
+            mail('api@amiv.ch', 'a@amiv.ch', 'Subject', 'Text')
+
+        # The worker crashed during every attempt
+        self.db['mail_outbox'].update_many(
+            {}, {'$set': {'attempts': self.app.config['MAIL_MAX_ATTEMPTS']}})
+
+        self.assertEqual(self.send_queued(), 0)
+        self.assertEqual(self.app.test_mails, [])
+        self.assertEqual(self.db['mail_outbox'].count_documents({}), 0)
+
+    def test_retry_succeeds(self):
+        """A mail which failed once is sent on the next attempt."""
+        failure = smtplib.SMTPServerDisconnected('Gone')
+
+        with self.app.app_context():
+            mail('api@amiv.ch', 'a@amiv.ch', 'Subject', 'Text')
+
+        with patch('amivapi.outbox.deliver', side_effect=failure):
+            self.send_queued()
+
+        self.db['mail_outbox'].update_many(
+            {}, {'$set': {'next_attempt': datetime.utcnow()}})
+        self.assertEqual(self.send_queued(), 1)
+        self.assertEqual(len(self.app.test_mails), 1)
+
+
+class SMTPSessionTest(WebTest):
+    """Test that the SMTP connection is reused."""
+
+    def setUp(self):
+        """Configure a (mocked) SMTP server."""
+        super().setUp(SMTP_SERVER='localhost', SMTP_PORT=25,
+                      SMTP_STARTTLS=False)
+        # Don't store mails in `test_mails`, use the SMTP server
+        self.app.config['TESTING'] = False
+
+    def test_connection_reused(self):
+        """All mails are sent over one connection."""
+        with patch('amivapi.outbox.smtplib.SMTP') as smtp, \
+                self.app.app_context():
+            mail_many([('api@amiv.ch', 'a@amiv.ch', 'First', 'Text'),
+                       ('api@amiv.ch', 'b@amiv.ch', 'Second', 'Text')])
+
+        smtp.assert_called_once()
+        self.assertEqual(smtp.return_value.sendmail.call_count, 2)
+        smtp.return_value.quit.assert_called_once()
+
+    def test_reconnect(self):
+        """A closed connection is opened again."""
+        first, second = MagicMock(), MagicMock()
+        first.sendmail.side_effect = [
+            None, smtplib.SMTPServerDisconnected('Idle')]
+
+        with patch('amivapi.outbox.smtplib.SMTP',
+                   side_effect=[first, second]), \
+                self.app.app_context(), SMTPSession() as session:
+            session.send('api@amiv.ch', 'a@amiv.ch', 'First', 'Text')
+            session.send('api@amiv.ch', 'b@amiv.ch', 'Second', 'Text')
+
+        self.assertEqual(first.sendmail.call_count, 2)
+        second.sendmail.assert_called_once()
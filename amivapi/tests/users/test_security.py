@@ -8,13 +8,15 @@ Includes item and field permissions as well as password hashing.
 """
 
 import json
+from unittest.mock import patch
+
 from bson import ObjectId
 
 from passlib.hash import pbkdf2_sha256
 
 from amivapi.tests import utils
 from amivapi.users.security import (
-    hash_on_insert, hash_on_update)
+    calibrate_rounds, hash_on_insert, hash_on_update)
 
 
 class PasswordHashing(utils.WebTestNoAuth):
@@ -101,6 +103,16 @@ class PasswordHashing(utils.WebTestNoAuth):
 
         self.assertVerifyDB(user['_id'], "other_pw")
 
+    def test_calibrate_rounds(self):
+        """Test that the rounds are scaled to the target time."""
+        def fake_measure(rounds):
+            return rounds * 1e-5  # seconds
+
+        with patch('amivapi.users.security.measure_hashing',
+                   side_effect=fake_measure), self.app.app_context():
+            self.assertEqual(calibrate_rounds(0.1), 10000)
+            self.assertEqual(calibrate_rounds(0.5), 50000)
+
 
 class UserFieldsTest(utils.WebTest):
     """Test field permissions.
@@ -4,6 +4,7 @@
 #          you to buy us beer if we meet and you like the software.
 """User module initialization."""
 
+from amivapi.auth.context import clear_auth_context
 from amivapi.utils import register_domain
 
 from .model import userdomain
@@ -44,4 +45,7 @@ def init_app(app):
 
     app.on_fetched_item_users += hide_fields
 
+    # Membership is part of the auth context of users
+    app.on_updated_users += clear_auth_context
+
     init_subscriber_list(app)
@@ -5,11 +5,12 @@
 
 """User Auth class."""
 
-from bson import ObjectId
+from time import perf_counter
 
 from flask import current_app, g
 
 from amivapi.auth import AmivTokenAuth
+from amivapi.auth.context import get_auth_context
 from amivapi.utils import on_post_hook
 
 
@@ -65,13 +66,7 @@ class UserAuth(AmivTokenAuth):
             dict: The filter, will be combined with other filters in the hook.
                 Return None if no filters should be applied.
         """
-        # Find out if not member
-        collection = current_app.data.driver.db['users']
-        # set projection to only return membership
-        result = collection.find_one({'_id': ObjectId(user_id)},
-                                     {'membership': 1})
-
-        if result['membership'] == "none":
+        if not get_auth_context(user_id).is_member:
             # Can't see others
             return {'_id': user_id}
         else:
@@ -223,3 +218,40 @@ def hash_on_update(updates, original):
         original (dict): dict of user data before the update
     """
     _hash_password(updates)
+
+
+def measure_hashing(rounds=None):
+    """Measure the time in seconds to hash a password.
+
+    Args:
+        rounds (int): Rounds to use, defaults to the `PASSWORD_CONTEXT`
+    """
+    context = current_app.config['PASSWORD_CONTEXT']
+    settings = {} if rounds is None else {'rounds': rounds}
+    start = perf_counter()
+    context.encrypt('calibration', **settings)
+    return perf_counter() - start
+
+
+def calibrate_rounds(target):
+    """Find the rounds for the default scheme of `PASSWORD_CONTEXT`, s.t.
+    hashing a password takes `target` seconds on the current machine.
+
+    The rounds are increased until hashing takes long enough to be measured
+    reliably, and then scaled to the target.
+
+    Args:
+        target (float): Time in seconds
+
+    Returns:
+        int: Number of rounds
+    """
+    handler = current_app.config['PASSWORD_CONTEXT'].handler()
+    rounds = max(handler.min_rounds, 1000)
+    duration = measure_hashing(rounds)
+    while duration < 0.05 and rounds < handler.max_rounds // 2:
+        rounds *= 2
+        duration = measure_hashing(rounds)
+
+    calibrated = int(rounds * target / duration)
+    return min(max(calibrated, handler.min_rounds), handler.max_rounds)
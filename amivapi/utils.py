@@ -6,20 +6,23 @@
 
 
 from base64 import b64encode
+from collections import OrderedDict
 from contextlib import contextmanager
 from copy import deepcopy
-from email.mime.text import MIMEText
+from datetime import timedelta
 from os import urandom
 from binascii import hexlify
-import smtplib
 from functools import wraps
 import json
+from threading import Lock
+from time import monotonic
 
 from bson import ObjectId
-from eve.utils import config
 from flask import current_app as app
 from flask import g
 
+from amivapi import outbox
+
 
 def token_urlsafe(nbytes=32):
     """Cryptographically random generate a token that can be passed in a URL.
@@ -56,6 +59,75 @@ def admin_permissions():
         g.resource_admin = old_admin
 
 
+class TTLCache(object):
+    """Small in-process cache with LRU eviction and expiring entries.
+
+    Every worker process has its own cache, so a change made by another
+    process is only noticed once the entry expires. Keep `ttl` short for
+    anything security related.
+
+    A cache with `maxsize` 0 or without `ttl` is disabled: `get` always
+    returns the default and `set` does nothing.
+
+    Args:
+        maxsize (int): Maximum number of entries, the least recently used
+            entry is evicted first.
+        ttl (timedelta or number): Lifetime of an entry (seconds if number).
+    """
+
+    def __init__(self, maxsize, ttl):
+        if isinstance(ttl, timedelta):
+            ttl = ttl.total_seconds()
+        self.maxsize = maxsize or 0
+        self.ttl = ttl or 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        """True if entries are stored at all."""
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key, default=None):
+        """Return the cached value or `default` if missing or expired."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires < monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store a value, evict the least recently used entries if full."""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove an entry and return its value (expired or not)."""
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
 def get_id(item):
     """Get the id of a field in a relation. Depending on the embedding clause
     a field returned by a mongo query may be an ID or an object. This function
@@ -83,43 +155,25 @@ def mail(sender, to, subject, text):
         subject(string): Subject string
         text(string): Mail content
     """
-    if app.config.get('TESTING', False):
-        app.test_mails.append({
-            'subject': subject,
-            'from': sender,
-            'receivers': to,
-            'text': text
-        })
-    elif config.SMTP_SERVER and config.SMTP_PORT:
-        msg = MIMEText(text)
-        msg['Subject'] = subject
-        msg['From'] = sender
-        msg['To'] = ';'.join([to] if isinstance(to, str) else to)
-
-        try:
-            with smtplib.SMTP(config.SMTP_SERVER,
-                              port=config.SMTP_PORT,
-                              timeout=config.SMTP_TIMEOUT) as smtp:
-                status_code, _ = smtp.starttls()
-                if status_code != 220:
-                    app.logger.error("Failed to create secure "
-                                     "SMTP connection!")
-                    return
-
-                if config.SMTP_USERNAME and config.SMTP_PASSWORD:
-                    smtp.login(config.SMTP_USERNAME, config.SMTP_PASSWORD)
-                else:
-                    smtp.ehlo()
-
-                try:
-                    smtp.sendmail(msg['From'], to, msg.as_string())
-                except smtplib.SMTPRecipientsRefused:
-                    error = ("Failed to send mail:\n"
-                             "From: %s\nTo: %s\n"
-                             "Subject: %s\n\n%s")
-                    app.logger.error(error % (sender, str(to), subject, text))
-        except smtplib.SMTPException as e:
-            app.logger.error("SMTP error trying to send mails: %s" % e)
+    mail_many([(sender, to, subject, text)])
+
+
+def mail_many(mails):
+    """Send several mails using a single SMTP connection.
+
+    If `MAIL_QUEUE` is enabled, the mails are only stored and sent later by
+    the mail worker (see `amivapi.outbox`).
+
+    Args:
+        mails(list): Tuples `(sender, to, subject, text)`, see `mail`
+    """
+    if not mails:
+        return
+
+    if app.config.get('MAIL_QUEUE', False):
+        outbox.enqueue(mails)
+    else:
+        outbox.send_now(mails)
 
 
 def run_embedded_hooks_fetched_item(resource, item):